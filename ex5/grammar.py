@@ -0,0 +1,541 @@
+#!/usr/bin/env python3
+
+"""
+compiler for the jsgf-like grammars of dialogos (and the .gram files of ex5)
+
+a grammar like
+
+    root $input;
+    $input = [$anzahl] $tier {$.tier=$tier} | $anzahl {$.anzahl=$anzahl} [(Sack|Säcke)];
+    $anzahl = (eine|einen|eins) {$=1} | "zwei" {$=2} | "drei" {$=3};
+    $tier = hamster {$="hamster"} | katze[n] {$="katze"} | hund[e] {$="hund"};
+
+is compiled into an automaton over words, so the asr text is parsed without any model or server:
+
+    grammar = compile_grammar(source)
+    grammar.parse('zwei katzen')    # -> {'tier': 'katze'}
+    grammar.parse('drei säcke')     # -> {'anzahl': 3}
+    grammar.parse('ein pferd')      # -> None (not in the grammar)
+
+supported: rules ($name or <name>), root/public, alternatives |, groups (), optional parts [],
+repetitions * and +, quoted words and semantic tags ({$=...}, {$.slot=...}, with numbers,
+strings, true/false or $rule as values). like in the dialogos projects, an optional part glued to a
+word is a suffix of the word (katze[n] is katze or katzen).
+
+the rules are inlined into one nondeterministic automaton, which is made deterministic lazily while
+parsing (each word step is computed once and then looked up in a dict). so parsing takes one lookup
+per word, the tags of the chosen path are evaluated at the end.
+"""
+
+import argparse
+import re
+import xml.etree.ElementTree as ElementTree
+
+
+class GrammarError(ValueError):
+    """the grammar can not be compiled"""
+
+
+# tokens of the grammar source
+_token_pattern = re.compile(r'''
+    (?P<space>\s+|//[^\n]*|/\*.*?\*/)
+  | (?P<tag>\{[^}]*\})
+  | (?P<quoted>"[^"]*")
+  | (?P<rule>\$\w+|<[\w.]+>)
+  | (?P<symbol>[()\[\]|;=*+])
+  | (?P<word>[^\s()\[\]|;=*+{}"$<>]+)
+''', re.VERBOSE | re.DOTALL)
+
+# one statement of a tag, e.g. $=1 or $.tier=$tier
+_statement_pattern = re.compile(r'^\$(?:\.(\w+))?\s*=\s*(.+)$', re.DOTALL)
+
+# characters around the words of the asr text that are ignored
+_punctuation = '.,!?;:"\''
+
+
+def normalize_words(text: str) -> list:
+    """the words of a text as they are matched against the grammar (lower case, without punctuation)"""
+    words = (word.strip(_punctuation) for word in text.lower().split())
+    return [word for word in words if word]
+
+
+def _tokenize(source: str) -> list:
+    tokens = []
+    position = 0
+    while position < len(source):
+        match = _token_pattern.match(source, position)
+        if match is None:
+            raise GrammarError(f'unexpected character {source[position]!r} at position {position}')
+        kind = match.lastgroup
+        if kind != 'space':
+            # (kind, text, directly after the previous token)
+            glued = bool(tokens) and tokens[-1][3] == position
+            tokens.append((kind, match.group(kind), glued, match.end()))
+        position = match.end()
+    return [(kind, text, glued) for kind, text, glued, _ in tokens]
+
+
+def _parse_tag(text: str) -> tuple:
+    """
+    the statements of a tag
+
+    :return: tuple of (slot or None for the rule's value, value expression)
+    """
+    statements = []
+    for statement in text[1:-1].split(';'):
+        statement = statement.strip()
+        if not statement:
+            continue
+        match = _statement_pattern.match(statement)
+        if match is None:
+            raise GrammarError(f'unsupported tag {text}')
+        statements.append((match.group(1), match.group(2).strip()))
+    return tuple(statements)
+
+
+def _rule_name(text: str) -> str:
+    return text[1:] if text.startswith('$') else text[1:-1]
+
+
+class _RuleParser:
+    """
+    parses the right hand side of a rule into a tree of tuples:
+
+    ('words', [word, ...]), ('ref', name), ('seq', [node, ...]), ('alt', [node, ...]),
+    ('opt', node), ('repeat', node, at_least_once), ('tag', statements)
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None, False)
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def expect(self, symbol):
+        kind, text, _ = self.take()
+        if kind != 'symbol' or text != symbol:
+            raise GrammarError(f'expected {symbol!r} but got {text!r}')
+
+    def alternatives(self):
+        options = [self.sequence()]
+        while self.peek()[:2] == ('symbol', '|'):
+            self.take()
+            options.append(self.sequence())
+        return options[0] if len(options) == 1 else ('alt', options)
+
+    def sequence(self):
+        items = []
+        while True:
+            kind, text, glued = self.peek()
+            if kind is None or (kind == 'symbol' and text in '|)];'):
+                break
+            item = self.item()
+            # katze[n]: an optional part glued to a word is a suffix of the word
+            if (item[0] == 'opt' and glued and items and items[-1][0] == 'words'
+                    and item[1][0] == 'words' and len(item[1][1]) == 1):
+                *prefix, word = items[-1][1]
+                suffixed = ('alt', [('words', [word + item[1][1][0]]), ('words', [word])])
+                items[-1:] = ([('words', prefix)] if prefix else []) + [suffixed]
+                continue
+            items.append(item)
+        return items[0] if len(items) == 1 else ('seq', items)
+
+    def item(self):
+        node = self.primary()
+        kind, text, _ = self.peek()
+        if kind == 'symbol' and text in '*+':
+            self.take()
+            if node[0] == 'tag':
+                raise GrammarError('a tag can not be repeated')
+            node = ('repeat', node, text == '+')
+        return node
+
+    def primary(self):
+        kind, text, _ = self.take()
+        if kind == 'word':
+            return ('words', [text.lower()])
+        if kind == 'quoted':
+            return ('words', normalize_words(text[1:-1]))
+        if kind == 'rule':
+            return ('ref', _rule_name(text))
+        if kind == 'tag':
+            return ('tag', _parse_tag(text))
+        if kind == 'symbol' and text == '(':
+            node = self.alternatives()
+            self.expect(')')
+            return node
+        if kind == 'symbol' and text == '[':
+            node = self.alternatives()
+            self.expect(']')
+            return ('opt', node)
+        raise GrammarError(f'unexpected {text!r}' if text else 'unexpected end of the grammar')
+
+
+def parse_rules(source: str) -> tuple:
+    """
+    read the rules of a grammar
+
+    :return: dict rule name -> tree of the rule, name of the root rule
+    """
+    tokens = _tokenize(source)
+    rules = {}
+    root = None
+    public = []
+
+    # split into statements ending with ';' (a ; in a tag or quoted word is part of that token)
+    statement = []
+    for token in tokens:
+        if token[:2] == ('symbol', ';'):
+            if statement:
+                kind, text, _ = statement[0]
+                if kind == 'word' and text == 'root' and len(statement) == 2 and statement[1][0] == 'rule':
+                    root = _rule_name(statement[1][1])
+                elif (kind == 'rule' or (kind == 'word' and text == 'public')) and ('symbol', '=') in [t[:2] for t in statement]:
+                    if kind == 'word':
+                        statement = statement[1:]
+                        public.append(_rule_name(statement[0][1]))
+                    if statement[0][0] != 'rule' or statement[1][:2] != ('symbol', '='):
+                        raise GrammarError(f'invalid rule {" ".join(t[1] for t in statement)}')
+                    name = _rule_name(statement[0][1])
+                    parser = _RuleParser(statement[2:])
+                    rules[name] = parser.alternatives()
+                    if parser.position != len(parser.tokens):
+                        raise GrammarError(f'unexpected {parser.peek()[1]!r} in rule {name}')
+                # other headers (#JSGF V1.0, grammar ..., language ...) do not matter for parsing
+            statement = []
+        else:
+            statement.append(token)
+    if statement:
+        raise GrammarError('missing ; at the end of the grammar')
+
+    if root is None:
+        # without a root declaration, the first public rule (or the first rule) is the root
+        root = public[0] if public else next(iter(rules), None)
+    if root not in rules:
+        raise GrammarError(f'the root rule {root} is not defined')
+    return rules, root
+
+
+class _State:
+    """state of the nondeterministic automaton"""
+    __slots__ = ('word', 'targets', 'event')
+
+    def __init__(self, word=None, targets=None, event=None):
+        # word that has to be read to go to targets[0] (None: targets are reached without reading)
+        self.word = word
+        # following states, by priority (an empty list for the final state)
+        self.targets = targets if targets is not None else []
+        # what happens when passing the state: ('enter', rule), ('exit', rule) or ('tag', statements)
+        self.event = event
+
+
+class _DeterministicState:
+    """state of the deterministic automaton: the states the nondeterministic one can be in"""
+    __slots__ = ('threads', 'final', 'steps')
+
+    def __init__(self, threads, final):
+        # word reading (or final) states of the nondeterministic automaton, by priority
+        self.threads = threads
+        # index of the first final thread (None if this state does not accept)
+        self.final = final
+        # word -> (next state, (index of the thread it came from, events on the way) per thread)
+        self.steps = {}
+
+
+class Grammar:
+    """a compiled grammar"""
+
+    def __init__(self, rules: dict, root: str):
+        """
+        :param rules: rule name -> tree of the rule (see parse_rules)
+        :param root: name of the rule the input has to match
+        """
+        self.rules = rules
+        self.root = root
+
+        self._states = []
+        self._final = self._new_state()
+        start = self._build(('ref', root), self._final, ())
+        # closure of each state: the word reading (or final) states reached without reading,
+        # with the events on the way
+        self._closures = {}
+        # all words of the grammar (other words never match, so they are not cached)
+        self.vocabulary = {state.word for state in self._states if state.word is not None}
+
+        self._deterministic = {}
+        closure = self._closure(start)
+        self._start_events = [events for _, events in closure]
+        self._start = self._deterministic_state(tuple(state for state, _ in closure))
+
+    def _new_state(self, word=None, targets=None, event=None) -> int:
+        self._states.append(_State(word, targets, event))
+        return len(self._states) - 1
+
+    def _build(self, node, follow: int, expanding: tuple) -> int:
+        """
+        add the states of a tree, followed by the state follow
+
+        :param expanding: names of the rules being inlined (to find recursive rules)
+        :return: the first state of the tree
+        """
+        kind = node[0]
+        if kind == 'words':
+            for word in reversed(node[1]):
+                follow = self._new_state(word, [follow])
+            return follow
+        if kind == 'seq':
+            for item in reversed(node[1]):
+                follow = self._build(item, follow, expanding)
+            return follow
+        if kind == 'alt':
+            return self._new_state(targets=[self._build(option, follow, expanding) for option in node[1]])
+        if kind == 'opt':
+            # prefer taking the optional part
+            return self._new_state(targets=[self._build(node[1], follow, expanding), follow])
+        if kind == 'repeat':
+            loop = self._new_state()
+            body = self._build(node[1], loop, expanding)
+            self._states[loop].targets = [body, follow]
+            return body if node[2] else loop
+        if kind == 'tag':
+            return self._new_state(targets=[follow], event=('tag', node[1]))
+        if kind == 'ref':
+            name = node[1]
+            if name not in self.rules:
+                raise GrammarError(f'the rule {name} is not defined')
+            if name in expanding:
+                # (only regular grammars can be compiled into a finite automaton)
+                raise GrammarError(f'the rule {name} is recursive')
+            exit_state = self._new_state(targets=[follow], event=('exit', name))
+            body = self._build(self.rules[name], exit_state, expanding + (name,))
+            return self._new_state(targets=[body], event=('enter', name))
+        raise GrammarError(f'unknown node {kind}')
+
+    def _closure(self, start: int) -> list:
+        """
+        the word reading (or final) states reached from start without reading a word
+
+        :return: list of (state, events on the way), by priority
+        """
+        closure = self._closures.get(start)
+        if closure is not None:
+            return closure
+
+        closure = []
+        visited = set()
+        # depth first, so the first path to a state is the one with the highest priority
+        stack = [(start, ())]
+        while stack:
+            index, events = stack.pop()
+            if index in visited:
+                continue
+            visited.add(index)
+            state = self._states[index]
+            if state.event is not None:
+                events = events + (state.event,)
+            if state.word is not None or index == self._final:
+                closure.append((index, events))
+            else:
+                stack.extend((target, events) for target in reversed(state.targets))
+
+        self._closures[start] = closure
+        return closure
+
+    def _deterministic_state(self, threads: tuple) -> _DeterministicState:
+        state = self._deterministic.get(threads)
+        if state is None:
+            final = next((i for i, thread in enumerate(threads) if thread == self._final), None)
+            state = self._deterministic[threads] = _DeterministicState(threads, final)
+        return state
+
+    def _step(self, state: _DeterministicState, word: str):
+        """
+        read one word
+
+        :return: (next state, back pointers) or None if no thread can read the word
+        """
+        step = state.steps.get(word)
+        if step is not None or word not in self.vocabulary:
+            return step
+
+        threads, back = [], []
+        seen = set()
+        for i, thread in enumerate(state.threads):
+            if self._states[thread].word != word:
+                continue
+            for target, events in self._closure(self._states[thread].targets[0]):
+                if target not in seen:
+                    seen.add(target)
+                    threads.append(target)
+                    back.append((i, (('word', word),) + events))
+
+        step = (self._deterministic_state(tuple(threads)), back) if threads else None
+        state.steps[word] = step
+        return step
+
+    def match_events(self, words: list):
+        """
+        the events of the highest priority path reading the words
+
+        :return: list of events or None if the words do not match the grammar
+        """
+        state = self._start
+        path = []
+        for word in words:
+            step = self._step(state, word)
+            if step is None:
+                return None
+            state, back = step
+            path.append(back)
+
+        thread = state.final
+        if thread is None:
+            return None
+
+        # follow the back pointers to the start
+        chunks = []
+        for back in reversed(path):
+            thread, events = back[thread]
+            chunks.append(events)
+        chunks.append(self._start_events[thread])
+        return [event for events in reversed(chunks) for event in events]
+
+    def matches(self, text: str) -> bool:
+        """check if the text is in the language of the grammar"""
+        return self.match_events(normalize_words(text)) is not None
+
+    def parse(self, text: str):
+        """
+        parse a text (e.g. the asr result)
+
+        :return: the value of the root rule (its tags, or the matched words if it has none),
+            None if the text does not match the grammar
+        """
+        events = self.match_events(normalize_words(text))
+        if events is None:
+            return None
+        return _evaluate(events)
+
+
+_unset = object()
+
+
+class _Frame:
+    """a rule being evaluated"""
+    __slots__ = ('value', 'words', 'refs')
+
+    def __init__(self):
+        self.value = _unset
+        self.words = []
+        # rule name -> value of the last match of the rule inside this one
+        self.refs = {}
+
+
+def _value(expression: str, frame: _Frame):
+    """value of the right hand side of a tag statement"""
+    if expression.startswith('$'):
+        name = expression[1:].strip()
+        return frame.refs.get(name)
+    if expression[0] in '"\'' and expression[-1] == expression[0]:
+        return expression[1:-1]
+    if expression in ('true', 'false'):
+        return expression == 'true'
+    try:
+        return int(expression)
+    except ValueError:
+        pass
+    try:
+        return float(expression)
+    except ValueError:
+        raise GrammarError(f'unsupported value {expression}')
+
+
+def _evaluate(events: list):
+    """run the tags of a path, return the value of the root rule"""
+    stack = [_Frame()]
+    for event in events:
+        kind = event[0]
+        frame = stack[-1]
+        if kind == 'word':
+            frame.words.append(event[1])
+        elif kind == 'enter':
+            stack.append(_Frame())
+        elif kind == 'exit':
+            stack.pop()
+            parent = stack[-1]
+            # without tags, the value of a rule is the text it matched
+            parent.refs[event[1]] = ' '.join(frame.words) if frame.value is _unset else frame.value
+            parent.words.extend(frame.words)
+        else:
+            for slot, expression in event[1]:
+                value = _value(expression, frame)
+                if slot is None:
+                    frame.value = value
+                else:
+                    if not isinstance(frame.value, dict):
+                        frame.value = {}
+                    frame.value[slot] = value
+
+    # the outermost frame only holds the root rule
+    return next(iter(stack[0].refs.values()))
+
+
+def compile_grammar(source: str) -> Grammar:
+    """compile the source of a grammar"""
+    return Grammar(*parse_rules(source))
+
+
+def load_grammar(path: str) -> Grammar:
+    """compile a .gram file"""
+    with open(path, encoding='utf-8') as f:
+        return compile_grammar(f.read())
+
+
+def load_dialogos_grammars(path: str) -> dict:
+    """
+    compile the grammars of a dialogos project (e.g. ex6/tierfutterstand_evolved.xml)
+
+    :return: dict grammar name -> Grammar
+    """
+    grammars = {}
+    for element in ElementTree.parse(path).getroot().iter('grammar'):
+        name, value = element.findtext('name'), element.findtext('value')
+        if name and value:
+            try:
+                grammars[name] = compile_grammar(value)
+            except GrammarError as e:
+                raise GrammarError(f'grammar {name}: {e}') from e
+    return grammars
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='parse texts with a grammar (a .gram file or a grammar of a dialogos project)')
+    parser.add_argument('grammar', help='.gram file or dialogos project (.xml)')
+    parser.add_argument('--name', help='name of the grammar in the dialogos project')
+    parser.add_argument('texts', nargs='*', help='texts to parse (otherwise read line by line from stdin)')
+    args = parser.parse_intermixed_args()
+
+    if args.grammar.endswith('.xml'):
+        grammars = load_dialogos_grammars(args.grammar)
+        if args.name not in grammars:
+            parser.error(f'choose one of the grammars with --name: {", ".join(grammars)}')
+        grammar = grammars[args.name]
+    else:
+        grammar = load_grammar(args.grammar)
+
+    def show(text):
+        print(f'{text!r} -> {grammar.parse(text)!r}')
+
+    if args.texts:
+        for text in args.texts:
+            show(text)
+    else:
+        import sys
+        for line in sys.stdin:
+            show(line.strip())
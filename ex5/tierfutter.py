@@ -2,17 +2,57 @@
 
 import os
 import subprocess
+from functools import lru_cache
+
+from grammar import load_grammar
+
+
+# grammar of everything that can be said at the pet food stand, compiled once
+grammar = load_grammar(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'grammars', 'gesamt.gram'))
+
+
+@lru_cache(maxsize=128)
+def synthesize(text, voice='de', rate=150):
+    """
+    synthesize text with espeak, repeated texts come from the cache
+
+    :raises subprocess.CalledProcessError: if espeak fails or gives no audio (nothing is cached then)
+    """
+
+    # text is passed on stdin, so it never goes through a shell
+    result = subprocess.run(['espeak', '-v', voice, '-s', str(rate), '--stdout', '--stdin'],
+                            input=text.encode('utf-8'), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # an exception is not cached by lru_cache, so the text is synthesized again next time
+    if result.returncode != 0 or not result.stdout:
+        raise subprocess.CalledProcessError(result.returncode, result.args, result.stdout, result.stderr)
+    return result.stdout
 
 
 def tts(text):
     """Text to speech function using espeak"""
 
-    command = f'espeak -v de -s 150 "{text}" --stdout | aplay'
-    
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    process.wait()
+    try:
+        audio = synthesize(text)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f'__tts error: {e}')
+        return
+    subprocess.run(['aplay', '-q'], input=audio, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
 
+def understand(text):
+    """
+    parse the asr text with the grammar (locally, no model or server)
 
+    :return: dict of the slots (tier, anzahl, zustimmung) or None if the text is not in the grammar
+    """
+    return grammar.parse(text)
 
 
+if __name__ == '__main__':
+    # type what the customer says
+    while True:
+        try:
+            text = input('>> ')
+        except EOFError:
+            break
+        print(f'__{understand(text)}')
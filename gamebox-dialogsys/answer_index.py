@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+"""
+index to validate the answers of the category games against the category's lexicon
+
+answers are normalized (case, articles, plurals, synonyms) and looked up exactly first,
+then with a bounded edit distance in a trie (to catch ASR misspellings like "tucan").
+"""
+
+import json
+import os
+import re
+import threading
+
+from vocabulary import game_data_dir, get_vocabulary, initial_letter, normalize_entry
+
+
+synonyms_dir = os.path.join(game_data_dir, 'synonyms')
+
+# words that are dropped at the beginning of an answer
+leading_articles = ('a', 'an', 'the', 'some')
+
+# words ending like this are not plurals (e.g. "octopus", "grass", "hummus", "ibis")
+non_plural_endings = ('ss', 'us', 'is')
+
+
+def singular_forms(word: str) -> list:
+    """
+    the possible singulars of a word, the most likely first (simple english rules, good enough
+    to match game answers, e.g. "peaches" is "peach", but "quiches" might be "quiche")
+    """
+    if len(word) <= 3 or word.endswith(non_plural_endings):
+        return [word]
+    if word.endswith('ies'):
+        # "berries", "cookies"
+        return [word[:-3] + 'y', word[:-1]]
+    if word.endswith('oes'):
+        # "tomatoes", "shoes"
+        return [word[:-2], word[:-1]]
+    if word.endswith(('sses', 'xes', 'zzes', 'ches', 'shes')):
+        # "glasses", "boxes", "peaches", "quiches"
+        return [word[:-2], word[:-1]]
+    if word.endswith(('ses', 'zes')):
+        # "horses", "cheeses", "breezes", "buses"
+        return [word[:-1], word[:-2]]
+    if word.endswith('s'):
+        return [word[:-1]]
+    return [word]
+
+
+def singularize(word: str) -> str:
+    """
+    the most likely singular of a word
+
+    >>> singularize('horses'), singularize('horse')
+    ('horse', 'horse')
+    >>> singularize('cheeses'), singularize('cheese')
+    ('cheese', 'cheese')
+    >>> singularize('tortoises'), singularize('glasses'), singularize('peaches'), singularize('berries')
+    ('tortoise', 'glass', 'peach', 'berry')
+    """
+    return singular_forms(word)[0]
+
+
+def answer_key(text: str) -> str:
+    """
+    normalize an answer, answers with the same key count as the same answer
+
+    e.g. "The Blueberries!" and "blueberry" have the same key
+    """
+    words = re.findall(r"[\w'-]+", normalize_entry(text))
+    while len(words) > 1 and words[0] in leading_articles:
+        words = words[1:]
+    if not words:
+        return ''
+    # only the last word carries the plural ("ice creams", "killer whales")
+    words[-1] = singularize(words[-1])
+    return ' '.join(words)
+
+
+def answer_keys(text: str) -> list:
+    """
+    the key of an answer and the keys of its other possible singulars (see singular_forms)
+
+    >>> answer_keys('The Quiches')
+    ['quich', 'quiche']
+    """
+    key = answer_key(text)
+    if not key:
+        return []
+    *words, last = key.split(' ')
+    original = re.findall(r"[\w'-]+", normalize_entry(text))[-1]
+    return [key] + [' '.join(words + [form]) for form in singular_forms(original)[1:]]
+
+
+def max_distance_for(key: str) -> int:
+    """number of typos tolerated, short words need to match exactly (e.g. "bat" vs "cat")"""
+    if len(key) < 5:
+        return 0
+    if len(key) < 11:
+        return 1
+    return 2
+
+
+class _TrieNode:
+    __slots__ = ('children', 'entry')
+
+    def __init__(self):
+        self.children = {}
+        # the canonical entry if a key ends here
+        self.entry = None
+
+
+class AnswerIndex:
+    """normalized exact and bounded edit distance lookup of answers in a lexicon"""
+
+    def __init__(self, entries=(), synonyms=None, vocabulary=None):
+        """
+        :param entries: the lexicon
+        :param synonyms: dict alias -> entry of the lexicon
+        :param vocabulary: a Vocabulary whose entries are added a letter at a time, when an answer
+            with that letter is looked up for the first time (so a memory-mapped vocabulary only
+            decodes the letters that are played)
+        """
+        self._exact = {}
+        # keys that are only there as synonyms (an entry of the lexicon replaces them)
+        self._alias_keys = set()
+        self._root = _TrieNode()
+        self._vocabulary = vocabulary
+        # letters of the vocabulary that have been added
+        self._added_letters = set()
+        self._lock = threading.Lock()
+
+        for entry in entries:
+            self._add(answer_key(entry), normalize_entry(entry))
+        for alias, entry in (synonyms or {}).items():
+            self._add(answer_key(alias), normalize_entry(entry), alias=True)
+
+    def _add(self, key: str, entry: str, alias=False):
+        """
+        :param alias: the key is a synonym, it does not replace anything (the entries of the
+            lexicon replace a synonym, they may be added after the synonyms)
+        """
+        if not key or (key in self._exact and (alias or key not in self._alias_keys)):
+            return
+        self._exact[key] = entry
+        if alias:
+            self._alias_keys.add(key)
+        else:
+            self._alias_keys.discard(key)
+
+        node = self._root
+        for char in key:
+            node = node.children.setdefault(char, _TrieNode())
+        node.entry = entry
+
+    def _add_letter(self, letter):
+        """add the entries of the vocabulary starting with the letter (once)"""
+        if self._vocabulary is None or letter is None or letter in self._added_letters:
+            return
+        with self._lock:
+            if letter not in self._added_letters:
+                for entry in self._vocabulary.words(letter):
+                    self._add(answer_key(entry), entry)
+                self._added_letters.add(letter)
+
+    def __len__(self):
+        """number of keys (of the letters added so far)"""
+        return len(self._exact)
+
+    def lookup(self, text: str, max_distance=None):
+        """
+        find the lexicon entry the answer means
+
+        :param max_distance: maximum edit distance (by default depending on the length of the answer)
+        :return: (entry, distance), entry is None if nothing matches
+        """
+        keys = answer_keys(text)
+        if not keys:
+            return None, 0
+        # (the keys of the entries start with their letter, unless an article is dropped, e.g. "the ...")
+        self._add_letter(initial_letter(keys[0]))
+        # the most likely singular first, then the others (e.g. "quiche" for "quiches")
+        for key in keys:
+            entry = self._exact.get(key)
+            if entry is not None:
+                return entry, 0
+        key = keys[0]
+
+        if max_distance is None:
+            max_distance = max_distance_for(key)
+        if max_distance <= 0:
+            return None, 0
+
+        # the first letter has to be right anyway (it is the letter of the game),
+        # so only the subtree of the first letter is searched
+        node = self._root.children.get(key[0])
+        if node is None:
+            return None, 0
+
+        # most misspellings are one edit away and searching with a small distance is much
+        # cheaper, so the distance is increased step by step
+        for distance in range(1, max_distance + 1):
+            entry = self._search(node, key, distance)
+            if entry is not None:
+                return entry, distance
+
+        return None, 0
+
+    def _search(self, start: _TrieNode, key: str, max_distance: int):
+        """find an entry within max_distance edits of the key below start (which matches key[0])"""
+        n = len(key)
+        too_far = max_distance + 1
+        # walk the trie and keep one row of the levenshtein matrix per node, only the band
+        # of cells within max_distance of the diagonal is computed (the rest is too far).
+        # branches where the whole band is too far are cut off
+        first_row = [min(i, too_far) for i in range(n + 1)]
+        stack = [(start, key[0], 1, first_row)]
+        while stack:
+            node, char, depth, previous_row = stack.pop()
+            row = [too_far] * (n + 1)
+            row[0] = min(depth, too_far)
+            low, high = max(1, depth - max_distance), min(n, depth + max_distance)
+            band_min = row[0]
+            for i in range(low, high + 1):
+                cell = min(row[i - 1] + 1, previous_row[i] + 1, previous_row[i - 1] + (key[i - 1] != char))
+                if cell < too_far:
+                    row[i] = cell
+                    if cell < band_min:
+                        band_min = cell
+
+            if node.entry is not None and row[n] <= max_distance:
+                return node.entry
+            if band_min <= max_distance:
+                stack.extend((child, child_char, depth + 1, row) for child_char, child in node.children.items())
+
+        return None
+
+
+def load_synonyms(category: str) -> dict:
+    """synonyms of a category from game_data/synonyms/<category>.json (alias -> entry)"""
+    path = os.path.join(synonyms_dir, f'{category}.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def get_answer_index(category: str) -> AnswerIndex:
+    """the answer index of a category (built once per process)"""
+    index = _indexes.get(category)
+    if index is None:
+        with _lock:
+            index = _indexes.get(category)
+            if index is None:
+                # the entries of a letter are added when it is played
+                index = AnswerIndex(synonyms=load_synonyms(category), vocabulary=get_vocabulary(category))
+                _indexes[category] = index
+    return index
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+"""
+batched story generation for many word sequence games at once
+
+continuation requests of different sessions that arrive within a short time window are
+run as one padded batch (one forward pass per token for all of them) instead of one
+batch-size-1 generation each. every story keeps its own kv cache between turns, the caches
+are padded into one batch cache for the generation and cut out again afterwards.
+"""
+
+import queue
+import threading
+from concurrent.futures import Future
+from time import monotonic, perf_counter
+
+import torch
+
+from metrics import count, observe
+from story import StoryGenerator, cache_layers, make_cache
+
+
+def _batch_cache(pasts, past_lengths, max_past):
+    """left pad the kv caches of the rows to max_past positions and stack them"""
+    if max_past == 0:
+        return None
+
+    # shape of the tensors of one layer of one row: (1, heads, positions, head_dim)
+    reference = next(layers for layers in pasts if layers)
+    layers = []
+    for layer_idx, (ref_keys, _) in enumerate(reference):
+        keys, values = [], []
+        for row_layers, length in zip(pasts, past_lengths):
+            pad_shape = (1, ref_keys.shape[1], max_past - length, ref_keys.shape[3])
+            padding = ref_keys.new_zeros(pad_shape)
+            if row_layers:
+                row_keys, row_values = row_layers[layer_idx]
+                keys.append(torch.cat([padding, row_keys], dim=2))
+                values.append(torch.cat([padding, row_values], dim=2))
+            else:
+                keys.append(padding)
+                values.append(padding)
+        layers.append((torch.cat(keys), torch.cat(values)))
+
+    return make_cache(layers)
+
+
+def generate_batch(stories, n_limits):
+    """
+    continue several stories at once (greedy decoding, like StoryGenerator.generate_ids)
+
+    the rows are padded on the left (with the attention mask and position ids set accordingly),
+    each row stops at its own n_limit or end of text token. afterwards each story holds
+    its part of the kv cache, as if it had generated on its own.
+
+    :param stories: StoryGenerators sharing the same model (each at most once)
+    :param n_limits: maximum number of new tokens per story
+    :return: list with the generated token ids of each story
+    """
+    results = [[] for _ in stories]
+
+    # rows of the batch: stories that have something to continue from
+    rows, limits = [], []
+    for i, (story, n_limit) in enumerate(zip(stories, n_limits)):
+        n_limit = story.prepare(n_limit)
+        if n_limit > 0:
+            rows.append(i)
+            limits.append(n_limit)
+    if not rows:
+        return results
+
+    active = [stories[i] for i in rows]
+    model = active[0].model
+    eos_token_id = active[0].tokenizer.eos_token_id
+    batch_size = len(active)
+
+    pasts = [cache_layers(story.past) for story in active]
+    past_lengths = [len(story.token_ids) for story in active]
+    max_past = max(past_lengths)
+    max_new = max(len(story.pending_ids) for story in active)
+
+    # the first step feeds the pending tokens of every row (after the cached ones)
+    input_ids = torch.zeros((batch_size, max_new), dtype=torch.long)
+    position_ids = torch.zeros((batch_size, max_new), dtype=torch.long)
+    # which cache positions hold real tokens (grows by one column per step)
+    attention_mask = torch.zeros((batch_size, max_past + max_new), dtype=torch.long)
+    for row, story in enumerate(active):
+        length, n_pending = past_lengths[row], len(story.pending_ids)
+        input_ids[row, max_new - n_pending:] = torch.tensor(story.pending_ids)
+        position_ids[row, max_new - n_pending:] = torch.arange(length, length + n_pending)
+        attention_mask[row, max_past - length:max_past] = 1
+        attention_mask[row, max_past + max_new - n_pending:] = 1
+
+    # tokens fed to the model per row and the position of the next one
+    fed = [list(story.pending_ids) for story in active]
+    next_positions = [length + len(story.pending_ids) for length, story in zip(past_lengths, active)]
+    pending = [[] for _ in active]
+    done = [False] * batch_size
+
+    past = _batch_cache(pasts, past_lengths, max_past)
+    with torch.inference_mode():
+        for _ in range(max(limits)):
+            outputs = model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                            past_key_values=past, use_cache=True)
+            past = outputs.past_key_values
+            next_ids = torch.argmax(outputs.logits[:, -1], dim=-1).tolist()
+
+            # finished rows keep running along with a masked dummy token
+            input_ids = torch.zeros((batch_size, 1), dtype=torch.long)
+            position_ids = torch.zeros((batch_size, 1), dtype=torch.long)
+            step_mask = torch.zeros((batch_size, 1), dtype=torch.long)
+            for row in range(batch_size):
+                if done[row]:
+                    continue
+
+                next_id = next_ids[row]
+                if next_id == eos_token_id:
+                    # do not keep the end of text token in the story
+                    done[row] = True
+                    continue
+
+                results[rows[row]].append(next_id)
+                if len(results[rows[row]]) >= limits[row]:
+                    # the last token is fed with the next turn of this story
+                    pending[row] = [next_id]
+                    done[row] = True
+                    continue
+
+                input_ids[row, 0] = next_id
+                position_ids[row, 0] = next_positions[row]
+                step_mask[row, 0] = 1
+                fed[row].append(next_id)
+                next_positions[row] += 1
+
+            if all(done):
+                break
+            attention_mask = torch.cat([attention_mask, step_mask], dim=1)
+
+    # give every story its own part of the cache back (without the padding)
+    layers = cache_layers(past)
+    for row, story in enumerate(active):
+        positions = attention_mask[row].bool()
+        story.past = make_cache([(keys[row:row + 1, :, positions], values[row:row + 1, :, positions])
+                                 for keys, values in layers])
+        story.token_ids.extend(fed[row])
+        story.pending_ids = pending[row]
+
+    return results
+
+
+class _Request:
+    __slots__ = ('story', 'n_limit', 'future', 'submitted')
+
+    def __init__(self, story: StoryGenerator, n_limit: int):
+        self.story = story
+        self.n_limit = n_limit
+        self.future = Future()
+        self.submitted = monotonic()
+
+
+class BatchScheduler:
+    """
+    collects continuation requests of many stories and generates them in batches
+
+    a batch is started once max_batch_size requests are waiting or max_wait seconds
+    after its first request arrived, so a single request is delayed by at most max_wait
+    """
+
+    def __init__(self, max_batch_size=8, max_wait=0.02):
+        """
+        :param max_batch_size: maximum number of stories generated at once
+        :param max_wait: seconds to wait for more requests before starting a batch
+        """
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self._queue = queue.Queue()
+        # requests for a story that was already in the batch being collected
+        self._deferred = []
+        self._thread = None
+        self._lock = threading.Lock()
+
+        # statistics
+        self.batches = 0
+        self.requests = 0
+        self.tokens = 0
+        self.generation_time = 0.0
+        self.max_latency = 0.0
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='generation-batcher', daemon=True)
+                self._thread.start()
+
+    def submit(self, story: StoryGenerator, n_limit: int) -> Future:
+        """
+        request the continuation of a story
+
+        :param story: the story to continue (its text has to be added before)
+        :param n_limit: maximum number of new tokens
+        :return: future of the generated token ids
+        """
+        if self._thread is None:
+            self._start()
+
+        request = _Request(story, n_limit)
+        self._queue.put(request)
+        return request.future
+
+    def generate(self, story: StoryGenerator, n_limit: int) -> str:
+        """
+        continue a story (blocks until its batch is done), like StoryGenerator.generate
+
+        :return: the generated text (only the new part)
+        """
+        ids = self.submit(story, n_limit).result()
+        return story.tokenizer.decode(ids, skip_special_tokens=True)
+
+    def _collect(self):
+        """wait for the next batch of requests"""
+        batch, self._deferred = self._deferred[:self.max_batch_size], self._deferred[self.max_batch_size:]
+        if not batch:
+            batch.append(self._queue.get())
+
+        stories = {id(request.story) for request in batch}
+        deadline = batch[0].submitted + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - monotonic()
+            try:
+                request = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+            # a story can only be continued once per batch
+            if id(request.story) in stories:
+                self._deferred.append(request)
+            else:
+                stories.add(id(request.story))
+                batch.append(request)
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+
+            start = perf_counter()
+            try:
+                results = generate_batch([request.story for request in batch],
+                                         [request.n_limit for request in batch])
+            except Exception as e:
+                count('batch_error')
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+
+            generation_time = perf_counter() - start
+            self.generation_time += generation_time
+            self.batches += 1
+            self.requests += len(batch)
+            observe('batch_generation', generation_time)
+            count('batch_requests', len(batch))
+
+            now = monotonic()
+            for request, ids in zip(batch, results):
+                self.tokens += len(ids)
+                self.max_latency = max(self.max_latency, now - request.submitted)
+                observe('batch_request_latency', now - request.submitted)
+                request.future.set_result(ids)
+            count('generated_tokens', sum(len(ids) for ids in results))
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'requests': self.requests,
+            'mean_batch_size': self.requests / self.batches if self.batches else 0.0,
+            'tokens_per_s': self.tokens / self.generation_time if self.generation_time else 0.0,
+            'max_latency_s': self.max_latency,
+        }
+
+
+# the scheduler shared by the whole process (e.g. all sessions of the server)
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_batch_scheduler() -> BatchScheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = BatchScheduler()
+    return _scheduler
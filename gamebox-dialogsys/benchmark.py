@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+
+"""
+headless end-to-end benchmark of the dialog
+
+scripted dialogs are replayed through the same DialogManager main.py uses, with stand-ins
+for the audio parts: the asr returns the scripted text, the tts only collects what is said and
+rasa is replaced by a local http server answering from the annotations of the script.
+nlu (local classifier, cache, http client), game logic and story generation run for real.
+
+reported are the latency percentiles per turn (overall and per kind of turn), the throughput
+and the peak memory, e.g.
+
+    ./benchmark.py --sessions 4 --repeat 3 --json results.json
+"""
+
+import argparse
+import json
+import random
+import resource
+import threading
+import traceback
+import tracemalloc
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, sleep
+
+import utils
+from answer_index import answer_key
+from dialog import DialogManager
+from games import CategoryGame, WordSequenceGame
+from metrics import metrics, percentile
+from models import resident_memory_mb
+from vocabulary import get_vocabulary, store as vocabulary_store
+
+
+# placeholder in a scripted turn, replaced by a valid answer of the running category game
+answer_placeholder = '{answer}'
+
+# the scripted dialogs, each turn is what the user says with the intent (and entity) rasa should find,
+# an empty text is a turn the asr did not recognize
+default_dialogs = [
+    {
+        'name': 'animal game',
+        'turns': [
+            {'text': 'let\'s play the animal game', 'intent': 'choose_animal_game'},
+            {'text': answer_placeholder},
+            {'text': answer_placeholder},
+            {'text': 'what are the rules of the games, i didn\'t understand them', 'intent': 'explain_rules'},
+            {'text': answer_placeholder},
+            {'text': ''},
+            {'text': 'give me some time', 'intent': 'wait'},
+            {'text': answer_placeholder},
+            {'text': 'xylophone', 'intent': 'game_answer', 'entity': 'xylophone'},
+            {'text': answer_placeholder},
+            {'text': 'I don\'t want to play anymore', 'intent': 'end_game'},
+            {'text': 'yes', 'intent': 'game_answer'},
+            {'text': 'I have had enough', 'intent': 'end_game'},
+        ],
+    },
+    {
+        'name': 'food game',
+        'turns': [
+            {'text': 'can you explain the games please', 'intent': 'explain_rules'},
+            {'text': 'let\'s play the food game', 'intent': 'choose_food_game'},
+            {'text': answer_placeholder},
+            {'text': answer_placeholder},
+            {'text': answer_placeholder},
+            {'text': answer_placeholder},
+            {'text': 'let\'s end this game', 'intent': 'end_game'},
+            {'text': 'no', 'intent': 'game_answer'},
+            {'text': answer_placeholder},
+            {'text': 'let\'s stop playing', 'intent': 'end_game'},
+            {'text': 'sure', 'intent': 'game_answer'},
+            {'text': 'I give up', 'intent': 'end_game'},
+        ],
+    },
+    {
+        'name': 'story game',
+        'turns': [
+            {'text': 'let\'s play the word sequence game', 'intent': 'choose_word_sequence_game'},
+            {'text': 'once upon a time there was a little fox', 'intent': 'game_answer'},
+            {'text': 'who lived in a dark forest', 'intent': 'game_answer'},
+            {'text': 'one day the fox met an old bear', 'intent': 'game_answer'},
+            {'text': 'and the bear said', 'intent': 'game_answer'},
+            {'text': 'that he had lost his way home a long time ago', 'intent': 'game_answer'},
+            {'text': 'so they walked together', 'intent': 'game_answer'},
+            {'text': 'through the trees and over the hills until the sun went down', 'intent': 'game_answer'},
+            {'text': 'in the night', 'intent': 'game_answer'},
+            {'text': 'they saw a light in the distance', 'intent': 'game_answer'},
+            {'text': 'it was a small house with a red door', 'intent': 'game_answer'},
+            {'text': 'the fox knocked', 'intent': 'game_answer'},
+            {'text': 'and an old woman opened the door and smiled at them', 'intent': 'game_answer'},
+            {'text': 'I think I\'ve had enough', 'intent': 'end_game'},
+            {'text': 'yeah', 'intent': 'game_answer'},
+            {'text': 'I have had enough', 'intent': 'end_game'},
+        ],
+    },
+]
+
+
+class _BenchmarkHTTPServer(ThreadingHTTPServer):
+    # many concurrent clients connect at once (the default backlog of 5 drops connections, which are retried after 1s)
+    request_queue_size = 128
+
+
+class FakeRasaServer:
+    """
+    stand-in for rasa's http api (/model/parse and /status)
+
+    texts of the script are answered with their annotated intent and entity,
+    unknown texts as game answers (like the user's words in the story game)
+    """
+
+    def __init__(self, dialogs, latency=0.0, default_intent='game_answer'):
+        """
+        :param dialogs: the scripted dialogs (their annotations are the answers)
+        :param latency: seconds each parse takes (to simulate the real server)
+        :param default_intent: intent of texts that are not annotated
+        """
+        self.latency = latency
+        self.default_intent = default_intent
+        self.annotations = {}
+        for dialog in dialogs:
+            for turn in dialog['turns']:
+                if turn.get('text') and turn.get('intent') and turn['text'] != answer_placeholder:
+                    self.annotations[turn['text'].lower()] = (turn['intent'], turn.get('entity'))
+
+        self.requests = 0
+        self._server = None
+
+    def parse(self, text: str) -> dict:
+        """the json rasa would answer for the text"""
+        intent, entity = self.annotations.get(text.lower(), (self.default_intent, None))
+        entities = [{'entity': 'answer', 'value': entity}] if entity else []
+        return {
+            'text': text,
+            'intent': {'name': intent, 'confidence': 0.95},
+            'entities': entities,
+            'intent_ranking': [{'name': intent, 'confidence': 0.95}],
+        }
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send(self, data: dict):
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == '/status':
+                    self._send({'fingerprint': {'benchmark': 1}, 'model_file': 'benchmark'})
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                if self.path != '/model/parse':
+                    self.send_error(404)
+                    return
+                length = int(self.headers.get('Content-Length', 0))
+                text = json.loads(self.rfile.read(length)).get('text', '')
+                fake.requests += 1
+                if fake.latency:
+                    sleep(fake.latency)
+                self._send(fake.parse(text))
+
+            def log_message(self, format, *args):
+                # no log line per request
+                pass
+
+        return Handler
+
+    def start(self) -> str:
+        """
+        serve on a free local port in the background
+
+        :return: the url of the server
+        """
+        self._server = _BenchmarkHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='fake-rasa', daemon=True).start()
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+class ScriptedUser:
+    """
+    plays one scripted dialog: stand-in asr (the scripted texts) and tts (collects what is said)
+
+    the answers of the category games are chosen from the vocabulary, so they start with the
+    letter of the game and have not been named yet
+    """
+
+    def __init__(self, dialog: dict, rng: random.Random, tts_chars_per_second=0.0, asr_latency=0.0):
+        """
+        :param dialog: the scripted dialog
+        :param rng: random numbers for the answers
+        :param tts_chars_per_second: simulated speaking time of the tts (0: no time)
+        :param asr_latency: simulated seconds the asr takes per turn (not part of the turn latency)
+        """
+        self.dialog = dialog
+        self.rng = rng
+        self.tts_chars_per_second = tts_chars_per_second
+        self.asr_latency = asr_latency
+
+        self.said = []
+        # seconds the user waited for the dialog's timers (e.g. the thinking time)
+        self.waited = 0.0
+
+    def say(self, text: str):
+        if not text:
+            return
+        self.said.append(text)
+        if self.tts_chars_per_second:
+            sleep(len(text) / self.tts_chars_per_second)
+
+    def answer(self, game) -> str:
+        """a valid, unused answer for the running category game"""
+        if not isinstance(game, CategoryGame):
+            return 'banana'
+        words = [word for word in get_vocabulary(game.category).words(game.letter)
+                 if answer_key(word) not in game.used_items]
+        return self.rng.choice(words) if words else 'nothing'
+
+    def listen(self, turn: dict, game) -> str:
+        """stand-in asr"""
+        if self.asr_latency:
+            sleep(self.asr_latency)
+        text = turn.get('text', '')
+        if text == answer_placeholder:
+            text = self.answer(game)
+        return text
+
+
+def turn_kind(dialog: DialogManager, text: str) -> str:
+    """what a turn mostly spends its time on"""
+    if not text:
+        return 'asr_failure'
+    if isinstance(dialog.current_game, WordSequenceGame):
+        return 'story'
+    if isinstance(dialog.current_game, CategoryGame):
+        return 'category'
+    return 'choice'
+
+
+def run_dialog(script: dict, rng: random.Random, record, streaming=True, **user_options):
+    """
+    replay one scripted dialog (like main() does with asr and tts)
+
+    :param record: called with (dialog name, kind of turn, seconds) for every turn
+    :param streaming: speak the story phrase by phrase while generating
+    :return: the scripted user (with everything the bot said)
+    """
+    user = ScriptedUser(script, rng, **user_options)
+    dialog = DialogManager(say=user.say, parse=utils.rasa_parse, story_options={'streaming': streaming})
+    dialog.start()
+
+    for turn in script['turns']:
+        if dialog.done:
+            break
+        text = user.listen(turn, dialog.current_game)
+        kind = turn_kind(dialog, text)
+
+        start = perf_counter()
+        if not text:
+            dialog.handle_no_input()
+        else:
+            dialog.handle(text)
+        record(script['name'], kind, perf_counter() - start)
+
+        # the scripted user stays silent until the pending timer fires
+        # (the benchmark does not wait, it only counts the time)
+        remaining = dialog.timer_remaining()
+        if remaining is not None:
+            user.waited += remaining
+            dialog.fire_timer(force=True)
+
+    return user
+
+
+def run_benchmark(dialogs, sessions=1, repeat=1, seed=0, rasa_latency=0.0, streaming=True, trace_memory=False,
+                  **user_options) -> dict:
+    """
+    run every dialog repeat times on each of the sessions (threads running at the same time)
+
+    :return: the report
+    """
+    fake_rasa = FakeRasaServer(dialogs, latency=rasa_latency)
+    utils.set_print_mode(True)
+    utils.set_rasa_url(fake_rasa.start())
+
+    # load everything that is loaded once per process before measuring
+    # (so the first turns do not include loading the models)
+    setup_start = perf_counter()
+    vocabulary_store.preload()
+    utils.get_nlu_client()
+    if any(turn.get('intent') == 'choose_word_sequence_game' for dialog in dialogs for turn in dialog['turns']):
+        from models import get_gpt2
+        get_gpt2()
+    setup_time = perf_counter() - setup_start
+
+    latencies = defaultdict(list)
+    lock = threading.Lock()
+
+    def record(name, kind, seconds):
+        with lock:
+            latencies['all'].append(seconds)
+            latencies[f'kind:{kind}'].append(seconds)
+            latencies[f'dialog:{name}'].append(seconds)
+
+    errors = []
+
+    def session(index):
+        rng = random.Random(seed + index)
+        for _ in range(repeat):
+            for script in dialogs:
+                # the letters of the category games are drawn from the global random generator
+                try:
+                    run_dialog(script, rng, record, streaming=streaming, **user_options)
+                except Exception as e:
+                    # a broken dialog must show up in the report, not only end its thread
+                    traceback.print_exc()
+                    with lock:
+                        errors.append(f'{script["name"]}: {e!r}')
+
+    random.seed(seed)
+    if trace_memory:
+        tracemalloc.start()
+
+    start = perf_counter()
+    threads = [threading.Thread(target=session, args=(i,), name=f'session-{i}') for i in range(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = perf_counter() - start
+
+    report = {
+        'sessions': sessions,
+        'dialogs': sessions * repeat * len(dialogs),
+        'turns': len(latencies['all']),
+        'errors': errors,
+        'setup_s': setup_time,
+        'wall_s': wall_time,
+        'turns_per_s': len(latencies['all']) / wall_time if wall_time else 0.0,
+        'latency_ms': {
+            name: {
+                'n': len(values),
+                'mean': 1000 * sum(values) / len(values),
+                'p50': 1000 * percentile(values, 50),
+                'p90': 1000 * percentile(values, 90),
+                'p95': 1000 * percentile(values, 95),
+                'p99': 1000 * percentile(values, 99),
+                'max': 1000 * max(values),
+            }
+            for name, values in sorted(latencies.items())
+        },
+        'memory_mb': {
+            # ru_maxrss is in KB on linux
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'rss_now': resident_memory_mb(),
+        },
+        'nlu': dict(utils.get_nlu_client().stats(), fake_rasa_requests=fake_rasa.requests),
+        # time per stage of the pipeline and the counters of the instrumentation
+        'metrics': metrics.snapshot(),
+    }
+    if trace_memory:
+        report['memory_mb']['python_heap_peak'] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        tracemalloc.stop()
+
+    fake_rasa.stop()
+    return report
+
+
+def print_report(report: dict):
+    print(f'{report["dialogs"]} dialogs, {report["turns"]} turns on {report["sessions"]} sessions '
+          f'in {report["wall_s"]:.2f}s ({report["turns_per_s"]:.1f} turns/s, setup {report["setup_s"]:.2f}s)')
+    print(f'{"latency (ms)":<24}{"n":>6}{"mean":>9}{"p50":>9}{"p90":>9}{"p95":>9}{"p99":>9}{"max":>9}')
+    for name, stats in report['latency_ms'].items():
+        print(f'{name:<24}{stats["n"]:>6}' + ''.join(f'{stats[key]:>9.1f}' for key in ('mean', 'p50', 'p90', 'p95', 'p99', 'max')))
+    for name, stats in sorted(report['metrics']['histograms'].items()):
+        print(f'{"stage:" + name:<24}{stats["count"]:>6}' + ''.join(f'{1000 * stats[key]:>9.1f}' for key in ('mean', 'p50', 'p90', 'p95', 'p99', 'max')))
+    print(f'counters: {report["metrics"]["counters"]}')
+    print('memory (MB): ' + ', '.join(f'{name} {value:.0f}' for name, value in report['memory_mb'].items()))
+    print(f'nlu: {report["nlu"]}')
+    for error in report['errors']:
+        print(f'error: {error}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='replay scripted dialogs without audio and report latency, throughput and memory')
+    parser.add_argument('--dialogs', help='json file with scripted dialogs (default: the built-in ones)')
+    parser.add_argument('--only', nargs='*', help='names of the dialogs to run (e.g. "animal game")')
+    parser.add_argument('--sessions', type=int, default=1, help='dialogs running at the same time')
+    parser.add_argument('--repeat', type=int, default=1, help='times each session replays the dialogs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rasa-latency', type=float, default=0.0, help='simulated seconds per rasa parse')
+    parser.add_argument('--asr-latency', type=float, default=0.0, help='simulated seconds of asr per turn')
+    parser.add_argument('--tts-cps', type=float, default=0.0, help='simulated tts speed in characters per second')
+    parser.add_argument('--no-streaming', action='store_true', help='generate the story continuation at once')
+    parser.add_argument('--tracemalloc', action='store_true', help='also trace the peak python heap (slower)')
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args()
+
+    dialogs = default_dialogs
+    if args.dialogs:
+        with open(args.dialogs, 'r', encoding='utf-8') as f:
+            dialogs = json.load(f)
+    if args.only:
+        dialogs = [dialog for dialog in dialogs if dialog['name'] in args.only]
+
+    report = run_benchmark(dialogs, sessions=args.sessions, repeat=args.repeat, seed=args.seed,
+                           rasa_latency=args.rasa_latency, streaming=not args.no_streaming,
+                           trace_memory=args.tracemalloc, tts_chars_per_second=args.tts_cps,
+                           asr_latency=args.asr_latency)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
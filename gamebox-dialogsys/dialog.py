@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+"""
+dialog management of the gamebox bot
+
+the state of one dialog (current game, pending confirmation) is kept in a DialogManager,
+input and output are passed in, so the same logic runs in the voice loop of main.py and
+for many sessions at once in server.py
+"""
+
+import random
+from time import monotonic
+
+from metrics import span
+from games import CategoryGame, WordSequenceGame, all_games_instructions, category_game_intents, prepare_nothing
+
+
+greeting = 'Hello! I am the gamebox bot. I can play three games with you: the animal, food or word sequence game. Which game would you like to play?'
+
+# phrases the dialog manager says over and over again
+dialog_phrases = [
+    greeting,
+    'I\'m sorry, I didn\'t understand that. Please try again. (asr)',
+    'I\'m sorry, I didn\'t understand that. Please try again. (nlu_fallback))',
+    'Okay. I will sleep a while and let you think.',
+    'I will give you some time to think.',
+    'I will wait a little.',
+    'And tell you when I\'m back.',
+    'I\'m back. Have you thought of something?',
+    'Great! Let\'s go on.',
+    'Okay! Goodbye!',
+    'Sorry, I didn\'t understand that. Please say again which game you want to play.',
+    'Do you really want to stop the game?',
+    'Okay let\'s play another game. Which game would you like to play? We can play the animal, food or word sequence game.',
+    'Okay. I will continue the game.',
+]
+
+affirmations = ['yes', 'yeah', 'yep', 'yup', 'sure', 'ok', 'okay']
+
+# said by the user to end the thinking time early
+ready_phrases = ['ready', 'i\'m back', 'i am back', 'let\'s go', 'go on', 'continue', 'got one', 'got something']
+
+# seconds the bot waits when the user asks for time to think
+thinking_time = 20
+# seconds without speech after a failed recognition before the bot asks to repeat
+repeat_request_delay = 5
+
+
+def is_affirmation(user_input) -> bool:
+    """check if the user's input confirms (e.g. 'yes' or 'sure')"""
+    if not user_input:
+        return False
+
+    user_input = user_input.lower().strip()
+
+    # if one of the affirmations is contained in user_input, return True
+    return any(affirmation in user_input for affirmation in affirmations)
+
+
+def is_ready(user_input) -> bool:
+    """check if the user says the thinking time can end (e.g. 'I'm ready')"""
+    user_input = user_input.lower().strip()
+    return any(phrase in user_input for phrase in ready_phrases)
+
+
+class Timer:
+    """
+    something the dialog does after a delay (e.g. asking the user to repeat)
+
+    the dialog does not sleep, whoever runs it (the voice loop, the server) fires the timer
+    when it is due, unless the user speaks before
+    """
+
+    def __init__(self, seconds: float, callback, fire_on_input=False):
+        """
+        :param seconds: delay
+        :param callback: called (without arguments) when the timer fires
+        :param fire_on_input: if the user speaks before, fire right away (instead of dropping the timer)
+        """
+        self.seconds = seconds
+        self.deadline = monotonic() + seconds
+        self.callback = callback
+        self.fire_on_input = fire_on_input
+
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - monotonic())
+
+
+class DialogManager:
+    """the dialog with one user"""
+
+    def __init__(self, say, parse, debug=False, story_options=None, prepare=prepare_nothing):
+        """
+        :param say: called with each text the bot says
+        :param parse: called with the user's input, returns (intent, entity)
+        :param debug: print the intent and entity of each input
+        :param story_options: keyword arguments for the WordSequenceGame
+        :param prepare: called with a text the bot will probably say soon (e.g. to synthesize it ahead)
+        """
+        self.say = say
+        self.parse = parse
+        self.prepare = prepare
+        self.debug = debug
+        self.story_options = story_options if story_options is not None else {}
+
+        # the currently running game
+        self.current_game = None
+        # True while waiting for the user to confirm stopping the game
+        self.confirming_end = False
+        # True once the dialog is over
+        self.done = False
+        # the pending delayed action (at most one)
+        self.timer = None
+        # True while the user has time to think
+        self.waiting = False
+
+        # intent to choose a category game -> category
+        self.category_games = category_game_intents()
+
+    def start(self):
+        """give entry message"""
+        self.say(greeting)
+
+    def _game_options(self) -> dict:
+        # the games speak and wait through the same output and timers as the dialog
+        return {'say': self.say, 'schedule': self.schedule, 'prepare': self.prepare}
+
+    def expected_input(self) -> str:
+        """
+        what kind of input the user is expected to say next
+        (the asr ends the recording after a shorter pause for a single word or a yes,
+        see speech_input.endpointing_presets)
+        """
+        if self.confirming_end:
+            return 'confirmation'
+        if self.current_game is None or self.waiting:
+            # choosing a game, or 'i'm ready' after thinking (which might as well be the answer)
+            return 'default'
+        return self.current_game.expected_input
+
+    def schedule(self, seconds: float, callback, fire_on_input=False):
+        """
+        do something after a delay (replaces the pending timer)
+
+        :param callback: called without arguments
+        :param fire_on_input: if the user speaks before, do it right away instead of not at all
+        """
+        self._resolve_timer()
+        self.timer = Timer(seconds, callback, fire_on_input)
+
+    def timer_remaining(self):
+        """seconds until the pending timer is due, None if there is none"""
+        return self.timer.remaining() if self.timer is not None else None
+
+    def fire_timer(self, force=False) -> bool:
+        """
+        fire the pending timer if it is due
+
+        :param force: fire it even if it is not due yet
+        :return: True if a timer fired
+        """
+        timer = self.timer
+        if timer is None or (not force and timer.remaining() > 0):
+            return False
+        self.timer = None
+        timer.callback()
+        return True
+
+    def _resolve_timer(self):
+        """the user spoke (or a new timer is set): fire or drop the pending timer"""
+        timer, self.timer = self.timer, None
+        if timer is not None and timer.fire_on_input:
+            timer.callback()
+
+    def _end_thinking_time(self):
+        self.waiting = False
+        self.say('I\'m back. Have you thought of something?')
+
+    def handle_no_input(self):
+        """the asr did not recognize anything"""
+        if self.waiting:
+            # noise during the thinking time does not end it, only an input of the user does
+            return
+        self._resolve_timer()
+        self.waiting = False
+        # wait some time before asking the user to repeat, to avoid asking too often
+        # (if the user speaks again before, there is no need to ask)
+        self.schedule(repeat_request_delay,
+                      lambda: self.say('I\'m sorry, I didn\'t understand that. Please try again. (asr)'))
+
+    def handle(self, user_input: str):
+        """
+        handle one input of the user
+
+        :param user_input: what the user said
+        :return: True if the dialog is over
+        """
+        if self.done:
+            return True
+
+        # the user spoke, so pending timers are not waited for anymore
+        self._resolve_timer()
+        if self.waiting:
+            # the user is done thinking before the time is over
+            self.waiting = False
+            if is_ready(user_input):
+                self.say('Great! Let\'s go on.')
+                return False
+
+        # the last question was whether to stop the game
+        if self.confirming_end:
+            self.confirming_end = False
+            if is_affirmation(user_input):
+                self.current_game.stop()
+                self.current_game = None
+                self.say('Okay let\'s play another game. Which game would you like to play? We can play the animal, food or word sequence game.')
+            else:
+                self.say('Okay. I will continue the game.')
+            return False
+
+        # parse what he/she said to get the intent and entity
+        intent, entity = self.parse(user_input)
+
+        # if is in debug mode print the intent and entity
+        if self.debug:
+            print(f'__{intent}, {entity}')
+
+        # if the intent is None, there was no input to parse
+        # (if the server can not be reached, the intent is nlu_fallback)
+        if not intent:
+            self.done = True
+            return True
+
+        # if entity is None, we can assume that the user's input is the entity
+        # (or at least treat it as such for the games)
+        if entity is None:
+            entity = user_input.lower().strip()
+
+        # if intent is NLU_FALLBACK, the user's input could not be parsed
+        # and we should ask the user to repeat
+        if intent == 'nlu_fallback':
+            self.say('I\'m sorry, I didn\'t understand that. Please try again. (nlu_fallback))')
+            return False
+        # if the intent is wait, the bot waits a little for the user to think
+        # only if not in the word sequence game
+        elif intent == 'wait' and not isinstance(self.current_game, WordSequenceGame):
+            # don't always say the same thing here
+            self.say(random.choice(['Okay. I will sleep a while and let you think.', 'I will give you some time to think.', 'I will wait a little.']))
+            self.say('And tell you when I\'m back.')
+            # the thinking time ends early when the user speaks (e.g. "I'm ready")
+            self.waiting = True
+            self.schedule(thinking_time, self._end_thinking_time)
+            return False
+
+        if self.current_game is None:
+            # if we are not currently running a game, we can start a new one
+            # (there is a category game, e.g. the animal game, for every file in game_data)
+            if intent in self.category_games:
+                self.current_game = CategoryGame(self.category_games[intent], **self._game_options())
+            elif intent == 'choose_word_sequence_game':
+                self.current_game = WordSequenceGame(**self.story_options, **self._game_options())
+            elif intent == 'explain_rules':
+                self.say(all_games_instructions)
+            elif intent == 'end_game':
+                self.say('Okay! Goodbye!')
+                self.done = True
+            else:
+                self.say('Sorry, I didn\'t understand that. Please say again which game you want to play.')
+        else:
+            # is in a game
+            # check if the intent is to stop the game or get the instructions
+            if intent == 'end_game':
+                # the answer is handled with the next input
+                self.confirming_end = True
+                self.say('Do you really want to stop the game?')
+            elif intent == 'explain_rules':
+                self.say(self.current_game.instructions)
+            else:
+                # if the intent is not to stop the game or get the instructions,
+                # we can assume that the user wants to play the game
+                # if game.next_input is true, it is game over
+                with span('game'):
+                    game_over = self.current_game.next_input(user_input, intent, entity)
+                if game_over:
+                    self.current_game.stop()
+                    self.done = True
+
+        return self.done
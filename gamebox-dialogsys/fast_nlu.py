@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+"""
+lightweight in-process intent classifier trained from data/nlu.yml
+
+uses the same kind of features as the rasa pipeline (word and char_wb 1-4 gram counts,
+tf-idf weighted) and a linear (softmax regression) model on top of them.
+only confidently classified utterances are answered locally, the others go to rasa.
+"""
+
+import hashlib
+import json
+import math
+import os
+import random
+import re
+from collections import Counter, defaultdict
+
+
+from metrics import count, span
+from nlu import NLUResult, fallback_intent
+
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+default_training_data = os.path.join(base_dir, 'data', 'nlu.yml')
+default_artifact = os.path.join(base_dir, 'models', 'fast_nlu.json')
+
+# entity annotation in the training data, e.g. [lion](answer)
+entity_pattern = re.compile(r'\[([^\]]+)\]\(([^)]+)\)')
+
+
+def load_training_data(path=default_training_data):
+    """
+    read the examples from a rasa nlu.yml
+
+    :return: list of (text, intent, entities), entities is a list of (value, entity name)
+    """
+    with open(path, 'r') as f:
+        # import here, it is only needed when the classifier is (re)trained
+        import yaml
+        data = yaml.safe_load(f)
+
+    examples = []
+    for item in data.get('nlu', []):
+        if 'intent' not in item:
+            continue
+        for line in item.get('examples', '').splitlines():
+            line = line.strip()
+            if not line.startswith('- '):
+                continue
+            annotated = line[2:].strip()
+            entities = [(value, name) for value, name in entity_pattern.findall(annotated)]
+            text = entity_pattern.sub(lambda match: match.group(1), annotated)
+            examples.append((text, item['intent'], entities))
+
+    return examples
+
+
+def tokenize(text: str):
+    """lower case words without punctuation"""
+    return re.findall(r"[\w'-]+", text.lower())
+
+
+def featurize(text: str, min_ngram=1, max_ngram=4) -> Counter:
+    """count word unigrams and char n-grams within word boundaries (like char_wb)"""
+    features = Counter()
+    for word in tokenize(text):
+        features['w:' + word] += 1
+        padded = f' {word} '
+        for n in range(min_ngram, max_ngram + 1):
+            for i in range(len(padded) - n + 1):
+                features['c:' + padded[i:i + n]] += 1
+    return features
+
+
+def _normalize(vector: dict) -> dict:
+    norm = math.sqrt(sum(value * value for value in vector.values()))
+    if norm == 0:
+        return vector
+    return {key: value / norm for key, value in vector.items()}
+
+
+def _file_hash(path) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _softmax(scores: dict):
+    """turn scores into probabilities, sorted with the most probable first"""
+    highest = max(scores.values())
+    exps = {key: math.exp(score - highest) for key, score in scores.items()}
+    total = sum(exps.values())
+    return sorted(((key, value / total) for key, value in exps.items()), key=lambda item: -item[1])
+
+
+class LocalIntentClassifier:
+    """linear intent classifier (softmax regression) on tf-idf weighted word and char n-gram features"""
+
+    def __init__(self, idf=None, weights=None, bias=None, answer_templates=None, training_hash=None):
+        # inverse document frequency per feature
+        self.idf = idf if idf is not None else {}
+        # intent -> {feature: weight}
+        self.weights = weights if weights is not None else {}
+        # intent -> bias
+        self.bias = bias if bias is not None else {}
+        # (prefix, suffix) word sequences around the answer entity in the training examples
+        self.answer_templates = answer_templates if answer_templates is not None else []
+        # hash of the training data the classifier was trained on
+        self.training_hash = training_hash
+
+    def train(self, examples, epochs=20, learning_rate=0.5, seed=0):
+        """
+        train on examples as returned by load_training_data (stochastic gradient descent)
+
+        :return: self
+        """
+        counts = [featurize(text) for text, _, _ in examples]
+
+        # inverse document frequency (smoothed like sklearn)
+        document_frequency = Counter()
+        for features in counts:
+            document_frequency.update(features.keys())
+        n_documents = len(counts)
+        self.idf = {feature: math.log((1 + n_documents) / (1 + df)) + 1 for feature, df in document_frequency.items()}
+
+        vectors = [self._vectorize(features) for features in counts]
+        labels = [intent for _, intent, _ in examples]
+        intents = sorted(set(labels))
+        self.weights = {intent: defaultdict(float) for intent in intents}
+        self.bias = {intent: 0.0 for intent in intents}
+
+        order = list(range(len(vectors)))
+        rng = random.Random(seed)
+        for _ in range(epochs):
+            rng.shuffle(order)
+            for i in order:
+                vector = vectors[i]
+                for intent, probability in _softmax(self._scores(vector)):
+                    # gradient of the cross entropy
+                    gradient = probability - (1.0 if intent == labels[i] else 0.0)
+                    if abs(gradient) < 1e-4:
+                        continue
+                    weights = self.weights[intent]
+                    for feature, value in vector.items():
+                        weights[feature] -= learning_rate * gradient * value
+                    self.bias[intent] -= learning_rate * gradient
+
+        self.weights = {intent: dict(weights) for intent, weights in self.weights.items()}
+
+        # remember the words around the answers, to find the answer in new utterances
+        templates = set()
+        for text, _, entities in examples:
+            for value, _ in entities:
+                words, value_words = tokenize(text), tokenize(value)
+                for i in range(len(words) - len(value_words) + 1):
+                    if words[i:i + len(value_words)] == value_words:
+                        templates.add((tuple(words[:i]), tuple(words[i + len(value_words):])))
+                        break
+        # longest templates first, so the most specific one matches
+        self.answer_templates = sorted(templates, key=lambda template: -(len(template[0]) + len(template[1])))
+
+        return self
+
+    def _vectorize(self, features: Counter) -> dict:
+        # unknown features do not count
+        return _normalize({feature: count * self.idf[feature] for feature, count in features.items()
+                           if feature in self.idf})
+
+    def _scores(self, vector: dict) -> dict:
+        return {intent: self.bias[intent] + sum(value * weights.get(feature, 0.0) for feature, value in vector.items())
+                for intent, weights in self.weights.items()}
+
+    def rank(self, text: str):
+        """
+        score the text against all intents
+
+        :return: list of (intent, probability), most probable first
+        """
+        if not self.weights:
+            return []
+        return _softmax(self._scores(self._vectorize(featurize(text))))
+
+    def extract_answer(self, text: str):
+        """
+        find the answer entity with the templates of the training data
+
+        :return: the answer or None if no template matches
+        """
+        words = tokenize(text)
+        for prefix, suffix in self.answer_templates:
+            if len(prefix) + len(suffix) >= len(words):
+                continue
+            if tuple(words[:len(prefix)]) == prefix and tuple(words[len(words) - len(suffix):]) == suffix:
+                return ' '.join(words[len(prefix):len(words) - len(suffix)])
+        return None
+
+    def parse(self, text: str) -> NLUResult:
+        """classify the text (the confidence is the probability of the best intent)"""
+        ranking = self.rank(text)
+        if not ranking:
+            return NLUResult(text, fallback_intent, 0.0, source='local')
+
+        intent, confidence = ranking[0]
+        entities = []
+        if intent == 'game_answer':
+            answer = self.extract_answer(text)
+            if answer:
+                entities.append({'entity': 'answer', 'value': answer})
+
+        return NLUResult(text, intent, confidence, entities, ranking, source='local')
+
+    def save(self, path=default_artifact):
+        """save the trained classifier as json"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'training_hash': self.training_hash, 'idf': self.idf, 'weights': self.weights,
+                       'bias': self.bias, 'answer_templates': self.answer_templates}, f)
+
+    @classmethod
+    def load(cls, path=default_artifact):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        templates = [(tuple(prefix), tuple(suffix)) for prefix, suffix in data['answer_templates']]
+        return cls(data['idf'], data['weights'], data['bias'], templates, data['training_hash'])
+
+    @classmethod
+    def load_or_train(cls, training_data=default_training_data, artifact=default_artifact):
+        """
+        load the compiled classifier, or train (and compile) it if the training data has changed
+
+        :param artifact: path of the compiled classifier (None to always train)
+        """
+        training_hash = _file_hash(training_data)
+
+        if artifact and os.path.exists(artifact):
+            try:
+                classifier = cls.load(artifact)
+                if classifier.training_hash == training_hash:
+                    return classifier
+            except (OSError, ValueError, KeyError):
+                pass
+
+        classifier = cls(training_hash=training_hash).train(load_training_data(training_data))
+        if artifact:
+            try:
+                classifier.save(artifact)
+            except OSError as e:
+                print(f'__could not save the fast nlu classifier: {e}')
+        return classifier
+
+
+class HybridParser:
+    """
+    answers confidently classified utterances locally, asks the remote parser (rasa) for the others
+
+    if the remote parser can not be reached, the local result is used if it is above the
+    fallback threshold (like rasa's FallbackClassifier), so the bot also works without rasa
+    """
+
+    def __init__(self, local: LocalIntentClassifier, remote, confidence_threshold=0.8, ambiguity_threshold=0.1,
+                 fallback_threshold=0.3):
+        """
+        :param local: the local classifier
+        :param remote: the remote parser (anything with parse(text) -> NLUResult), None to only parse locally
+        :param confidence_threshold: minimum probability to answer locally
+        :param ambiguity_threshold: minimum difference to the second best intent to answer locally
+        :param fallback_threshold: minimum probability to use the local result if the remote parser fails
+        """
+        self.local = local
+        self.remote = remote
+        self.confidence_threshold = confidence_threshold
+        self.ambiguity_threshold = ambiguity_threshold
+        self.fallback_threshold = fallback_threshold
+
+        # number of utterances answered locally / remotely
+        self.local_answers = 0
+        self.remote_answers = 0
+
+    def _is_confident(self, result: NLUResult) -> bool:
+        if result.confidence < self.confidence_threshold:
+            return False
+        second = result.intent_ranking[1][1] if len(result.intent_ranking) > 1 else 0.0
+        return result.confidence - second >= self.ambiguity_threshold
+
+    def parse(self, text: str) -> NLUResult:
+        with span('nlu_local'):
+            local_result = self.local.parse(text)
+        if self.remote is None or self._is_confident(local_result):
+            self.local_answers += 1
+            count('nlu_local_answer')
+            if self.remote is None and local_result.confidence < self.fallback_threshold:
+                return NLUResult.fallback(text)
+            return local_result
+
+        result = self.remote.parse(text)
+        if result.source == 'fallback' and local_result.confidence >= self.fallback_threshold:
+            # the remote parser can not be reached, better a guess than nothing
+            self.local_answers += 1
+            count('nlu_local_answer')
+            return local_result
+
+        self.remote_answers += 1
+        count('nlu_remote_answer')
+        return result
+
+    def stats(self) -> dict:
+        stats = {'local': self.local_answers, 'remote': self.remote_answers}
+        if hasattr(self.remote, 'stats'):
+            stats['remote_stats'] = self.remote.stats()
+        return stats
@@ -4,15 +4,15 @@
 games module for the dialogmanager
 """
 
-from utils import asr, tts, rasa_parse
+from utils import tts
 
-import string
 import random
-import json
-from time import sleep
+from time import perf_counter
 
-import torch
-from transformers import GPT2Tokenizer, GPT2LMHeadModel
+from metrics import span, observe, count
+from models import get_gpt2
+from vocabulary import get_vocabulary, store as vocabulary_store
+from answer_index import get_answer_index, answer_key, singularize
 
 
 all_games_instructions = """The animal game works as follows: At the beginning of the game, I will decide upon a random letter.
@@ -27,11 +27,53 @@ Then I will continue the text you started with as many words as I like.
 This way we try to tell a story together.
 The game does not end, until you say so."""
 
+# said by the category games while pretending to think
+thinking_phrases = ['Good one! I need some time to think',
+                    'Nice choice! I need some time to think',
+                    'Great! Wait...',
+                    'Ok...']
+
+# said by the category games with their item after pretending to think
+thinking_replies = ['Got something! I\'ll say {item}. Your turn.',
+                    'Ok, I\'ll say {item}. Your turn.',
+                    'Here we go! I\'ll say {item}. Your turn.']
+
+# said by the category games with their item right away ({answer} is the user's item, {kind} e.g. 'animal')
+replies = ['Great! {answer} is a valid {kind}. I\'ll say {item}. Your turn.',
+           'Nice choice! I\'ll say {item}. Your turn.',
+           'Good one! I\'ll say {item}.',
+           'You got it! I\'ll say {item}. Your turn.']
+
+
+def run_now(seconds, callback, fire_on_input=False):
+    """schedule of games played without a dialog manager: does not wait at all"""
+    callback()
+
+
+def prepare_nothing(text):
+    """prepare of games played without audio output: nothing to synthesize ahead"""
+
+
 class Game:
     """abstract game class"""
-    def __init__(self):
-        """each game has to have an instruction set"""
-        self.instructions = '' 
+
+    # each game has to have an instruction set
+    instructions = ''
+    # what the user is expected to say (tunes when the asr considers the input over,
+    # see speech_input.endpointing_presets)
+    expected_input = 'default'
+
+    def __init__(self, say=tts, schedule=run_now, prepare=prepare_nothing):
+        """
+        :param say: called with each text the game says
+        :param schedule: called with (seconds, callback, fire_on_input) to do something after a delay
+            (see DialogManager.schedule), the game never blocks
+        :param prepare: called with a text the game will probably say soon (e.g. to synthesize it
+            in the background), it must return right away
+        """
+        self.say = say
+        self.schedule = schedule
+        self.prepare = prepare
 
     def next_input(self, user_input, intent, entity) -> bool:
         """
@@ -43,289 +85,421 @@ class Game:
         """
         return False
 
+    def stop(self):
+        """the game is over or the user left it (nothing is said after this)"""
 
-class FoodGame(Game):
 
-    def __init__(self):
-        self.instructions = """At the beginning of the game, I will decide upon a random letter.
-Then, you will have to name a food that starts with that letter.
-Then, I will do the same.
-We will continue until one of us can't think of an food anymore.
-You can't repeat foods."""
-        # generate a random letter
-        self.letter = random.choice(string.ascii_uppercase)
-
-        # load the list of foods starting with the letter
-        # from the json file
-        with open('./game_data/foods.json', 'r') as f:
-            self.foods = json.load(f)[self.letter]
-        # set the foods index counter to zero
-        self.foods_index = 0
-        # set of foods already used
-        self.used_foods = set()
-        # generate a random number between 3-10
-        # after which the computer will give up
-        self.give_up_at = random.randint(1, 10)
-        self.give_up_counter = 0
+class LazyShuffle:
+    """
+    iterates over the items of a list in random order without copying or shuffling it up front
 
-        # get the first food to be said
-        first_food = self._get_next_food()
-        # start the game!
-        tts('Good choice! Let\'s play the food game. I will start.')
-        tts(f'I have chosen the letter {self.letter}. I begin by saying {first_food}. Now it\'s your turn!')
-
-
-    def _get_next_food(self):
-        # update food index
-        self.foods_index += 1
-        # check if we have reached the end of the list
-        if self.foods_index >= len(self.foods):
-            return None
-        
-        # else get the next food
-        next_food = self.foods[self.foods_index]
-
-        # if the next food has already been used, get the next one recursively
-        if next_food in self.used_foods:
-            return self._get_next_food()
-        else:
-            # add to list of used foods and return
-            self.used_foods.add(next_food)
-            return next_food
+    (a Fisher-Yates shuffle done one step per item, the swaps are kept in a dict,
+    so getting the next item is O(1) and the list is never modified)
+    """
 
-    def next_input(self, user_input, intent, entity) -> bool:
-        if intent != 'game_answer':
-            tts('I\'m sorry, I didn\'t understand your food. Could you please repeat that?')
-            # feeback is game_answer
-        else:
-            # check if the food starts with the right letter
-            if entity[0].upper() == self.letter:
-                # check if food has already been used
-                if entity not in self.used_foods:
-                    self.used_foods.add(entity)
-                    # correct case!
-                    # btw, we do not really check if this is really an existing food
-                    # but we could do that with a web request
-                    # for now, we just assume that the user is honest
-                    # and knows the rules of the game
+    def __init__(self, items):
+        self.items = items
+        self.remaining = len(items)
+        # position -> index of the item that was swapped to that position
+        self.swapped = {}
 
-                    # check as well if the computer gives up
-                    if self.give_up_counter >= self.give_up_at:
-                        tts(f'Good call! I give up. I can\'t think of any more foods starting with {self.letter}. You won!')
-                        return True  # return true to end the game
-                    else:
-                        # computer's turn
-                        next_food = self._get_next_food()
+    def __iter__(self):
+        return self
 
-                        # if is None, we have reached the end of the list
-                        if not next_food:
-                            tts(f'Good call! I can\'t think of any more foods starting with {self.letter}. You won!')
-                            return True
-                        else:
-                            # it is nice to have some randomness in the game
-                            # so that the computer does not always say the same thing
-                            # and the game is more fun
-                            # sleep a little bit sometimes to pretend to think
-                            if random.random() < 0.3:
-                                tts(random.choice(['Good one! I need some time to think',
-                                                   'Nice choice! I need some time to think',
-                                                   'Great! Wait...',
-                                                   'Ok...']))
-                                sleep(random.uniform(1, 4))
-                                tts(random.choice([f'Got something! I\'ll say {next_food}. Your turn.',
-                                                   f'Ok, I\'ll say {next_food}. Your turn.',
-                                                   f'Here we go! I\'ll say {next_food}. Your turn.',]))
-                            else:
-                                # don't always say the same thing
-                                tts(random.choice([f'Great! {entity} is a valid food. I\'ll say {next_food}. Your turn.',
-                                                   f'Nice choice! I\'ll say {next_food}. Your turn.',
-                                                   f'Good one! I\'ll say {next_food}.',
-                                                   f'You got it! I\'ll say {next_food}. Your turn.']))
-                            # increment the give up counter
-                            self.give_up_counter += 1
+    def __next__(self):
+        if self.remaining == 0:
+            raise StopIteration
 
-                else:
-                    tts('This food has already been named! Try again.')
-            else:
-                tts(f'The food has to start with the letter {self.letter}. Please try again.')
+        # pick one of the remaining positions and swap the last remaining one into its place
+        position = random.randrange(self.remaining)
+        self.remaining -= 1
+        index = self.swapped.get(position, position)
+        self.swapped[position] = self.swapped.pop(self.remaining, self.remaining)
+        return self.items[index]
 
-        return False  # return False to continue game
 
-class AnimalGame(Game):
+def category_item(category: str) -> str:
+    """name of one item of a category, e.g. 'animal' for 'animals'"""
+    return singularize(category)
 
-    def __init__(self):
-        self.instructions = """At the beginning of the game, I will decide upon a random letter.
-Then, you will have to name an animal that starts with that letter.
+
+def category_game_intents() -> dict:
+    """intent to choose the game -> category, for every category there is game data for"""
+    return {f'choose_{category_item(category)}_game': category for category in vocabulary_store.categories()}
+
+
+def category_instructions(category: str) -> str:
+    """the rules of the game of a category"""
+    item = category_item(category)
+    article = 'an' if item[0] in 'aeiou' else 'a'
+    return f"""At the beginning of the game, I will decide upon a random letter.
+Then, you will have to name {article} {item} that starts with that letter.
 Then, I will do the same.
-We will continue until one of us can't think of an animal anymore.
-You can't repeat animals."""
-        # generate a random letter
-        self.letter = random.choice(string.ascii_uppercase)
-
-        # load the list of animals starting with the letter
-        # from the json file
-        with open('./game_data/animals.json', 'r') as f:
-            self.animals = json.load(f)[self.letter]
-        # set the animals index counter to zero
-        self.animals_index = 0
-        # set of animals already used
-        self.used_animals = set()
+We will continue until one of us can't think of {article} {item} anymore.
+You can't repeat {category}."""
+
+
+class CategoryGame(Game):
+    """
+    game of naming items of a category (e.g. animals or foods) starting with a random letter
+
+    the category is one of the game_data files, so new categories need no new code
+    """
+
+    # a single item (e.g. 'lion')
+    expected_input = 'answer'
+
+    def __init__(self, category: str, say=tts, schedule=run_now, prepare=prepare_nothing):
+        super().__init__(say, schedule, prepare)
+        self.category = category
+        # e.g. 'animal'
+        self.item = category_item(category)
+        self.instructions = category_instructions(category)
+
+        vocabulary = get_vocabulary(category)
+        # generate a random letter (that there are items for)
+        self.letter = random.choice(vocabulary.letters())
+
+        # the items starting with the letter, in random order
+        # (the vocabulary is loaded only once per process)
+        self.items = LazyShuffle(vocabulary.words(self.letter))
+        # index of all known items to match the user's answers against
+        self.answers = get_answer_index(category)
+        # set of items already used (normalized with answer_key, so "Apple" and "apples" are the same)
+        self.used_items = set()
         # generate a random number between 3-10
         # after which the computer will give up
         self.give_up_at = random.randint(1, 10)
         self.give_up_counter = 0
+        # the computer's next (item, thinking phrase or None, reply), prepared before the user answers
+        self.speculation = None
 
-        # get the first animal to be said
-        first_animal = self._get_next_animal()
+        # get the first item to be said
+        first_item = self._get_next_item()
         # start the game!
-        tts('Good choice! Let\'s play the animal game. I will start.')
-        tts(f'I have chosen the letter {self.letter}. I begin by saying {first_animal}. Now it\'s your turn!')
-
-
-    def _get_next_animal(self):
-        # update animal index
-        self.animals_index += 1
-        # check if we have reached the end of the list
-        if self.animals_index >= len(self.animals):
-            return None
-        
-        # else get the next animal
-        next_animal = self.animals[self.animals_index]
-
-        # if the next animal has already been used, get the next one recursively
-        if next_animal in self.used_animals:
-            return self._get_next_animal()
-        else:
-            # add to list of used animals and return
-            self.used_animals.add(next_animal)
-            return next_animal
+        self.say(f'Good choice! Let\'s play the {self.item} game. I will start.')
+        self.say(f'I have chosen the letter {self.letter}. I begin by saying {first_item}. Now it\'s your turn!')
+        # while the user thinks of an item, the computer already prepares its reply
+        self._speculate()
+
+    def _draw_item(self):
+        """
+        get the next item that has not been used yet (without using it)
+
+        :return: the item or None if all items of the letter have been used
+        """
+        # each item is drawn at most once, so skipping the used ones costs O(1) per item
+        for next_item in self.items:
+            if answer_key(next_item) not in self.used_items:
+                return next_item
+
+        return None
+
+    def _get_next_item(self):
+        """
+        get the next item that has not been used yet and use it
+
+        :return: the item or None if all items of the letter have been used
+        """
+        next_item = self._draw_item()
+        if next_item is not None:
+            self.used_items.add(answer_key(next_item))
+        return next_item
+
+    def _compose_reply(self, next_item):
+        """
+        choose what the computer says with its item
+
+        it is nice to have some randomness in the game, so that the computer does not always say
+        the same thing and the game is more fun. sometimes it pretends to think a little first.
+
+        :return: thinking phrase or None, reply (with an {answer} placeholder for the user's item)
+        """
+        if random.random() < 0.3:
+            return random.choice(thinking_phrases), random.choice(thinking_replies).replace('{item}', next_item)
+        return None, random.choice(replies).replace('{item}', next_item).replace('{kind}', self.item)
+
+    def _speculate(self):
+        """
+        prepare the computer's next item and reply while the user is still thinking and speaking
+
+        the item is drawn but not used yet (the user might name it), the reply is passed to prepare,
+        so its audio is synthesized in the background and answering only means playing it
+        """
+        self.speculation = None
+        # with the next valid answer the computer gives up, there is no reply to prepare
+        if self.give_up_counter >= self.give_up_at:
+            return
+
+        next_item = self._draw_item()
+        if next_item is None:
+            return
+
+        thinking_phrase, reply = self._compose_reply(next_item)
+        self.speculation = (next_item, thinking_phrase, reply)
+        # a reply mentioning the user's item can only be synthesized once the item is known
+        if '{answer}' not in reply:
+            self.prepare(reply)
+
+    def _take_speculation(self):
+        """
+        the prepared item and reply, or new ones if the user has named the prepared item
+
+        :return: item (None if all items of the letter have been used), thinking phrase or None, reply
+        """
+        speculation, self.speculation = self.speculation, None
+        if speculation is not None and answer_key(speculation[0]) not in self.used_items:
+            count('speculation_hit')
+            return speculation
+
+        if speculation is not None:
+            # the user named the prepared item, it is dropped (the audio just stays in the cache)
+            count('speculation_miss')
+        next_item = self._draw_item()
+        if next_item is None:
+            return None, None, None
+        return (next_item, *self._compose_reply(next_item))
 
     def next_input(self, user_input, intent, entity) -> bool:
         if intent != 'game_answer':
-            tts('I\'m sorry, I didn\'t understand your animal. Could you please repeat that?')
+            self.say(f'I\'m sorry, I didn\'t understand your {self.item}. Could you please repeat that?')
             # feeback is game_answer
         else:
-            # check if the animal starts with the right letter
-            if entity[0].upper() == self.letter:
-                # check if animal has already been used
-                if entity not in self.used_animals:
-                    self.used_animals.add(entity)
+            # the checks are done on what the user said (normalized, so "The Apples" is "apple")
+            answer = entity.lower().strip()
+            key = answer_key(answer)
+            # keys that count as this answer: its own, and the known item it means
+            # (e.g. "blueberries" and "blue berry"), but only if that item starts with the letter too,
+            # a synonym with another letter (e.g. "orca" for "killer whale") stays the user's answer.
+            # exact matches (plurals, articles, synonyms) win, a misspelling of the asr (e.g. "tucan")
+            # only finds a known item if nothing matches exactly, and it only counts to find repeats
+            keys = {key}
+            known_item, distance = self.answers.lookup(answer)
+            if known_item and known_item[0].upper() == self.letter:
+                if distance == 0:
+                    answer = known_item
+                keys.add(answer_key(known_item))
+
+            # check if the answer starts with the right letter
+            if key and key[0].upper() == self.letter:
+                # check if the answer has already been used
+                if not keys & self.used_items:
+                    self.used_items.update(keys)
                     # correct case!
-                    # btw, we do not really check if this is really an existing animal
-                    # but we could do that with a web request
+                    # btw, we do not require the answer to be in our list of known items
+                    # (it is only used to recognize the same item said differently)
                     # for now, we just assume that the user is honest
                     # and knows the rules of the game
 
                     # check as well if the computer gives up
                     if self.give_up_counter >= self.give_up_at:
-                        tts(f'Good call! I give up. I can\'t think of any more animals starting with {self.letter}. You won!')
+                        self.say(f'Good call! I give up. I can\'t think of any more {self.category} starting with {self.letter}. You won!')
                         return True  # return true to end the game
                     else:
                         # computer's turn
-                        next_animal = self._get_next_animal()
+                        # (usually with the item and reply prepared while the user was speaking)
+                        next_item, thinking_phrase, reply = self._take_speculation()
 
-                        # if is None, we have reached the end of the list
-                        if not next_animal:
-                            tts(f'Good call! I can\'t think of any more animals starting with {self.letter}. You won!')
+                        # if is None, we have used all items of the letter
+                        if not next_item:
+                            self.say(f'Good call! I can\'t think of any more {self.category} starting with {self.letter}. You won!')
                             return True
                         else:
-                            # it is nice to have some randomness in the game
-                            # so that the computer does not always say the same thing
-                            # and the game is more fun
-                            # sleep a little bit sometimes to pretend to think
-                            if random.random() < 0.3:
-                                tts(random.choice(['Good one! I need some time to think',
-                                                   'Nice choice! I need some time to think',
-                                                   'Great! Wait...',
-                                                   'Ok...']))
-                                sleep(random.uniform(1, 4))
-                                tts(random.choice([f'Got something! I\'ll say {next_animal}. Your turn.',
-                                                   f'Ok, I\'ll say {next_animal}. Your turn.',
-                                                   f'Here we go! I\'ll say {next_animal}. Your turn.',]))
+                            self.used_items.add(answer_key(next_item))
+                            reply = reply.replace('{answer}', answer)
+                            if thinking_phrase:
+                                # wait a little bit to pretend to think
+                                # (if the user speaks meanwhile, the item is said right away)
+                                self.say(thinking_phrase)
+                                self.schedule(random.uniform(1, 4), lambda: self.say(reply), fire_on_input=True)
                             else:
-                                # don't always say the same thing
-                                tts(random.choice([f'Great! {entity} is a valid animal. I\'ll say {next_animal}. Your turn.',
-                                                   f'Nice choice! I\'ll say {next_animal}. Your turn.',
-                                                   f'Good one! I\'ll say {next_animal}.',
-                                                   f'You got it! I\'ll say {next_animal}. Your turn.']))
+                                self.say(reply)
                             # increment the give up counter
                             self.give_up_counter += 1
+                            # prepare the next reply while the user thinks of the next item
+                            self._speculate()
 
                 else:
-                    tts('This animal has already been named! Try again.')
+                    self.say(f'This {self.item} has already been named! Try again.')
             else:
-                tts(f'The animal has to start with the letter {self.letter}. Please try again.')
+                self.say(f'The {self.item} has to start with the letter {self.letter}. Please try again.')
 
         return False  # return False to continue game
 
 
 class WordSequenceGame(Game):
     
-    def __init__(self):
-        self.instructions = """You will start with as many words as you like.
+    instructions = """You will start with as many words as you like.
 Then I will continue the text you started with as many words as I like.
 This way we try to tell a story together.
 The game does not really end, until you say so."""
 
+    # a sentence or more
+    expected_input = 'story'
+
+    def __init__(self, streaming=True, batcher=None, pool=None, say=tts, schedule=run_now, prepare=prepare_nothing):
+        """
+        :param streaming: say the continuation phrase by phrase while it is generated
+        :param batcher: BatchScheduler to generate together with other games (e.g. in the server),
+            the continuation is then said at once
+        :param pool: GenerationPool to generate in a worker process with a deadline, the game does not
+            wait for the continuation (it is said when it is ready), so the dialog can go on meanwhile
+        """
+        super().__init__(say, schedule, prepare)
         # set text to empty string
         self.text = ''
 
-        # load the transformer models
-        self.tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
-        self.model = GPT2LMHeadModel.from_pretrained('gpt2')
+        # generation in worker processes (None: generate in this process)
+        self.pool = pool
+        # the continuation the pool is generating (None if there is none)
+        self.pending = None
+        # True once the game is over, late continuations are not said anymore
+        self.stopped = False
+        if pool is not None:
+            # the model and the kv cache of the story are in the worker process
+            self.story_id = pool.new_story()
+        else:
+            # get the shared transformer models (loaded only once per process)
+            self.tokenizer, self.model = get_gpt2()
+            # token buffer and kv cache of the story, so each turn only feeds the new words
+            # (torch is imported only now, so starting the bot and the other games does not wait for it)
+            from story import StoryGenerator
+            self.story = StoryGenerator(self.tokenizer, self.model)
+        # if streaming, the continuation is spoken phrase by phrase while it is still generated
+        self.streaming = streaming and batcher is None
+        # generation scheduler shared with the other games of the process (None: generate alone)
+        self.batcher = batcher
 
         # start the game!
-        tts('Great! Let\'s play the word sequence game. You can start by saying as many words as you like. I will continue from there.')
+        self.say('Great! Let\'s play the word sequence game. You can start by saying as many words as you like. I will continue from there.')
 
     def _predict_next_words(self, text: str, n_limit=1):
         """
-        Generate text using a pre-trained GPT-2 model.
+        Continue the story using a pre-trained GPT-2 model.
+
+        Only the new text is encoded, the earlier story is kept in the kv cache.
 
-        :param text: Input text to start generating from.
-        :param n_limit: Maximum number of words to generate. Note this limits the total
-                         output length including the input text.
+        :param text: New text (e.g. the user's input) to add to the story before generating.
+        :param n_limit: Maximum number of tokens to generate (not including the story so far).
 
-        :return: Generated text.
+        :return: Generated text (only the continuation).
         """
+        self.story.add_text(text)
+        if self.batcher is not None:
+            return self.batcher.generate(self.story, n_limit)
+        return self.story.generate(n_limit)
 
+    def _stream_next_words(self, text: str, n_limit=1):
+        """
+        Continue the story like _predict_next_words, but yield it phrase by phrase while decoding.
 
-        # Encode the input text
-        input_ids = self.tokenizer.encode(text, return_tensors='pt')
+        :param text: New text (e.g. the user's input) to add to the story before generating.
+        :param n_limit: Maximum number of tokens to generate (not including the story so far).
 
-        # Calculate the number of tokens in the input
-        input_tokens_count = input_ids.size(1)
+        :return: Generator of phrases of the continuation.
+        """
+        self.story.add_text(text)
+        from story import stream_phrases
+        return stream_phrases(self.story.stream_words(n_limit))
 
-        # Generate text
-        attention_mask = torch.ones(input_ids.shape, device=input_ids.device) # Ensure attention is only on the input sequence
-        output_sequences = self.model.generate(
-            input_ids=input_ids,
-            attention_mask=attention_mask,
-            max_length=input_tokens_count + n_limit,  # Adjust max_length for the desired number of additional tokens
-            temperature=1.0,
-            num_return_sequences=1,
-            pad_token_id=self.tokenizer.eos_token_id
-        )
 
-        # Decode the output
-        return self.tokenizer.decode(output_sequences[0], skip_special_tokens=True)
+    def _submit_next_words(self, text: str, n_limit=1):
+        """
+        Continue the story in a worker process of the pool, without waiting for it.
 
+        The continuation is said (phrase by phrase if streaming) when it arrives, it is added to the
+        text by the next input (see _add_pending), so the text is only changed on the dialog's thread.
+        """
+        start = perf_counter()
+        said = []
+
+        def say_phrase(phrase):
+            if not said:
+                # how long the user waits until the bot starts to speak
+                observe('story_first_phrase', perf_counter() - start)
+            said.append(phrase)
+            if not self.stopped:
+                self.say(phrase.replace('\n', ' ').strip())
+
+        def done(future):
+            prediction = future.result().replace('\n', ' ')
+            if not self.streaming and not self.stopped:
+                self.say(prediction)
+
+        self.pending = self.pool.submit(self.story_id, text, n_limit, on_phrase=say_phrase if self.streaming else None)
+        self.pending.add_done_callback(done)
+
+    def _add_pending(self):
+        """add the continuation the pool is generating to the text (waits for it if it is not done)"""
+        if self.pending is not None:
+            # the user went on before the last continuation was done, it comes first in the story
+            # (waiting for it is bounded by the pool's deadline)
+            self.text += self.pending.result().replace('\n', ' ')
+            self.pending = None
+
+    def stop(self):
+        self.stopped = True
+        if self.pool is not None:
+            self.pool.drop_story(self.story_id)
 
     def next_input(self, user_input, intent, entity) -> bool:
+        # the last continuation comes before the user's input
+        self._add_pending()
         # add the user's input to the text
-        self.text += ' ' + user_input
+        new_text = ' ' + user_input
+        self.text += new_text
 
         # make prediction about the next words
         # generate a random amount of next words
         user_len = len(user_input.split(' '))
         n_limit = random.randint(user_len // 2, user_len * 2)
         # (prediction is only the next words, not the whole text)
-        prediction = self._predict_next_words(self.text, n_limit=n_limit)[len(self.text):].replace('\n', ' ')
+        if self.pool is not None:
+            # the dialog goes on while the worker generates (e.g. to stop the game)
+            self._submit_next_words(new_text, n_limit=n_limit)
+            return False
+        elif self.streaming:
+            # say each phrase as soon as it is generated
+            prediction = ''
+            start = perf_counter()
+            with span('story_generation'):
+                for phrase in self._stream_next_words(new_text, n_limit=n_limit):
+                    if not prediction:
+                        # how long the user waits until the bot starts to speak
+                        observe('story_first_phrase', perf_counter() - start)
+                    phrase = phrase.replace('\n', ' ')
+                    prediction += phrase
+                    self.say(phrase.strip())
+        else:
+            with span('story_generation'):
+                prediction = self._predict_next_words(new_text, n_limit=n_limit).replace('\n', ' ')
+            # say the prediction and wait for next input
+            self.say(prediction)
 
         # add the prediction to the text
         self.text += prediction
 
-        # say the prediction and wait for next input
-        tts(prediction)
-
         return False
 
+
+def game_phrases():
+    """
+    phrases the games say over and over again (without any placeholders),
+    they can be synthesized once at startup
+    """
+    phrases = [
+        all_games_instructions,
+        WordSequenceGame.instructions,
+        'Great! Let\'s play the word sequence game. You can start by saying as many words as you like. I will continue from there.',
+    ] + thinking_phrases
+
+    for category in vocabulary_store.categories():
+        item = category_item(category)
+        phrases += [
+            category_instructions(category),
+            f'Good choice! Let\'s play the {item} game. I will start.',
+            f'I\'m sorry, I didn\'t understand your {item}. Could you please repeat that?',
+            f'This {item} has already been named! Try again.',
+        ]
+
+    return phrases
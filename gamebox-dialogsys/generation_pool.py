@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+
+"""
+story generation in supervised worker processes
+
+the dialog never runs the model itself: the continuation of a story is requested from a worker
+process, which holds the model and the kv caches of its stories. every request has a deadline,
+when it passes the worker stops after the current token and the text generated so far is the
+continuation (a canned one if there is none yet). a worker that crashes or does not stop in time
+is replaced by a new one, its stories are rebuilt from their text with the next request.
+
+    pool = GenerationPool(workers=2, deadline=5.0)
+    story = pool.new_story()
+    future = pool.submit(story, ' once upon a time', n_limit=20, on_phrase=tts)
+    future.result()  # the whole continuation
+
+with a memory-mapped inference profile (e.g. 'mmap') the workers share the weights, so each further
+worker only costs its activations and kv caches. `./generation_pool.py --workers 3` shows the memory
+of each worker.
+"""
+
+import argparse
+import itertools
+import multiprocessing
+import random
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import monotonic, perf_counter
+
+from metrics import count, observe
+from models import inference_profiles, process_memory_mb
+
+
+# said instead of the continuation when nothing could be generated in time
+canned_continuations = [
+    ' and then something unexpected happened.',
+    ' and nobody knew what would come next.',
+    ' but that was only the beginning.',
+    ' and so the story went on.',
+]
+
+# characters of a story kept to rebuild it in a new worker
+# (more than the model's window of 1024 tokens, so nothing it would still see is lost)
+max_history_chars = 8000
+
+
+def _worker_main(connection, profile: str, threads=None):
+    """
+    loop of a worker process: load the model, then continue stories until the pipe is closed
+
+    messages from the pool:
+        ('generate', request_id, story_id, history, text, n_limit, deadline)
+        ('drop', story_id)
+    messages to the pool:
+        ('ready',), ('phrase', request_id, phrase), ('done', request_id)
+    """
+    from models import set_inference_profile, get_gpt2
+    from story import StoryGenerator, stream_phrases
+
+    set_inference_profile(profile, threads)
+    tokenizer, model = get_gpt2()
+    # story id -> StoryGenerator (with its kv cache)
+    stories = {}
+    connection.send(('ready',))
+
+    while True:
+        try:
+            message = connection.recv()
+        except (EOFError, OSError):
+            # the pool is gone
+            return
+
+        if message[0] == 'generate':
+            _, request_id, story_id, history, text, n_limit, deadline = message
+            story = stories.get(story_id)
+            if story is None:
+                # new story, or one of a worker that was replaced
+                story = stories[story_id] = StoryGenerator(tokenizer, model)
+                story.add_text(history)
+            story.add_text(text)
+
+            # (time.monotonic is the same clock in all processes of the host)
+            for phrase in stream_phrases(story.stream_words(n_limit, deadline)):
+                connection.send(('phrase', request_id, phrase))
+            connection.send(('done', request_id))
+        elif message[0] == 'drop':
+            stories.pop(message[1], None)
+
+
+class _WorkerFailed(Exception):
+    """the worker crashed or did not stop in time"""
+
+
+class _Worker:
+    """one worker process and what the pool knows about it"""
+
+    def __init__(self, index: int, context, profile: str, threads=None):
+        self.index = index
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_connection, profile, threads),
+                                       name=f'story-worker-{index}', daemon=True)
+        self.process.start()
+        # only the worker uses its end of the pipe
+        child_connection.close()
+
+        # True once the model is loaded
+        self.ready = False
+        # monotonic time the worker crashed or was stopped for not answering (None while it is fine)
+        self.failed_at = None
+        # ids of the stories the process holds the state of
+        self.stories = set()
+        # one request at a time
+        self.lock = threading.Lock()
+
+    def wait_ready(self, until: float) -> bool:
+        """wait for the model to be loaded, at most until the given monotonic time"""
+        while not self.ready:
+            timeout = until - monotonic()
+            try:
+                if timeout <= 0 or not self.connection.poll(timeout):
+                    return False
+                if self.connection.recv()[0] == 'ready':
+                    self.ready = True
+            except (EOFError, OSError) as e:
+                # crashed while loading
+                raise _WorkerFailed from e
+        return True
+
+    def stop(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+class GenerationPool:
+    """
+    worker processes continuing stories with a deadline per request
+
+    the stories are spread over the workers, a story stays with its worker (its kv cache is there)
+    """
+
+    def __init__(self, workers=1, profile='default', deadline=5.0, grace=2.0, check_interval=1.0, threads=None):
+        """
+        :param workers: number of worker processes (each loads its own model)
+        :param profile: inference profile of the workers (see models.inference_profiles)
+        :param deadline: seconds a continuation may take
+        :param grace: seconds after the deadline until a worker that did not stop is replaced
+        :param check_interval: seconds between checks for crashed workers (and the first restart delay)
+        :param threads: number of torch threads of each worker (None: the one of the profile)
+        """
+        self.profile = profile
+        self.threads = threads
+        self.deadline = deadline
+        self.grace = grace
+        self.check_interval = check_interval
+
+        # spawn, so the workers do not inherit the threads and locks of the dialog process
+        self._context = multiprocessing.get_context('spawn')
+        self._workers = [_Worker(index, self._context, profile, threads) for index in range(workers)]
+        # failures of each worker since it was last ready (the restarts are delayed more and more,
+        # so a worker that can not load the model does not keep the cpu busy)
+        self._failures_in_row = [0] * workers
+        # story id -> index of its worker
+        self._assignment = {}
+        # story id -> its text so far (to rebuild it in a new worker)
+        self._history = {}
+        # story id -> text the worker does not know yet (e.g. a canned continuation)
+        self._unsent = {}
+        self._story_ids = itertools.count()
+        self._request_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+
+        # the requests wait for their worker on these threads, so submitting never blocks
+        self._executor = ThreadPoolExecutor(max_workers=4 * workers, thread_name_prefix='story-request')
+
+        # statistics
+        self.requests = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.canned = 0
+        self.restarts = 0
+
+        self._supervisor = threading.Thread(target=self._supervise,
+                                            name='story-supervisor', daemon=True)
+        self._supervisor.start()
+
+    def new_story(self) -> int:
+        """
+        start a new story
+
+        :return: the id of the story
+        """
+        with self._lock:
+            story_id = next(self._story_ids)
+            # the worker with the fewest stories
+            loads = [0] * len(self._workers)
+            for index in self._assignment.values():
+                loads[index] += 1
+            self._assignment[story_id] = loads.index(min(loads))
+            self._history[story_id] = ''
+            self._unsent[story_id] = ''
+        return story_id
+
+    def drop_story(self, story_id: int):
+        """forget a story (e.g. when the game ends), also in its worker"""
+        with self._lock:
+            index = self._assignment.pop(story_id, None)
+            self._history.pop(story_id, None)
+            self._unsent.pop(story_id, None)
+        if index is not None:
+            self._executor.submit(self._drop, index, story_id)
+
+    def _drop(self, index: int, story_id: int):
+        worker = self._acquire(index)
+        try:
+            if story_id in worker.stories:
+                worker.stories.discard(story_id)
+                worker.connection.send(('drop', story_id))
+        except OSError:
+            pass
+        finally:
+            worker.lock.release()
+
+    def _acquire(self, index: int) -> _Worker:
+        """lock the current worker of the index (it might be replaced while waiting for the lock)"""
+        while True:
+            worker = self._workers[index]
+            worker.lock.acquire()
+            if self._workers[index] is worker:
+                return worker
+            worker.lock.release()
+
+    def submit(self, story_id: int, text: str, n_limit: int, on_phrase=None) -> Future:
+        """
+        add text to the story and request its continuation
+
+        :param text: the new text (e.g. the user's input)
+        :param n_limit: maximum number of new tokens
+        :param on_phrase: called with each phrase of the continuation as soon as it is generated
+            (on a thread of the pool)
+        :return: future of the whole continuation (never fails, if it is cut short it is the partial one,
+            or a canned one if nothing was generated)
+        """
+        deadline = monotonic() + self.deadline
+        return self._executor.submit(self._request, story_id, text, n_limit, on_phrase, deadline)
+
+    def _request(self, story_id, text, n_limit, on_phrase, deadline) -> str:
+        start = perf_counter()
+        with self._lock:
+            self.requests += 1
+            index = self._assignment[story_id]
+
+        phrases = []
+        def emit(phrase):
+            phrases.append(phrase)
+            if on_phrase is not None:
+                on_phrase(phrase)
+
+        # True if the continuation was cut short (deadline, failed or down worker),
+        # an empty continuation is fine otherwise (e.g. n_limit 0 or the model ended the text)
+        cut = True
+        worker = self._acquire(index)
+        try:
+            if worker.failed_at is not None or not worker.process.is_alive():
+                # down until the supervisor restarts it
+                count('generation_worker_down')
+            elif self._generate(worker, story_id, text, n_limit, deadline, emit):
+                with self._lock:
+                    self.timeouts += 1
+                count('generation_timeout')
+            else:
+                cut = False
+        except _WorkerFailed:
+            self._fail(worker)
+        finally:
+            worker.lock.release()
+
+        continuation = ''.join(phrases)
+        canned = cut and not continuation.strip()
+        if canned:
+            continuation = random.choice(canned_continuations)
+            emit(continuation)
+            with self._lock:
+                self.canned += 1
+            count('generation_canned')
+
+        with self._lock:
+            if story_id in self._history:
+                self._history[story_id] = (self._history[story_id] + text + continuation)[-max_history_chars:]
+                # a worker that has the story, but not the canned continuation, gets it with the next request
+                # (a new worker rebuilds the story from the history anyway)
+                if canned and story_id in self._workers[index].stories:
+                    self._unsent[story_id] += continuation
+        observe('generation_request', perf_counter() - start)
+        return continuation
+
+    def _generate(self, worker: _Worker, story_id, text, n_limit, deadline, emit) -> bool:
+        """
+        send the request and pass the phrases on until the worker is done (call with the worker's lock)
+
+        :return: True if the deadline stopped the generation
+        """
+        if not worker.wait_ready(deadline):
+            # still loading the model (e.g. right after startup or a restart)
+            return True
+        self._failures_in_row[worker.index] = 0
+
+        request_id = next(self._request_ids)
+        with self._lock:
+            if story_id in worker.stories:
+                history = None
+                text = self._unsent.get(story_id, '') + text
+            else:
+                # new story or new worker: the story so far is sent along
+                history = self._history.get(story_id, '')
+            if story_id in self._unsent:
+                self._unsent[story_id] = ''
+        try:
+            worker.connection.send(('generate', request_id, story_id, history, text, n_limit, deadline))
+        except OSError as e:
+            raise _WorkerFailed from e
+        worker.stories.add(story_id)
+
+        while True:
+            # the worker stops by itself at the deadline, after the grace time it is considered stuck
+            timeout = deadline + self.grace - monotonic()
+            try:
+                if timeout <= 0 or not worker.connection.poll(timeout):
+                    raise _WorkerFailed
+                message = worker.connection.recv()
+            except (EOFError, OSError) as e:
+                # the worker crashed
+                raise _WorkerFailed from e
+
+            if message[1] != request_id:
+                # (a late answer of an earlier request)
+                continue
+            if message[0] == 'phrase':
+                emit(message[2])
+            elif message[0] == 'done':
+                return monotonic() >= deadline
+
+    def _fail(self, worker: _Worker):
+        """stop a worker that crashed or did not answer in time (call with the worker's lock)"""
+        worker.stop()
+        worker.failed_at = monotonic()
+        with self._lock:
+            self.failures += 1
+            self._failures_in_row[worker.index] += 1
+        count('generation_worker_failed')
+        print(f'__story worker {worker.index} (pid {worker.process.pid}) failed with exit code {worker.process.exitcode}')
+
+    def _restart(self, worker: _Worker):
+        """replace a failed worker (call with the worker's lock), its stories are rebuilt from their history"""
+        with self._lock:
+            self.restarts += 1
+        count('generation_worker_restart')
+        self._workers[worker.index] = _Worker(worker.index, self._context, self.profile, self.threads)
+
+    def _supervise(self):
+        """restart failed workers, so the model is loaded again before the next request"""
+        while not self._closed.wait(self.check_interval):
+            for worker in list(self._workers):
+                if worker.failed_at is None and worker.process.is_alive():
+                    continue
+                if not worker.lock.acquire(blocking=False):
+                    # a request is using it, it finds out itself
+                    continue
+                try:
+                    if self._workers[worker.index] is not worker or self._closed.is_set():
+                        continue
+                    if worker.failed_at is None:
+                        # crashed while idle
+                        self._fail(worker)
+                    # 1, 2, 4, ... check intervals after the failure (at most 64)
+                    delay = self.check_interval * 2 ** min(self._failures_in_row[worker.index] - 1, 6)
+                    if monotonic() - worker.failed_at >= delay:
+                        self._restart(worker)
+                finally:
+                    worker.lock.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'workers': len(self._workers),
+                'ready': sum(worker.ready for worker in self._workers),
+                'stories': len(self._assignment),
+                'requests': self.requests,
+                'timeouts': self.timeouts,
+                'failures': self.failures,
+                'canned': self.canned,
+                'restarts': self.restarts,
+            }
+
+    def memory(self) -> list:
+        """
+        memory of the worker processes
+
+        :return: one dict per worker with its pid and rss, pss, uss and shared in MB (see models.process_memory_mb)
+        """
+        report = []
+        for worker in list(self._workers):
+            memory = process_memory_mb(worker.process.pid) if worker.process.is_alive() else None
+            report.append(dict(memory or {}, worker=worker.index, pid=worker.process.pid))
+        return report
+
+    def close(self):
+        self._closed.set()
+        self._executor.shutdown(wait=False)
+        for worker in self._workers:
+            worker.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='memory of the story workers (e.g. sharing memory-mapped weights)')
+    parser.add_argument('--workers', type=int, default=2, help='number of worker processes')
+    parser.add_argument('--profile', default='mmap', choices=list(inference_profiles),
+                        help='inference profile of the workers (see models.py)')
+    parser.add_argument('--tokens', type=int, default=20, help='tokens generated by each worker before measuring')
+    args = parser.parse_args()
+
+    # no deadline, the workers load the model first
+    pool = GenerationPool(args.workers, args.profile, deadline=600.0)
+    try:
+        # one story for each worker, so each has run the model and holds a kv cache
+        futures = [pool.submit(pool.new_story(), ' Once upon a time', args.tokens) for _ in range(args.workers)]
+        for future in futures:
+            future.result()
+
+        print(f'{"worker":<8}{"pid":>8}{"rss MB":>9}{"pss MB":>9}{"uss MB":>9}{"shared MB":>11}')
+        report = pool.memory()
+        for memory in report:
+            if 'rss' not in memory:
+                print(f'{memory["worker"]:<8}{memory["pid"]:>8}  (no memory information)')
+                continue
+            print(f'{memory["worker"]:<8}{memory["pid"]:>8}{memory["rss"]:>9.0f}{memory["pss"]:>9.0f}'
+                  f'{memory["uss"]:>9.0f}{memory["shared"]:>11.0f}')
+        # the pss add up to the memory the workers use together
+        print(f'total pss of the workers: {sum(memory.get("pss", 0) for memory in report):.0f} MB')
+    finally:
+        pool.close()
@@ -1,122 +1,133 @@
 #!/usr/bin/env python3
 
 """
-dialogue manager for the gamebox bot
+voice dialog loop of the gamebox bot (the dialog logic itself is in dialog.py)
 """
 
-from utils import asr, tts, rasa_parse, get_print_mode, set_print_mode
-from games import AnimalGame, FoodGame, WordSequenceGame, all_games_instructions
-from time import sleep
-import random
+from time import perf_counter
+# the startup time (until the greeting) is measured from here
+startup_start = perf_counter()
 
+from utils import asr, tts, tts_prepare, rasa_parse, get_print_mode, set_print_mode, set_asr_backend, wait_for_speech, warm_up
+from games import game_phrases
+from dialog import DialogManager, dialog_phrases
+from models import warm_up_gpt2, set_inference_profile, inference_profiles
+from speech_output import get_engine
+from vocabulary import store as vocabulary_store
+from metrics import metrics, Profiler
+from generation_pool import GenerationPool
+import argparse
 
-def confirm(text) -> bool:
-    """
-    ask the user for confirmation
 
-    :param text: the text to confirm
+def main(warm_up_model=True, generation_pool=None):
     """
-    tts(text)
-
-    user_input = asr()
-    if not user_input:
-        return False
-
-    affirmations = ['yes', 'yeah', 'yep', 'yup', 'sure', 'ok', 'okay']
-    user_input = user_input.lower().strip()
-
-    # if one of the affirmations is contained in user_input, return True
-    if any([True for affirmation in affirmations if affirmation in user_input]):
-        return True
-
-    return False
-
-def main():
-    # the currently running game
-    current_game = None 
+    :param warm_up_model: load the story model in the background right after the greeting
+        (otherwise only when the story game is chosen)
+    :param generation_pool: GenerationPool the story game generates in (None: in this process)
+    """
+    # the dialog logic, speaking with tts and parsing with rasa
+    # (if is in print mode, the intent and entity of each input is printed)
+    # the replies the games prepare ahead are synthesized while the user is speaking
+    story_options = {'pool': generation_pool} if generation_pool is not None else None
+    dialog = DialogManager(say=tts, parse=rasa_parse, debug=get_print_mode(), story_options=story_options,
+                           prepare=tts_prepare)
+
+    # give entry message (nothing heavy has been loaded so far: no torch, speech_recognition or requests)
+    dialog.start()
+    startup_time = perf_counter() - startup_start
+    metrics.observe('startup', startup_time)
+    print(f'__startup {startup_time:.2f}s until the greeting')
+
+    # everything else is prepared in the background while the greeting is spoken:
+    # the nlu client (local classifier and rasa client) and the asr
+    warm_up()
+
+    # load the game vocabularies now, so starting a game costs no i/o
+    vocabulary_store.preload()
+
+    # synthesize the canned phrases in the background, so they are played without any delay
+    if not get_print_mode():
+        get_engine().prerender_async(dialog_phrases + game_phrases())
+
+    # load the story game model in the background, so choosing the game later does not stall
+    # (the workers of a generation pool load their own)
+    if warm_up_model and generation_pool is None:
+        warm_up_gpt2()
 
-    # give entry message
-    tts('Hello! I am the gamebox bot. I can play three games with you: the animal, food or word sequence game. Which game would you like to play?')
-    
     # run an infinite loop (till stopped)
-    while True:
-        # get the user's input and
-        # parse what he/she said to get the intent and entity
-        user_input = asr()
-        if not user_input:
-            # sleep some time before asking the user to repeat, to avoid asking too often
-            sleep(5)
-            tts('I\'m sorry, I didn\'t understand that. Please try again. (asr)')
-            continue
-
-        intent, entity = rasa_parse(user_input)
-
-        # if is in print mode print the intent and entity
-        if get_print_mode():
-            print(f'__{intent}, {entity}')
-
-        # if the intent is None, the user's input could not be parsed
-        # and there is an error with the server
-        if not intent:
-            break
-
-        # if entity is None, we can assume that the user's input is the entity
-        # (or at least treat it as such for the games)
-        if entity is None:
-            entity = user_input.lower().strip()
-
-        # if intent is NLU_FALLBACK, the user's input could not be parsed
-        # and we should ask the user to repeat
-        if intent == 'nlu_fallback':
-            tts('I\'m sorry, I didn\'t understand that. Please try again. (nlu_fallback))')
-            continue
-        # if the intent is wait, the program will sleep a little for the user to think
-        # only if not in the word sequence game
-        elif intent == 'wait' and not isinstance(current_game, WordSequenceGame):
-            # don't always say the same thing here
-            tts(random.choice(['Okay. I will sleep a while and let you think.', 'I will give you some time to think.', 'I will wait a little.']))
-            tts('And tell you when I\'m back.')
-            sleep(20)  # sleep for n secs
-            tts('I\'m back. Have you thought of something?')
-            continue
-
-        if current_game == None:
-            # if we are not currently running a game, we can start a new one
-            if intent == 'choose_animal_game':
-                current_game = AnimalGame()
-            elif intent == 'choose_food_game':
-                current_game = FoodGame()
-            elif intent == 'choose_word_sequence_game':
-                current_game = WordSequenceGame()
-            elif intent == 'explain_rules':
-                tts(all_games_instructions)
-            elif intent == 'end_game':
-                tts('Okay! Goodbye!')
-                break
-            else:
-                tts('Sorry, I didn\'t understand that. Please say again which game you want to play.')
-        else:
-            # is in a game
-            # check if the intent is to stop the game or get the instructions
-            if intent == 'end_game':
-                if confirm('Do you really want to stop the game?'):
-                    current_game = None
-                    tts('Okay let\'s play another game. Which game would you like to play? We can play the animal, food or word sequence game.')
-                else:
-                    tts('Okay. I will continue the game.')
-            elif intent == 'explain_rules':
-                tts(current_game.instructions)
+    while not dialog.done:
+        # collect the time of each stage of the turn (asr, nlu, game, ...)
+        with metrics.turn() as stages:
+            start = perf_counter()
+            # get the user's input, but only until the pending timer of the dialog is due
+            # (e.g. the end of the thinking time), so no time is spent sleeping
+            # (a short pause ends a single word or a yes, a longer one a sentence of the story)
+            user_input = asr(timeout=dialog.timer_remaining(), expected_input=dialog.expected_input())
+            if user_input is None:
+                # the user did not speak until the timer was due
+                dialog.fire_timer(force=True)
+            elif not user_input:
+                # the user spoke, but nothing was recognized
+                dialog.handle_no_input()
             else:
-                # if the intent is not to stop the game or get the instructions,
-                # we can assume that the user wants to play the game
-                # if game.next_input is true, it is game over
-                if current_game.next_input(user_input, intent, entity):
-                    break
+                dialog.handle(user_input)
+            turn_time = perf_counter() - start
+        metrics.observe('turn', turn_time)
+
+        # show where the time of the turn went
+        print(f'__turn {turn_time:.2f}s: ' + ', '.join(f'{stage} {seconds:.2f}s' for stage, seconds in stages))
+
+    # speech is played in the background, let the last words be spoken before exiting
+    wait_for_speech()
 
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='gamebox bot')
+    parser.add_argument('--metrics-file', help='write the metrics (json) to this file every 10 seconds and at the end')
+    parser.add_argument('--metrics-port', type=int, help='serve the metrics for scraping on this local port (/metrics)')
+    parser.add_argument('--profile', choices=Profiler.modes, help='profile the session with cProfile or tracemalloc')
+    parser.add_argument('--profile-output', default='gamebox.prof', help='file the profile is written to')
+    parser.add_argument('--inference-profile', default='default', choices=list(inference_profiles),
+                        help='how the story model runs on the cpu (int8 quantization, distilgpt2, see models.py)')
+    parser.add_argument('--threads', type=int,
+                        help='intra-op threads of torch for the story model (default: the profile\'s, one per core)')
+    parser.add_argument('--no-warm-up', action='store_true',
+                        help='load the story model only when the story game is chosen (saves memory if it is never played)')
+    parser.add_argument('--generation-workers', type=int, default=0,
+                        help='generate the stories in this many worker processes (0: in the dialog process)')
+    parser.add_argument('--generation-deadline', type=float, default=5.0,
+                        help='seconds a story continuation of the workers may take, then the part generated so far is said')
+    args = parser.parse_args()
+
     # set print mode to True to use stdin/stdout instead of asr/tts
     set_print_mode(False)
-    # start game
-    main()
+    # 'google' recognizes in the cloud, use 'vosk' (or 'sphinx') to run without network access
+    set_asr_backend('google')
+    # before the model is warmed up
+    set_inference_profile(args.inference_profile, args.threads)
+
+    if args.metrics_file:
+        metrics.export_to_file(args.metrics_file)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+
+    # the workers start loading the model right away
+    generation_pool = None
+    if args.generation_workers:
+        generation_pool = GenerationPool(args.generation_workers, args.inference_profile, args.generation_deadline,
+                                         threads=args.threads)
+
+    profiler = Profiler(args.profile, args.profile_output) if args.profile else None
+    try:
+        if profiler:
+            profiler.start()
+        # start game
+        main(warm_up_model=not args.no_warm_up, generation_pool=generation_pool)
+    finally:
+        if generation_pool is not None:
+            generation_pool.close()
+        if profiler:
+            profiler.stop()
+        if args.metrics_file:
+            metrics.write_json(args.metrics_file)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+"""
+latency and resource instrumentation of the dialog pipeline
+
+every stage of a turn (asr, nlu, game, generation, tts) is timed with a span, the durations
+go into histograms. counters track cache hits, retries, fallbacks, ... . everything is kept
+in one process wide registry and can be written to a json file or scraped in the prometheus
+text format from a local http endpoint.
+
+    with span('nlu'):
+        result = parse(text)
+    count('nlu_cache_hit')
+
+for a closer look at one session, cProfile or tracemalloc can be switched on with Profiler.
+"""
+
+import cProfile
+import io
+import json
+import math
+import os
+import pstats
+import threading
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, sleep, time
+
+
+# upper bounds of the histogram buckets in seconds (from a cached tts phrase to a long asr phrase)
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# number of recent samples kept per histogram to compute exact percentiles
+recent_samples = 1024
+
+
+def percentile(values, q: float) -> float:
+    """q-th percentile (0-100) of the values (nearest rank: the smallest value with q% of the values up to it)"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, math.ceil(q * len(values) / 100) - 1))
+    return values[rank]
+
+
+class Histogram:
+    """bucketed durations (like a prometheus histogram) plus the most recent samples"""
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=recent_samples)
+
+    def observe(self, value: float):
+        # first bucket the value fits into (the last one is +Inf)
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self.recent.append(value)
+
+    def percentile(self, q: float) -> float:
+        """q-th percentile (0-100) of the recent samples"""
+        return percentile(self.recent, q)
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class Metrics:
+    """thread safe registry of counters and histograms"""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        # stages recorded for the current turn of each thread (see turn())
+        self._local = threading.local()
+
+        self._export_thread = None
+        self._http_server = None
+
+    def count(self, name: str, value=1):
+        """increase a counter"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float):
+        """record a duration"""
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+        stages = getattr(self._local, 'stages', None)
+        if stages is not None:
+            stages.append((name, seconds))
+
+    @contextmanager
+    def span(self, name: str):
+        """time the block (also if it raises) and record it in the histogram of the name"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start)
+
+    @contextmanager
+    def turn(self):
+        """
+        collect the spans of this thread during the block, e.g. to show where a turn's time went
+
+        :return: list of (stage, seconds), filled while the block runs
+        """
+        stages = []
+        previous = getattr(self._local, 'stages', None)
+        self._local.stages = stages
+        try:
+            yield stages
+        finally:
+            self._local.stages = previous
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'time': time(),
+                'counters': dict(self.counters),
+                'histograms': {name: histogram.summary() for name, histogram in self.histograms.items()},
+            }
+
+    def write_json(self, path: str):
+        """write a snapshot to a file (replaced as a whole, so readers never see half of it)"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(tmp_path, path)
+
+    def prometheus(self) -> str:
+        """all metrics in the prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                lines += [f'# TYPE gamebox_{name}_total counter', f'gamebox_{name}_total {value}']
+            for name, histogram in sorted(self.histograms.items()):
+                metric = f'gamebox_{name}_seconds'
+                lines.append(f'# TYPE {metric} histogram')
+                cumulative = 0
+                for bound, bucket_count in zip(histogram.buckets, histogram.counts):
+                    cumulative += bucket_count
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+                lines += [f'{metric}_sum {histogram.sum}', f'{metric}_count {histogram.count}']
+        return '\n'.join(lines) + '\n'
+
+    def export_to_file(self, path: str, interval=10.0) -> threading.Thread:
+        """write a snapshot to the file every interval seconds (in the background)"""
+        def run():
+            while True:
+                sleep(interval)
+                self.write_json(path)
+
+        if self._export_thread is None:
+            self._export_thread = threading.Thread(target=run, name='metrics-export', daemon=True)
+            self._export_thread.start()
+        return self._export_thread
+
+    def serve(self, port=9105, host='127.0.0.1'):
+        """serve the metrics for scraping at http://host:port/metrics (json at /metrics.json)"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = metrics.prometheus().encode('utf-8'), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = json.dumps(metrics.snapshot()).encode('utf-8'), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        if self._http_server is None:
+            self._http_server = ThreadingHTTPServer((host, port), Handler)
+            self._http_server.daemon_threads = True
+            threading.Thread(target=self._http_server.serve_forever, name='metrics-server', daemon=True).start()
+        return self._http_server
+
+
+class Profiler:
+    """
+    cProfile or tracemalloc for a whole session
+
+    cProfile only sees the thread it was started on (the dialog loop),
+    tracemalloc sees the allocations of all threads
+    """
+
+    modes = ('cprofile', 'tracemalloc')
+
+    def __init__(self, mode: str, output: str, top=25):
+        """
+        :param mode: 'cprofile' or 'tracemalloc'
+        :param output: file the results are written to (pstats file for cProfile, text for tracemalloc)
+        :param top: number of entries printed when stopping
+        """
+        if mode not in self.modes:
+            raise ValueError(f'unknown profiler {mode}, use one of {self.modes}')
+        self.mode = mode
+        self.output = output
+        self.top = top
+        self._profile = None
+
+    def start(self):
+        if self.mode == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            # keep a few frames, so allocations can be told apart by their callers
+            tracemalloc.start(10)
+
+    def stop(self):
+        """stop profiling, write the results and print a summary"""
+        if self.mode == 'cprofile':
+            self._profile.disable()
+            self._profile.dump_stats(self.output)
+            summary = io.StringIO()
+            pstats.Stats(self._profile, stream=summary).sort_stats('cumulative').print_stats(self.top)
+            print(summary.getvalue())
+        else:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            statistics = snapshot.statistics('lineno')
+            with open(self.output, 'w', encoding='utf-8') as f:
+                f.write(f'current {current / 2 ** 20:.1f} MB, peak {peak / 2 ** 20:.1f} MB\n')
+                for statistic in statistics:
+                    f.write(f'{statistic}\n')
+            print(f'__tracemalloc current {current / 2 ** 20:.1f} MB, peak {peak / 2 ** 20:.1f} MB')
+            for statistic in statistics[:self.top]:
+                print(f'  {statistic}')
+
+        print(f'__profile written to {self.output}')
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+# the registry shared by the whole process
+metrics = Metrics()
+
+
+def span(name: str):
+    """time a stage, e.g. with span('nlu'): ..."""
+    return metrics.span(name)
+
+
+def count(name: str, value=1):
+    """increase a counter"""
+    metrics.count(name, value)
+
+
+def observe(name: str, seconds: float):
+    """record a duration measured elsewhere"""
+    metrics.observe(name, seconds)
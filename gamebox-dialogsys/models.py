@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+
+"""
+process wide registry for the language models used by the games
+
+the GPT-2 tokenizer and model are loaded only once per process and the same
+instances are handed to every caller (e.g. every WordSequenceGame)
+
+how the model runs on the cpu is chosen with an inference profile (checkpoint, int8
+quantization, number of threads), `./models.py --benchmark` compares the profiles.
+
+with a memory-mapped profile the weights are exported once to a read-only file, which every process
+maps instead of loading its own copy, so all processes of a host share the same physical pages
+(see process_memory_mb for the memory each process has for itself).
+"""
+
+import argparse
+import fcntl
+import gc
+import json
+import os
+import subprocess
+import sys
+import threading
+import resource
+from time import perf_counter
+
+
+# name of the pretrained checkpoint used for the story game
+default_model_name = 'gpt2'
+
+# directory of the exported (memory-mapped) weights
+base_dir = os.path.dirname(os.path.abspath(__file__))
+shared_weights_dir = os.path.join(base_dir, 'models')
+
+
+class InferenceProfile:
+    """how the story model is run on the cpu"""
+
+    def __init__(self, name: str, model_name=default_model_name, quantize=False, threads=None, mmap=False):
+        """
+        :param name: name of the profile
+        :param model_name: pretrained checkpoint (e.g. 'distilgpt2' has half of gpt2's layers)
+        :param quantize: dynamically quantize the linear layers to int8 (weights are stored in int8,
+            activations are quantized on the fly)
+        :param threads: number of intra-op threads of torch (None: torch's default, one per core)
+        :param mmap: map the weights from a read-only file shared by all processes (see load_shared_gpt2)
+        """
+        if mmap and quantize:
+            # quantizing creates new weights in each process, there would be nothing left to share
+            raise ValueError('a memory-mapped profile can not be quantized')
+        self.name = name
+        self.model_name = model_name
+        self.quantize = quantize
+        self.threads = threads
+        self.mmap = mmap
+
+    def __repr__(self):
+        return (f'InferenceProfile({self.name!r}, model_name={self.model_name!r}, quantize={self.quantize}, '
+                f'threads={self.threads}, mmap={self.mmap})')
+
+
+# the selectable profiles
+inference_profiles = {profile.name: profile for profile in [
+    InferenceProfile('default'),
+    InferenceProfile('int8', quantize=True),
+    InferenceProfile('distil', model_name='distilgpt2'),
+    InferenceProfile('distil-int8', model_name='distilgpt2', quantize=True),
+    InferenceProfile('mmap', mmap=True),
+    InferenceProfile('distil-mmap', model_name='distilgpt2', mmap=True),
+]}
+default_profile = 'default'
+
+
+def resident_memory_mb() -> float:
+    """
+    get the current resident memory of this process
+
+    :return: resident set size in MB (falls back to the peak rss if /proc is not available)
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in KB on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def process_memory_mb(pid='self'):
+    """
+    get the memory of a process from /proc/<pid>/smaps_rollup
+
+    pages shared with other processes (e.g. memory-mapped weights) count fully in rss, split between
+    the processes in pss and not at all in uss, so the uss is what the process costs on its own
+
+    :param pid: process id ('self': this process)
+    :return: dict of rss, pss, uss and shared in MB (None if /proc is not available)
+    """
+    fields = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup', 'r') as f:
+            for line in f:
+                parts = line.split()
+                # e.g. 'Pss:   123456 kB'
+                if len(parts) == 3 and parts[2] == 'kB':
+                    fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    except (OSError, ValueError):
+        return None
+
+    return {
+        'rss': fields.get('Rss', 0.0),
+        'pss': fields.get('Pss', 0.0),
+        'uss': fields.get('Private_Clean', 0.0) + fields.get('Private_Dirty', 0.0),
+        'shared': fields.get('Shared_Clean', 0.0) + fields.get('Shared_Dirty', 0.0),
+    }
+
+
+def shared_weights_path(model_name: str) -> str:
+    """directory of the exported weights of a checkpoint (config.json and weights.pt)"""
+    return os.path.join(shared_weights_dir, f'{model_name}.mmap')
+
+
+def export_shared_weights(model_name: str) -> str:
+    """
+    export the weights of a pretrained checkpoint to a read-only file that can be memory-mapped
+    (once, later calls return right away)
+
+    the processes of a host may call this at the same time, only the first exports
+
+    :return: directory of the exported weights
+    """
+    path = shared_weights_path(model_name)
+    weights_file = os.path.join(path, 'weights.pt')
+    if os.path.exists(weights_file):
+        return path
+
+    os.makedirs(shared_weights_dir, exist_ok=True)
+    with open(path + '.lock', 'w') as lock:
+        # the others wait here until the first has exported
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(weights_file):
+            return path
+
+        import torch
+        from transformers import GPT2LMHeadModel
+
+        start = perf_counter()
+        model = GPT2LMHeadModel.from_pretrained(model_name)
+        os.makedirs(path, exist_ok=True)
+        model.config.save_pretrained(path)
+        # written under another name first, so no process maps a half written file
+        # (the tied output and input embeddings share one storage in the file)
+        temporary_file = weights_file + '.tmp'
+        torch.save(model.state_dict(), temporary_file)
+        os.chmod(temporary_file, 0o444)
+        os.replace(temporary_file, weights_file)
+        print(f'__exported {model_name} to {path} in {perf_counter() - start:.2f}s')
+
+    return path
+
+
+def load_shared_gpt2(model_name: str):
+    """
+    load GPT-2 with its weights memory-mapped from the exported file (see export_shared_weights)
+
+    the weights are not copied: the parameters point to the pages of the file, which the kernel keeps
+    once for all processes. the model never writes to them (it is only used for inference),
+    so the copy-on-write mapping stays shared, each process only has its activations and kv caches
+
+    :return: the model (in eval mode without gradients)
+    """
+    import torch
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    path = export_shared_weights(model_name)
+    config = GPT2Config.from_pretrained(path)
+    # the modules without memory for their parameters (the mapped tensors are assigned instead)
+    with torch.device('meta'):
+        model = GPT2LMHeadModel(config)
+    state_dict = torch.load(os.path.join(path, 'weights.pt'), mmap=True, weights_only=True, map_location='cpu')
+    model.load_state_dict(state_dict, assign=True)
+    model.tie_weights()
+    model.eval()
+    model.requires_grad_(False)
+    return model
+
+
+def conv1d_to_linear(model):
+    """
+    replace the Conv1D layers of GPT-2 by equivalent nn.Linear layers (in place)
+
+    GPT-2 implements its projections with transformers' Conv1D (a linear layer with transposed
+    weights), which dynamic quantization does not know, so they are converted first
+    """
+    import torch
+    from transformers.pytorch_utils import Conv1D
+
+    for parent in list(model.modules()):
+        for child_name, child in list(parent.named_children()):
+            if isinstance(child, Conv1D):
+                n_in, n_out = child.weight.shape
+                linear = torch.nn.Linear(n_in, n_out)
+                with torch.no_grad():
+                    linear.weight.copy_(child.weight.t())
+                    linear.bias.copy_(child.bias)
+                setattr(parent, child_name, linear)
+    return model
+
+
+def quantize_int8(model):
+    """dynamic int8 quantization of all linear layers (including the output layer)"""
+    import torch
+    from torch.ao.quantization import quantize_dynamic
+
+    # in place, a copy would keep both models in memory while quantizing
+    return quantize_dynamic(conv1d_to_linear(model), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+class ModelRegistry:
+    """
+    loads tokenizer and model once and shares them between all callers
+
+    loading is thread safe, so the models can be warmed up on a background thread
+    while the dialog is already running
+    """
+
+    def __init__(self, profile=default_profile):
+        """
+        :param profile: name of an inference profile or an InferenceProfile
+        """
+        self.profile = inference_profiles[profile] if isinstance(profile, str) else profile
+        self.model_name = self.profile.model_name
+        self._tokenizer = None
+        self._model = None
+        self._lock = threading.Lock()
+        self._warm_up_thread = None
+
+        # load statistics (filled after loading)
+        self.load_time = None
+        self.memory_before_load = None
+        self.memory_after_load = None
+
+    def is_loaded(self) -> bool:
+        return self._model is not None
+
+    def _load(self):
+        """load tokenizer and model (has to be called with the lock held)"""
+
+        # import here, so that only the first load pays for it
+        import torch
+        from transformers import GPT2Tokenizer, GPT2LMHeadModel
+
+        self.memory_before_load = resident_memory_mb()
+        start = perf_counter()
+
+        if self.profile.threads:
+            torch.set_num_threads(self.profile.threads)
+
+        self._tokenizer = GPT2Tokenizer.from_pretrained(self.model_name)
+        if self.profile.mmap:
+            model = load_shared_gpt2(self.model_name)
+        else:
+            model = GPT2LMHeadModel.from_pretrained(self.model_name)
+        # we only do inference, never training
+        model.eval()
+        model.requires_grad_(False)
+        if self.profile.quantize:
+            model = quantize_int8(model)
+            # the replaced float layers are part of reference cycles, free them right away
+            gc.collect()
+        self._model = model
+
+        self.load_time = perf_counter() - start
+        self.memory_after_load = resident_memory_mb()
+
+        memory = process_memory_mb()
+        print(f'__loaded {self.model_name} ({self.profile.name}) in {self.load_time:.2f}s, '
+              f'resident memory {self.memory_before_load:.0f} MB -> {self.memory_after_load:.0f} MB'
+              + (f' (unique {memory["uss"]:.0f} MB)' if memory else ''))
+
+    def get(self):
+        """
+        get the shared tokenizer and model, loading them if needed
+
+        :return: tokenizer, model
+        """
+        # fast path without locking once loaded
+        if self._model is None:
+            with self._lock:
+                # check again, another thread might have loaded in the meantime
+                if self._model is None:
+                    self._load()
+
+        return self._tokenizer, self._model
+
+    def warm_up(self) -> threading.Thread:
+        """
+        start loading the models on a background (daemon) thread
+
+        :return: the thread doing the loading
+        """
+        with self._lock:
+            if self._warm_up_thread is None and self._model is None:
+                self._warm_up_thread = threading.Thread(target=self.get, name='model-warm-up', daemon=True)
+                self._warm_up_thread.start()
+
+        return self._warm_up_thread
+
+    def stats(self) -> dict:
+        """report load time and resident memory"""
+        memory = process_memory_mb() or {}
+        return {
+            'profile': self.profile.name,
+            'model': self.model_name,
+            'loaded': self.is_loaded(),
+            'load_time_s': self.load_time,
+            'memory_before_load_mb': self.memory_before_load,
+            'memory_after_load_mb': self.memory_after_load,
+            'memory_now_mb': resident_memory_mb(),
+            # without and with the pages shared with other processes (e.g. memory-mapped weights)
+            'unique_memory_mb': memory.get('uss'),
+            'proportional_memory_mb': memory.get('pss'),
+        }
+
+
+# the registry shared by the whole process
+registry = ModelRegistry()
+
+
+def set_inference_profile(profile, threads=None):
+    """
+    choose how the story model is run (before it is loaded, e.g. at startup)
+
+    :param profile: name of an inference profile (see inference_profiles) or an InferenceProfile
+    :param threads: number of intra-op threads of torch, overrides the one of the profile
+        (e.g. to leave cores to other processes on the host)
+    """
+    global registry
+    if isinstance(profile, str):
+        if profile not in inference_profiles:
+            raise ValueError(f'unknown inference profile {profile}, use one of {list(inference_profiles)}')
+        profile = inference_profiles[profile]
+    if threads:
+        profile = InferenceProfile(profile.name, profile.model_name, profile.quantize, threads, profile.mmap)
+    # games that already got the old model keep it, the next ones get the new one
+    registry = ModelRegistry(profile)
+
+
+def get_gpt2():
+    """
+    get the process wide GPT-2 tokenizer and model
+
+    :return: tokenizer, model
+    """
+    return registry.get()
+
+
+def warm_up_gpt2() -> threading.Thread:
+    """start loading GPT-2 in the background"""
+    return registry.warm_up()
+
+
+def measure_profile(profile: str, threads=None, prompt_tokens=128, new_tokens=64, repeats=3) -> dict:
+    """
+    load the model with the profile and measure greedy generation speed and memory
+
+    (run once per process, so the memory of the profiles does not add up)
+
+    :param threads: override the number of threads of the profile
+    """
+    import torch
+    from story import StoryGenerator
+
+    set_inference_profile(profile, threads)
+    tokenizer, model = get_gpt2()
+
+    # a fixed prompt of prompt_tokens tokens
+    text = 'Once upon a time there was a little fox who lived in a dark forest. '
+    prompt_ids = (tokenizer.encode(text) * prompt_tokens)[:prompt_tokens]
+
+    # the first run warms up (allocations, kernel selection)
+    times = []
+    for i in range(repeats + 1):
+        story = StoryGenerator(tokenizer, model)
+        story.pending_ids = list(prompt_ids)
+        start = perf_counter()
+        generated = 0
+        # keep going if the model ends the text early
+        while generated < new_tokens:
+            n = len(list(story.generate_ids(new_tokens - generated)))
+            if n == 0:
+                story.add_text(' and')
+            generated += n
+        if i > 0:
+            times.append(perf_counter() - start)
+
+    return dict(registry.stats(), threads=torch.get_num_threads(), prompt_tokens=prompt_tokens,
+                new_tokens=new_tokens, tokens_per_s=new_tokens / min(times),
+                peak_memory_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def benchmark_profiles(profiles, **options):
+    """
+    measure each profile in its own process and print a comparison
+
+    :param options: keyword arguments of measure_profile
+    """
+    results = []
+    for profile in profiles:
+        command = [sys.executable, os.path.abspath(__file__), '--measure', profile, '--options', json.dumps(options)]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f'{"profile":<14}{"model":<12}{"threads":>8}{"load s":>8}{"model MB":>10}{"peak MB":>9}{"tok/s":>8}')
+    for result in results:
+        print(f'{result["profile"]:<14}{result["model"]:<12}{result["threads"]:>8}{result["load_time_s"]:>8.2f}'
+              f'{result["memory_after_load_mb"] - result["memory_before_load_mb"]:>10.0f}'
+              f'{result["peak_memory_mb"]:>9.0f}{result["tokens_per_s"]:>8.1f}')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare the inference profiles of the story model')
+    parser.add_argument('--benchmark', nargs='*', metavar='PROFILE',
+                        help=f'profiles to compare (default: all of {list(inference_profiles)})')
+    parser.add_argument('--threads', type=int, help='override the number of threads of all profiles')
+    parser.add_argument('--prompt-tokens', type=int, default=128)
+    parser.add_argument('--new-tokens', type=int, default=64)
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    parser.add_argument('--options', default='{}', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        # one profile in this process (started by benchmark_profiles), the result is the last line
+        print(json.dumps(measure_profile(args.measure, **json.loads(args.options))))
+    else:
+        benchmark_profiles(args.benchmark or list(inference_profiles), threads=args.threads,
+                           prompt_tokens=args.prompt_tokens, new_tokens=args.new_tokens)
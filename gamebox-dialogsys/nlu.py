@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+"""
+natural language understanding (NLU) client for the rasa server
+
+uses one pooled keep-alive session with connect/read deadlines and bounded retries.
+a circuit breaker stops asking a failing server for a while, the parse then degrades
+to the nlu_fallback intent instead of ending the dialog.
+"""
+
+import copy
+import json
+import re
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import count, span
+
+
+# intent rasa gives when it is not confident enough, also used when the server can not be reached
+fallback_intent = 'nlu_fallback'
+
+
+class NLUResult:
+    """result of parsing one utterance"""
+
+    def __init__(self, text, intent, confidence=0.0, entities=None, intent_ranking=None, source='rasa'):
+        self.text = text
+        self.intent = intent
+        self.confidence = confidence
+        # list of dicts with at least 'entity' and 'value'
+        self.entities = entities if entities is not None else []
+        # list of (intent, confidence), most probable first
+        self.intent_ranking = intent_ranking if intent_ranking is not None else [(intent, confidence)]
+        # where the result came from (e.g. 'rasa' or 'fallback')
+        self.source = source
+
+    @property
+    def entity(self):
+        """value of the first entity (None if there is none)"""
+        return self.entities[0]['value'] if self.entities else None
+
+    @classmethod
+    def from_rasa(cls, text, parsed_data: dict, source='rasa'):
+        """create the result from the json of rasa's /model/parse"""
+        intent = parsed_data.get('intent') or {}
+        ranking = [(item['name'], item.get('confidence', 0.0)) for item in parsed_data.get('intent_ranking', [])]
+        return cls(text, intent.get('name'), intent.get('confidence', 0.0),
+                   parsed_data.get('entities', []), ranking or None, source)
+
+    @classmethod
+    def fallback(cls, text):
+        """result used when the text could not be parsed at all"""
+        return cls(text, fallback_intent, 0.0, source='fallback')
+
+    def __repr__(self):
+        return f'NLUResult({self.text!r}, intent={self.intent!r}, confidence={self.confidence:.2f}, entity={self.entity!r})'
+
+
+class CircuitBreaker:
+    """
+    stops calls to a failing service for a while
+
+    after failure_threshold failures in a row the breaker opens and calls are not allowed
+    for reset_timeout seconds, then one trial call is allowed (half open)
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if monotonic() - self.opened_at >= self.reset_timeout:
+                # half open: let the next call try again (and reopen at once if it fails)
+                self.opened_at = None
+                self.failures = self.failure_threshold - 1
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = monotonic()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+
+class CountingRetry(Retry):
+    """urllib3 retry policy that counts the retries in the metrics"""
+
+    def increment(self, *args, **kwargs):
+        retry = super().increment(*args, **kwargs)
+        count('rasa_retry')
+        return retry
+
+
+class RasaClient:
+    """client for the rasa NLU http api"""
+
+    def __init__(self, url='http://localhost:5005', connect_timeout=1.0, read_timeout=3.0, retries=2,
+                 backoff_factor=0.1, pool_size=10, breaker=None, status_timeout=0.5):
+        """
+        :param url: base url of the rasa server
+        :param connect_timeout: seconds to wait for the connection
+        :param read_timeout: seconds to wait for the response
+        :param retries: number of retries on connection errors and 5xx responses
+        :param backoff_factor: retries wait backoff_factor * 2^(retry - 1) seconds
+        :param pool_size: number of kept-alive connections
+        :param breaker: circuit breaker to use (a default one if None)
+        :param status_timeout: seconds the status request may take (connect and read, it is not retried)
+        """
+        self.url = url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+
+        retry = CountingRetry(total=retries, connect=retries, read=retries, status=retries,
+                      backoff_factor=backoff_factor, status_forcelist=(500, 502, 503, 504),
+                      # parsing does not change anything on the server, so POST can be retried
+                      allowed_methods=frozenset(['GET', 'POST']), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # the status is polled while parsing, so it gets a single short attempt on its own connection
+        self.status_timeout = status_timeout
+        status_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0)
+        self.status_session = requests.Session()
+        self.status_session.mount('http://', status_adapter)
+        self.status_session.mount('https://', status_adapter)
+
+        # number of parses that degraded to the fallback intent
+        self.fallbacks = 0
+
+    def parse(self, text: str) -> NLUResult:
+        """
+        parse the text with the rasa model
+
+        :return: the result, with the fallback intent if the server could not be reached
+        """
+        if not self.breaker.allow():
+            self.fallbacks += 1
+            count('rasa_breaker_open')
+            count('rasa_fallback')
+            return NLUResult.fallback(text)
+
+        try:
+            with span('rasa_request'):
+                response = self.session.post(f'{self.url}/model/parse', json={'text': text}, timeout=self.timeout)
+                response.raise_for_status()
+                result = NLUResult.from_rasa(text, response.json())
+        except (requests.RequestException, ValueError) as e:
+            self.breaker.record_failure()
+            self.fallbacks += 1
+            count('rasa_fallback')
+            print(f'__rasa NLU server error: {e}')
+            return NLUResult.fallback(text)
+
+        self.breaker.record_success()
+        return result
+
+    def status(self) -> dict:
+        """get the status of the server (contains the fingerprint of the loaded model)"""
+        response = self.status_session.get(f'{self.url}/status', timeout=self.status_timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def close(self):
+        self.session.close()
+        self.status_session.close()
+
+
+def normalize_text(text: str) -> str:
+    """normalize an utterance for caching (case, surrounding punctuation and whitespace)"""
+    text = re.sub(r'\s+', ' ', text.lower())
+    return text.strip(' .,!?;:\'"')
+
+
+class NLUCache:
+    """LRU cache of parse results with an optional time to live"""
+
+    def __init__(self, max_size=1024, ttl=None):
+        """
+        :param max_size: maximum number of cached results
+        :param ttl: seconds a result stays valid (None for no expiry)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                result, stored_at = entry
+                if self.ttl is None or monotonic() - stored_at < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return result
+                # expired
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, result):
+        with self._lock:
+            self._entries[key] = (result, monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate, 'size': len(self)}
+
+
+class CachingParser:
+    """
+    memoizes the parses of a client by normalized text and the fingerprint of the loaded model
+
+    the fingerprint is checked every fingerprint_interval seconds, when the server loaded
+    a new model, the cache is cleared
+    """
+
+    def __init__(self, client: RasaClient, cache=None, fingerprint_interval=10.0):
+        self.client = client
+        self.cache = cache if cache is not None else NLUCache()
+        self.fingerprint_interval = fingerprint_interval
+        self.fingerprint = None
+        self._fingerprint_checked_at = None
+        # number of times the cache was cleared because of a new model
+        self.invalidations = 0
+
+    def _model_fingerprint(self):
+        now = monotonic()
+        if self._fingerprint_checked_at is not None and now - self._fingerprint_checked_at < self.fingerprint_interval:
+            return self.fingerprint
+        self._fingerprint_checked_at = now
+
+        # the server is failing, do not wait for it (the parse falls back anyway)
+        breaker = self.client.breaker
+        if not breaker.allow():
+            return self.fingerprint
+
+        try:
+            with span('rasa_status'):
+                status = self.client.status()
+            fingerprint = json.dumps([status.get('model_id'), status.get('model_file'), status.get('fingerprint')],
+                                     sort_keys=True)
+        except (requests.RequestException, ValueError):
+            # keep the last known model if the status can not be fetched
+            breaker.record_failure()
+            count('rasa_status_error')
+            return self.fingerprint
+        breaker.record_success()
+
+        if fingerprint != self.fingerprint:
+            if self.fingerprint is not None:
+                self.cache.clear()
+                self.invalidations += 1
+            self.fingerprint = fingerprint
+
+        return self.fingerprint
+
+    def parse(self, text: str) -> NLUResult:
+        key = (normalize_text(text), self._model_fingerprint())
+
+        cached = self.cache.get(key)
+        count('nlu_cache_hit' if cached is not None else 'nlu_cache_miss')
+        if cached is not None:
+            result = copy.copy(cached)
+            result.text = text
+            result.source = 'cache'
+            return result
+
+        result = self.client.parse(text)
+        # do not remember that the server could not be reached
+        if result.source != 'fallback':
+            self.cache.put(key, result)
+        return result
+
+    def stats(self) -> dict:
+        return dict(self.cache.stats(), invalidations=self.invalidations)
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+
+"""
+throughput, latency and accuracy benchmark of the nlu
+
+the examples of data/nlu.yml are expanded into a workload: every example as written, the game
+answers additionally with other items of the game data in place of their annotated entity, plus some
+out of domain utterances that should end up as nlu_fallback. the workload is replayed by a number
+of concurrent callers against one of the backends:
+
+    local   the in-process classifier of fast_nlu.py
+    rasa    a rasa server (--url), without any cache
+    hybrid  what the bot uses: local classifier, cache and rasa client (see utils.get_nlu_client)
+
+without --url, rasa is replaced by a local stand-in server answering with the in-process
+classifier (and --stand-in-latency per request), so the http path can be measured without rasa.
+
+reported per concurrency are the queries per second, the latency percentiles (overall and per
+intent), the intent and entity accuracy at rasa's fallback threshold (overall and per intent) and
+how the accuracy and the fallback rate change with the threshold, e.g.
+
+    ./nlu_benchmark.py --backend hybrid --concurrency 1 4 16 --repeat 3
+
+the accuracy is measured on held-out examples: a part of the examples of every intent (--holdout)
+is left out when training the classifier (of the local backend and the stand-in server), the
+latency is measured on the whole workload. a real rasa server (--url) was trained on all examples,
+so its accuracy is the accuracy on the training set (as is the accuracy with --holdout 0).
+most of the workload are game answers, so the accuracy of each intent is reported as well.
+"""
+
+import argparse
+import json
+import random
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+
+from benchmark import FakeRasaServer
+from fast_nlu import LocalIntentClassifier, HybridParser, default_training_data, load_training_data
+from metrics import metrics, percentile
+from nlu import RasaClient, CachingParser, fallback_intent
+from vocabulary import get_vocabulary, store as vocabulary_store
+
+
+# threshold of rasa's FallbackClassifier (config.yml)
+default_fallback_threshold = 0.3
+
+# thresholds the accuracy and the fallback rate are reported for
+default_thresholds = (0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9)
+
+# utterances none of the intents is meant for
+out_of_domain = [
+    'what is the weather like tomorrow',
+    'turn on the lights in the kitchen',
+    'who won the football match yesterday',
+    'please set an alarm for seven',
+    'how much does a train ticket to berlin cost',
+    'can you order a pizza for me',
+    'what time is it in new york',
+    'remind me to call my mother',
+]
+
+backends = ('local', 'rasa', 'hybrid')
+
+
+def split_examples(examples, holdout=0.2, seed=0) -> tuple:
+    """
+    split the examples into training and held-out examples, the same fraction of every intent
+
+    (every intent keeps at least one training example)
+
+    :param holdout: fraction of the examples that are held out
+    :return: training examples, held-out examples
+    """
+    rng = random.Random(seed)
+    by_intent = defaultdict(list)
+    for example in examples:
+        by_intent[example[1]].append(example)
+
+    training, held_out = [], []
+    for intent, group in sorted(by_intent.items()):
+        rng.shuffle(group)
+        n_held_out = min(len(group) - 1, int(round(holdout * len(group))))
+        held_out += group[:n_held_out]
+        training += group[n_held_out:]
+    return training, held_out
+
+
+def expand_workload(examples, answers_per_example=5, seed=0, held_out=()) -> list:
+    """
+    the utterances of the benchmark with the intent (and entity) expected for them
+
+    :param examples: (text, intent, entities) like fast_nlu.load_training_data returns them
+    :param answers_per_example: variants of each example with an entity, with other items of the game data
+    :param held_out: the examples the classifier was not trained on
+    :return: list of dicts with text, intent, entity (None if there is none) and seen
+        (False if the utterance is new to the classifier: from a held-out example or out of domain)
+    """
+    held_out = {(text, intent) for text, intent, _ in held_out}
+    rng = random.Random(seed)
+    items = sorted({word for category in vocabulary_store.categories()
+                    for letter in get_vocabulary(category).letters()
+                    for word in get_vocabulary(category).words(letter)})
+
+    workload = []
+    for text, intent, entities in examples:
+        entity = entities[0][0] if entities else None
+        # (the variants with other items keep the sentence of the example, so they count as seen as well)
+        seen = (text, intent) not in held_out
+        workload.append({'text': text, 'intent': intent, 'entity': entity, 'seen': seen})
+
+        if entity is None or not items:
+            continue
+        for _ in range(answers_per_example):
+            # the same sentence with another item (every mention of the annotated one is replaced)
+            item = rng.choice(items)
+            workload.append({'text': text.replace(entity, item), 'intent': intent, 'entity': item, 'seen': seen})
+
+    workload += [{'text': text, 'intent': fallback_intent, 'entity': None, 'seen': False} for text in out_of_domain]
+    return workload
+
+
+class ClassifierRasaServer(FakeRasaServer):
+    """stand-in for rasa's http api answering with the in-process classifier"""
+
+    def __init__(self, classifier: LocalIntentClassifier, latency=0.0, fallback_threshold=default_fallback_threshold):
+        """
+        :param classifier: the classifier answering the requests
+        :param latency: seconds each parse takes additionally (to simulate the real model)
+        :param fallback_threshold: below this confidence the intent is nlu_fallback (like rasa's FallbackClassifier)
+        """
+        super().__init__([], latency)
+        self.classifier = classifier
+        self.fallback_threshold = fallback_threshold
+
+    def parse(self, text: str) -> dict:
+        # (parsing only reads the classifier, so the request threads can share it)
+        result = self.classifier.parse(text)
+        ranking = [{'name': intent, 'confidence': confidence} for intent, confidence in result.intent_ranking]
+        intent = {'name': result.intent, 'confidence': result.confidence}
+        if result.confidence < self.fallback_threshold:
+            # like rasa: the fallback comes first, the ranking of the model stays
+            intent = {'name': fallback_intent, 'confidence': self.fallback_threshold}
+            ranking.insert(0, intent)
+        return {'text': text, 'intent': intent, 'entities': result.entities, 'intent_ranking': ranking}
+
+
+def make_parser(backend: str, url: str, classifier: LocalIntentClassifier):
+    """
+    :return: the parser (anything with parse(text) -> NLUResult)
+    """
+    if backend == 'local':
+        # the classifier only reads its weights while parsing, so it can be shared by the callers
+        return classifier
+    if backend == 'rasa':
+        return RasaClient(url)
+    if backend == 'hybrid':
+        return HybridParser(classifier, CachingParser(RasaClient(url)))
+    raise ValueError(f'unknown backend {backend}, use one of {backends}')
+
+
+def model_prediction(result) -> tuple:
+    """
+    the best intent of the model, ignoring its fallback threshold (rasa puts nlu_fallback in front)
+
+    :return: intent, confidence
+    """
+    for intent, confidence in result.intent_ranking:
+        if intent != fallback_intent:
+            return intent, confidence
+    return fallback_intent, 0.0
+
+
+def accuracy(samples, threshold: float) -> dict:
+    """
+    how well the intents are recognized if everything below the threshold is a fallback
+
+    :param samples: list of (expected intent, best intent of the model, its confidence)
+    """
+    correct = fallbacks = in_domain = wrong_fallbacks = 0
+    for expected, intent, confidence in samples:
+        predicted = intent if confidence >= threshold else fallback_intent
+        correct += predicted == expected
+        fallbacks += predicted == fallback_intent
+        if expected != fallback_intent:
+            in_domain += 1
+            wrong_fallbacks += predicted == fallback_intent
+    return {
+        'threshold': threshold,
+        'accuracy': correct / len(samples) if samples else 0.0,
+        'fallback_rate': fallbacks / len(samples) if samples else 0.0,
+        # utterances the bot would have understood, but asked to repeat
+        'false_fallback_rate': wrong_fallbacks / in_domain if in_domain else 0.0,
+    }
+
+
+def latency_stats(values) -> dict:
+    """latency summary in milliseconds"""
+    values = [1000 * value for value in values]
+    stats = {'n': len(values), 'mean': sum(values) / len(values) if values else 0.0}
+    for q in (50, 90, 95, 99):
+        stats[f'p{q}'] = percentile(values, q)
+    stats['max'] = max(values) if values else 0.0
+    return stats
+
+
+def run_load(parser, workload, concurrency=1, repeat=1, seed=0, fallback_threshold=default_fallback_threshold,
+             thresholds=default_thresholds) -> dict:
+    """
+    replay the workload with concurrent callers
+
+    :param parser: anything with parse(text) -> NLUResult
+    :param concurrency: number of callers parsing at the same time
+    :param repeat: times the (shuffled) workload is replayed
+    :return: the report
+    """
+    rng = random.Random(seed)
+    requests = []
+    for _ in range(repeat):
+        rng.shuffle(workload)
+        requests += workload
+
+    results = [None] * len(requests)
+    next_request = iter(range(len(requests)))
+    next_lock = threading.Lock()
+
+    def caller():
+        while True:
+            with next_lock:
+                index = next(next_request, None)
+            if index is None:
+                return
+            start = perf_counter()
+            result = parser.parse(requests[index]['text'])
+            results[index] = (perf_counter() - start, result)
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='nlu-caller') as executor:
+        for future in [executor.submit(caller) for _ in range(concurrency)]:
+            future.result()
+    wall = perf_counter() - start
+
+    latencies = defaultdict(list)
+    backend_fallbacks = 0
+    for request, (seconds, result) in zip(requests, results):
+        latencies['all'].append(seconds)
+        latencies[f'intent:{request["intent"]}'].append(seconds)
+        backend_fallbacks += result.source == 'fallback'
+
+    # the accuracy on the utterances new to the classifier (if there are any besides the out of domain ones),
+    # of one replay (the others give the same results)
+    held_out = any(not request['seen'] and request['intent'] != fallback_intent for request in workload)
+    samples = []
+    entities_correct = entities_expected = 0
+    for request, (seconds, result) in zip(requests[:len(workload)], results):
+        if held_out and request['seen']:
+            continue
+        intent, confidence = model_prediction(result)
+        samples.append((request['intent'], intent, confidence))
+        if request['entity'] is not None:
+            entities_expected += 1
+            entities_correct += (result.entity or '').lower().strip() == request['entity'].lower()
+
+    # mistakes at the configured threshold, e.g. to see which examples are ambiguous
+    confusions = defaultdict(int)
+    per_intent = defaultdict(lambda: [0, 0])
+    for expected, intent, confidence in samples:
+        predicted = intent if confidence >= fallback_threshold else fallback_intent
+        per_intent[expected][0] += predicted == expected
+        per_intent[expected][1] += 1
+        if predicted != expected:
+            confusions[f'{expected} -> {predicted}'] += 1
+
+    return {
+        'requests': len(requests),
+        'concurrency': concurrency,
+        'wall_s': wall,
+        'qps': len(requests) / wall if wall else 0.0,
+        'latency_ms': {name: latency_stats(values) for name, values in sorted(latencies.items())},
+        'evaluated_on': 'held-out' if held_out else 'training set',
+        'evaluated': len(samples),
+        'intent': accuracy(samples, fallback_threshold),
+        # (most of the workload are game answers, so the other intents are shown on their own)
+        'intent_accuracy': {intent: {'accuracy': correct / total, 'n': total}
+                            for intent, (correct, total) in sorted(per_intent.items())},
+        # mean of the intents (each intent counts the same)
+        'intent_macro_accuracy': (sum(correct / total for correct, total in per_intent.values()) / len(per_intent)
+                                  if per_intent else 0.0),
+        'entity_accuracy': entities_correct / entities_expected if entities_expected else 0.0,
+        # the server could not be reached (not the fallback of the model)
+        'unreachable': backend_fallbacks,
+        'thresholds': [accuracy(samples, threshold) for threshold in thresholds],
+        'confusions': dict(sorted(confusions.items(), key=lambda item: -item[1])),
+    }
+
+
+def run_benchmark(backend='local', url=None, concurrency=(1,), repeat=1, seed=0, answers_per_example=5,
+                  fallback_threshold=default_fallback_threshold, stand_in_latency=0.0,
+                  training_data=default_training_data, holdout=0.2) -> dict:
+    """
+    build the workload and replay it against the backend at each concurrency
+
+    :param url: url of the rasa server (None: a local stand-in server)
+    :param stand_in_latency: seconds each request to the stand-in server takes additionally
+    :param holdout: fraction of the examples of each intent the classifier is not trained on
+        (to measure the accuracy on them, 0: train on all, like the bot)
+    """
+    examples = load_training_data(training_data)
+    if holdout and (backend == 'local' or url is None):
+        # (not saved, the bot keeps the classifier trained on all examples)
+        training, held_out = split_examples(examples, holdout, seed)
+        classifier = LocalIntentClassifier().train(training)
+    else:
+        # a real rasa server knows all examples anyway
+        held_out = []
+        classifier = LocalIntentClassifier.load_or_train(training_data)
+    workload = expand_workload(examples, answers_per_example, seed, held_out)
+
+    stand_in = None
+    if backend != 'local' and url is None:
+        stand_in = ClassifierRasaServer(classifier, stand_in_latency, fallback_threshold)
+        url = stand_in.start()
+
+    report = {'backend': backend, 'url': url, 'stand_in': stand_in is not None, 'workload': len(workload),
+              'held_out_examples': len(held_out), 'fallback_threshold': fallback_threshold, 'runs': []}
+    try:
+        for callers in concurrency:
+            # a new parser per run, so the cache of the hybrid parser starts empty every time
+            parser = make_parser(backend, url, classifier)
+            # one request first, so connecting (or loading) is not part of the measurement
+            parser.parse(workload[0]['text'])
+            report['runs'].append(run_load(parser, list(workload), callers, repeat, seed, fallback_threshold))
+            if hasattr(parser, 'stats'):
+                report['runs'][-1]['parser'] = parser.stats()
+            if hasattr(parser, 'close'):
+                parser.close()
+            # let the connections of the last run close before the next one
+            sleep(0.1)
+    finally:
+        if stand_in is not None:
+            stand_in.stop()
+
+    report['metrics'] = metrics.snapshot()
+    return report
+
+
+def print_report(report: dict):
+    target = report['url'] if report['backend'] != 'local' else 'in process'
+    print(f'backend {report["backend"]} ({target}{", stand-in" if report["stand_in"] else ""}), '
+          f'{report["workload"]} utterances ({report["held_out_examples"]} examples held out), '
+          f'fallback threshold {report["fallback_threshold"]}')
+    for run in report['runs']:
+        intent = run['intent']
+        print(f'\nconcurrency {run["concurrency"]}: {run["requests"]} requests in {run["wall_s"]:.2f}s, {run["qps"]:.1f} qps, '
+              f'{run["evaluated_on"]} intent accuracy {intent["accuracy"]:.3f} (mean of the intents '
+              f'{run["intent_macro_accuracy"]:.3f}, fallbacks {intent["fallback_rate"]:.3f}), '
+              f'entity accuracy {run["entity_accuracy"]:.3f}'
+              + (f', {run["unreachable"]} unreachable' if run['unreachable'] else ''))
+        print(f'{"latency (ms)":<34}{"n":>6}{"mean":>9}{"p50":>9}{"p90":>9}{"p95":>9}{"p99":>9}{"max":>9}')
+        for name, stats in run['latency_ms'].items():
+            print(f'{name:<34}{stats["n"]:>6}' + ''.join(f'{stats[key]:>9.2f}' for key in ('mean', 'p50', 'p90', 'p95', 'p99', 'max')))
+        if 'parser' in run:
+            print(f'parser: {run["parser"]}')
+
+    # the accuracy does not depend on the concurrency, so the sweep is shown once
+    if report['runs']:
+        run = report['runs'][0]
+        print(f'\naccuracy on the {run["evaluated_on"]} utterances ({run["evaluated"]})')
+        print(f'{"threshold":>9}{"accuracy":>10}{"fallbacks":>11}{"false fallbacks":>17}')
+        for row in run['thresholds']:
+            print(f'{row["threshold"]:>9.2f}{row["accuracy"]:>10.3f}{row["fallback_rate"]:>11.3f}{row["false_fallback_rate"]:>17.3f}')
+        print('intent accuracy: ' + ', '.join(f'{name} {value["accuracy"]:.3f} (n={value["n"]})'
+                                              for name, value in run['intent_accuracy'].items()))
+        if run['confusions']:
+            print('mistakes: ' + ', '.join(f'{name} ({number})' for name, number in run['confusions'].items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='replay the examples of data/nlu.yml against the nlu and report qps, latency and accuracy')
+    parser.add_argument('--backend', default='local', choices=backends,
+                        help='local: in-process classifier, rasa: rasa server, hybrid: the parser the bot uses')
+    parser.add_argument('--url', help='url of the rasa server (default: a local stand-in server)')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1], help='numbers of concurrent callers to run with')
+    parser.add_argument('--repeat', type=int, default=1, help='times the workload is replayed per run')
+    parser.add_argument('--answers', type=int, default=5, help='variants with other items per annotated example')
+    parser.add_argument('--fallback-threshold', type=float, default=default_fallback_threshold)
+    parser.add_argument('--stand-in-latency', type=float, default=0.0, help='simulated seconds per request of the stand-in server')
+    parser.add_argument('--holdout', type=float, default=0.2,
+                        help='fraction of the examples of each intent held out of training to measure the accuracy on '
+                             '(0: accuracy on the training set)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args()
+
+    report = run_benchmark(args.backend, args.url, args.concurrency, args.repeat, args.seed, args.answers,
+                           args.fallback_threshold, args.stand_in_latency, holdout=args.holdout)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
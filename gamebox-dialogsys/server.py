@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+"""
+dialog server for many users at once
+
+every connection gets its own dialog session (current game, story, ...), all sessions share
+the nlu client and the language model. the protocol is json lines over a local tcp socket:
+
+    client -> server: {"text": "let's play the animal game"}
+                      (optionally with "session": <id> to continue an earlier session)
+    server -> client: {"session": <id>, "say": "Good choice! ..."}   (one per utterance of the bot)
+                      {"session": <id>, "done": false}               (the input has been handled)
+"""
+
+import argparse
+import asyncio
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+from batching import get_batch_scheduler
+from dialog import DialogManager
+from metrics import metrics, span
+from models import inference_profiles, set_inference_profile
+from utils import rasa_parse
+from vocabulary import store as vocabulary_store
+
+
+class Session:
+    """state of one dialog, independent of the connection it is used from"""
+
+    def __init__(self, session_id: str, loop: asyncio.AbstractEventLoop):
+        self.id = session_id
+        self.loop = loop
+        # the connection the bot's utterances are sent to (None while disconnected)
+        self.writer = None
+        # inputs of one session are handled one after another
+        self.lock = asyncio.Lock()
+        self.last_active = monotonic()
+
+        # the story continuations of all sessions are generated in shared batches
+        self.dialog = DialogManager(say=self.say, parse=rasa_parse, story_options={'batcher': get_batch_scheduler()})
+        # the event loop's handle for firing the dialog's timer (no thread waits for it)
+        self.timer_handle = None
+
+    def send(self, message: dict):
+        """send a message to the client (only call from the event loop)"""
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write((json.dumps(message) + '\n').encode('utf-8'))
+
+    def say(self, text: str):
+        """output of the dialog, called from the worker threads"""
+        if text:
+            self.loop.call_soon_threadsafe(self.send, {'session': self.id, 'say': text})
+
+
+class DialogServer:
+    """asyncio server holding the sessions"""
+
+    def __init__(self, workers=8, session_timeout=30 * 60):
+        """
+        :param workers: number of threads the dialogs are handled on (nlu requests and text generation block)
+        :param session_timeout: seconds after which an inactive session is dropped
+        """
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dialog')
+        self.session_timeout = session_timeout
+        self.sessions = {}
+
+    def _get_session(self, session_id, loop):
+        """
+        get the session with the id or create a new one
+
+        :return: session, True if it was created
+        """
+        session = self.sessions.get(session_id) if session_id else None
+        if session is not None:
+            return session, False
+
+        session = Session(uuid.uuid4().hex, loop)
+        self.sessions[session.id] = session
+        return session, True
+
+    async def _run(self, function, *args):
+        """run blocking dialog code on the worker threads"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def _arm_timer(self, session: Session):
+        """let the event loop fire the dialog's pending timer (e.g. the end of the thinking time) when it is due"""
+        if session.timer_handle is not None:
+            session.timer_handle.cancel()
+            session.timer_handle = None
+
+        remaining = session.dialog.timer_remaining()
+        if remaining is not None:
+            session.timer_handle = session.loop.call_later(
+                remaining, lambda: asyncio.ensure_future(self._fire_timer(session)))
+
+    async def _fire_timer(self, session: Session):
+        async with session.lock:
+            session.timer_handle = None
+            # the timer might have been replaced or dropped by an input in the meantime
+            if session.dialog.fire_timer():
+                session.last_active = monotonic()
+                # firing can schedule the next timer
+                self._arm_timer(session)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        session = None
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    writer.write(b'{"error": "invalid json"}\n')
+                    continue
+
+                # the first message decides the session (a new one unless an existing id is given)
+                if session is None or message.get('session', session.id) != session.id:
+                    if session is not None:
+                        session.writer = None
+                    session, created = self._get_session(message.get('session'), loop)
+                    session.writer = writer
+                    if created:
+                        session.dialog.start()
+
+                text = message.get('text', '').strip()
+                async with session.lock:
+                    session.last_active = monotonic()
+                    if text:
+                        with span('turn'):
+                            await self._run(session.dialog.handle, text)
+                    session.send({'session': session.id, 'done': session.dialog.done})
+                    self._arm_timer(session)
+
+                await writer.drain()
+                if session.dialog.done:
+                    self.sessions.pop(session.id, None)
+                    break
+        finally:
+            if session is not None and session.writer is writer:
+                session.writer = None
+            writer.close()
+
+    async def expire_sessions(self):
+        """drop sessions that have been inactive for too long"""
+        while True:
+            await asyncio.sleep(60)
+            now = monotonic()
+            for session_id, session in list(self.sessions.items()):
+                if session.writer is None and now - session.last_active > self.session_timeout:
+                    if session.timer_handle is not None:
+                        session.timer_handle.cancel()
+                    del self.sessions[session_id]
+
+    async def serve(self, host='127.0.0.1', port=5006):
+        # load the game data before the first session starts
+        vocabulary_store.preload()
+
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f'__serving dialogs on {host}:{port}')
+        expiry = asyncio.create_task(self.expire_sessions())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            expiry.cancel()
+            self.executor.shutdown(wait=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='serve gamebox dialogs as json lines over tcp')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5006)
+    parser.add_argument('--workers', type=int, default=8, help='threads for nlu requests and text generation')
+    parser.add_argument('--metrics-port', type=int, help='serve the metrics for scraping on this local port (/metrics)')
+    parser.add_argument('--inference-profile', default='default', choices=list(inference_profiles),
+                        help='how the story model runs on the cpu (int8 quantization, distilgpt2, see models.py)')
+    parser.add_argument('--threads', type=int,
+                        help='intra-op threads of torch for the story model (default: the profile\'s, one per core)')
+    args = parser.parse_args()
+
+    set_inference_profile(args.inference_profile, args.threads)
+
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+
+    asyncio.run(DialogServer(workers=args.workers).serve(args.host, args.port))
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+
+"""
+speech input (ASR) for the dialog manager
+
+listening is done chunk by chunk here (instead of speech_recognition's Recognizer.listen),
+so the dialog can react as soon as the user starts to talk, e.g. to stop the bot's speech (barge-in),
+and the phrase is handed to the recognizer as soon as the voice activity detection hears it end.
+
+how long a pause ends the phrase depends on what the dialog expects (see endpointing_presets):
+a single word or a yes needs a much shorter pause than a sentence of a story.
+"""
+
+import collections
+import json
+import math
+import os
+from array import array
+from time import perf_counter
+
+import speech_recognition as sr
+
+from metrics import count, observe
+
+
+# speech_recognition (3.11 and newer) raises this if a backend is not installed or misses its model
+SetupError = getattr(getattr(sr, 'exceptions', None), 'SetupError', sr.RequestError)
+
+# sample rate vosk models are trained on
+vosk_sample_rate = 16000
+
+
+class Endpointing:
+    """when a phrase is over"""
+
+    def __init__(self, name: str, pause_threshold: float, phrase_time_limit=None, phrase_threshold=0.3):
+        """
+        :param name: name of the setting
+        :param pause_threshold: seconds of silence that end the phrase
+        :param phrase_time_limit: seconds after which the phrase is cut (None: no limit)
+        :param phrase_threshold: seconds of speech a phrase needs at least (shorter sounds are ignored)
+        """
+        self.name = name
+        self.pause_threshold = pause_threshold
+        self.phrase_time_limit = phrase_time_limit
+        self.phrase_threshold = phrase_threshold
+
+    def __repr__(self):
+        return (f'Endpointing({self.name!r}, pause_threshold={self.pause_threshold}, '
+                f'phrase_time_limit={self.phrase_time_limit}, phrase_threshold={self.phrase_threshold})')
+
+
+# the settings for what the dialog expects next (see DialogManager.expected_input)
+endpointing_presets = {endpointing.name: endpointing for endpointing in [
+    # anything (e.g. choosing a game), speech_recognition's defaults
+    Endpointing('default', pause_threshold=0.8),
+    # a single entity (e.g. an animal), said in one go
+    Endpointing('answer', pause_threshold=0.4, phrase_time_limit=4.0),
+    # yes or no
+    Endpointing('confirmation', pause_threshold=0.35, phrase_time_limit=2.5),
+    # a sentence of a story, the user may pause to think in the middle
+    Endpointing('story', pause_threshold=1.2, phrase_time_limit=20.0),
+]}
+
+
+def get_endpointing(endpointing) -> Endpointing:
+    """
+    :param endpointing: name of a preset or an Endpointing
+    """
+    if isinstance(endpointing, Endpointing):
+        return endpointing
+    if endpointing not in endpointing_presets:
+        raise ValueError(f'unknown endpointing {endpointing}, use one of {list(endpointing_presets)}')
+    return endpointing_presets[endpointing]
+
+
+def rms(frame: bytes) -> float:
+    """root mean square energy of a chunk of signed 16 bit audio"""
+    samples = array('h', frame[:len(frame) & ~1])
+    if not samples:
+        return 0.0
+    return math.sqrt(sum(sample * sample for sample in samples) / len(samples))
+
+
+class EnergyVAD:
+    """voice activity detection by the energy threshold of the recognizer (calibrated for the ambient noise)"""
+
+    # any chunk size and sample rate
+    sample_rate = None
+    chunk_size = None
+
+    def __init__(self, recognizer: sr.Recognizer):
+        self.recognizer = recognizer
+
+    def is_speech(self, chunk: bytes) -> bool:
+        return rms(chunk) > self.recognizer.energy_threshold
+
+
+class WebRTCVAD:
+    """
+    voice activity detection of webrtc (the webrtcvad package has to be installed)
+
+    tells speech from noise by its spectrum, not only by its loudness,
+    so the end of the speech is found reliably even with short pauses and a noisy room
+    """
+
+    # webrtc takes 10, 20 or 30 ms of 8, 16, 32 or 48 kHz audio
+    sample_rate = 16000
+    chunk_size = 480
+
+    def __init__(self, aggressiveness=2):
+        """
+        :param aggressiveness: 0 (counts most as speech) to 3 (counts least as speech)
+        """
+        import webrtcvad
+        self.vad = webrtcvad.Vad(aggressiveness)
+
+    def is_speech(self, chunk: bytes) -> bool:
+        return self.vad.is_speech(chunk, self.sample_rate)
+
+
+def listen(recognizer: sr.Recognizer, source: sr.Microphone, on_speech_start=None, start_threshold_factor=None,
+           timeout=None, endpointing=None, vad=None):
+    """
+    record one phrase from the (opened) microphone
+
+    works like recognizer.listen (same energy threshold and pause settings),
+    but calls on_speech_start as soon as the user starts to talk,
+    and the pause that ends the phrase can be chosen for each call
+
+    :param recognizer: the recognizer with the energy threshold and pause settings to use
+    :param source: the opened microphone
+    :param on_speech_start: called (without arguments) once speech has been detected
+    :param start_threshold_factor: callable returning a factor for the energy threshold to detect
+                                   the start of speech (e.g. higher while the bot is speaking, so
+                                   its own voice does not trigger a barge-in)
+    :param timeout: seconds to wait for speech to start (None: wait forever)
+    :param endpointing: name of a preset or an Endpointing, when the phrase is over
+        (None: the pause settings of the recognizer)
+    :param vad: voice activity detection telling speech chunks from silence (None: EnergyVAD)
+    :return: the recorded phrase as sr.AudioData
+    :raises sr.WaitTimeoutError: if no speech started within timeout seconds
+    """
+    if endpointing is None:
+        endpointing = Endpointing('recognizer', recognizer.pause_threshold, None, recognizer.phrase_threshold)
+    else:
+        endpointing = get_endpointing(endpointing)
+    if vad is None:
+        vad = EnergyVAD(recognizer)
+
+    seconds_per_chunk = source.CHUNK / source.SAMPLE_RATE
+    # chunks of silence kept before the speech starts
+    pre_roll = collections.deque(maxlen=max(1, int(math.ceil(recognizer.non_speaking_duration / seconds_per_chunk))))
+    pause_chunks = int(math.ceil(endpointing.pause_threshold / seconds_per_chunk))
+    phrase_chunks = int(math.ceil(endpointing.phrase_threshold / seconds_per_chunk))
+    # the phrase is cut after this many chunks (counted from the start of the speech)
+    limit_chunks = (int(math.ceil(endpointing.phrase_time_limit / seconds_per_chunk))
+                    if endpointing.phrase_time_limit else None)
+    waited = 0.0
+
+    while True:
+        # wait for the speech to start
+        while True:
+            if timeout is not None and waited > timeout:
+                raise sr.WaitTimeoutError('listening timed out while waiting for phrase to start')
+            chunk = source.stream.read(source.CHUNK)
+            waited += seconds_per_chunk
+            pre_roll.append(chunk)
+            factor = start_threshold_factor() if start_threshold_factor else 1.0
+            # loud enough (louder while the bot is speaking) and speech for the vad
+            if rms(chunk) > recognizer.energy_threshold * factor and vad.is_speech(chunk):
+                break
+
+        if on_speech_start:
+            on_speech_start()
+
+        # record until the user pauses (or the phrase is too long)
+        frames = list(pre_roll)
+        speech_chunks = 1
+        silent_chunks = 0
+        recorded_chunks = 1
+        while silent_chunks < pause_chunks:
+            if limit_chunks is not None and recorded_chunks >= limit_chunks:
+                count('asr_phrase_limit')
+                break
+            chunk = source.stream.read(source.CHUNK)
+            frames.append(chunk)
+            recorded_chunks += 1
+            if vad.is_speech(chunk):
+                speech_chunks += 1
+                silent_chunks = 0
+            else:
+                silent_chunks += 1
+
+        # too short to be a phrase (e.g. a click), wait for the next one
+        if speech_chunks >= phrase_chunks:
+            break
+        pre_roll.clear()
+
+    # drop most of the trailing silence
+    trailing = max(0, silent_chunks - len(pre_roll))
+    if trailing:
+        frames = frames[:-trailing]
+
+    return sr.AudioData(b''.join(frames), source.SAMPLE_RATE, source.SAMPLE_WIDTH)
+
+
+class ASRSession:
+    """
+    speech recognition session that is kept for the whole dialog
+
+    the microphone is opened and calibrated for ambient noise only once.
+    recognition can be done offline (vosk, sphinx) or with the google cloud api.
+    """
+
+    # backends that work without network access
+    offline_backends = ('vosk', 'sphinx')
+
+    def __init__(self, backend='google', fallback_backend=None, language='en-US', vosk_model_path='model',
+                 calibration_duration=1.0, vad='energy'):
+        """
+        :param backend: 'google' (cloud), 'vosk' or 'sphinx' (offline)
+        :param fallback_backend: backend to try if the first one fails with an error (e.g. no network)
+        :param language: language of the speech (only used by google and sphinx)
+        :param vosk_model_path: directory of the vosk model (only used by vosk)
+        :param calibration_duration: seconds of ambient noise to listen to when opening the microphone
+        :param vad: voice activity detection finding the end of the speech,
+            'energy' (the energy threshold) or 'webrtc' (needs the webrtcvad package)
+        """
+        self.backend = backend
+        self.fallback_backend = fallback_backend
+        self.language = language
+        self.vosk_model_path = vosk_model_path
+        self.calibration_duration = calibration_duration
+
+        self.recognizer = sr.Recognizer()
+        # the vosk model (loaded by open, vosk is run directly, as speech_recognition's
+        # recognize_vosk loads the model again on every call and only from its own directory)
+        self._vosk_model = None
+        if vad == 'energy':
+            self.vad = EnergyVAD(self.recognizer)
+        elif vad == 'webrtc':
+            self.vad = WebRTCVAD()
+        else:
+            raise ValueError(f'unknown vad {vad}, use energy or webrtc')
+        self._microphone = None
+        self._source = None
+
+        # timing (seconds) and error of the last call
+        self.last_timing = {}
+        self.last_error = None
+        # True if the last call ended because the user did not speak in time
+        self.timed_out = False
+        # number of calls and errors per backend
+        self.calls = collections.Counter()
+        self.errors = collections.Counter()
+
+    def open(self):
+        """open the microphone and calibrate the energy threshold for the ambient noise"""
+        if self._source is not None:
+            return
+
+        if 'vosk' in (self.backend, self.fallback_backend):
+            # load the model once, before the first phrase
+            try:
+                self._load_vosk_model()
+            except sr.RequestError as e:
+                # reported again with each phrase (the fallback backend is used instead)
+                print(f'__asr error (vosk: {e})')
+
+        # (the webrtc vad needs its sample rate and chunks of 30 ms)
+        self._microphone = sr.Microphone(sample_rate=self.vad.sample_rate, chunk_size=self.vad.chunk_size or 1024)
+        self._source = self._microphone.__enter__()
+
+        start = perf_counter()
+        self.recognizer.adjust_for_ambient_noise(self._source, duration=self.calibration_duration)
+        print(f'__calibrated microphone in {perf_counter() - start:.2f}s, '
+              f'energy threshold {self.recognizer.energy_threshold:.0f}')
+
+    def close(self):
+        if self._microphone is not None:
+            self._microphone.__exit__(None, None, None)
+            self._microphone = None
+            self._source = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _load_vosk_model(self):
+        """
+        :return: the vosk model (loaded on the first call)
+        :raises sr.RequestError: if vosk is not installed or the model can not be loaded
+        """
+        if self._vosk_model is None:
+            try:
+                from vosk import Model
+            except ImportError as e:
+                raise sr.RequestError('vosk is not installed (pip install vosk)') from e
+            if not os.path.isdir(self.vosk_model_path):
+                raise sr.RequestError(f'no vosk model in {self.vosk_model_path}')
+            try:
+                self._vosk_model = Model(self.vosk_model_path)
+            except Exception as e:
+                # (vosk raises a plain Exception if the model is broken)
+                raise sr.RequestError(f'can not load the vosk model in {self.vosk_model_path}: {e}') from e
+        return self._vosk_model
+
+    def _recognize_vosk(self, audio: sr.AudioData) -> str:
+        # (raises the RequestError if vosk is not installed)
+        model = self._load_vosk_model()
+        from vosk import KaldiRecognizer
+
+        recognizer = KaldiRecognizer(model, vosk_sample_rate)
+        recognizer.AcceptWaveform(audio.get_raw_data(convert_rate=vosk_sample_rate, convert_width=2))
+        # the result is a json string
+        text = json.loads(recognizer.FinalResult()).get('text', '')
+        if not text:
+            raise sr.UnknownValueError()
+        return text
+
+    def _recognize_with(self, backend: str, audio: sr.AudioData) -> str:
+        if backend == 'google':
+            return self.recognizer.recognize_google(audio, language=self.language)
+        elif backend == 'vosk':
+            return self._recognize_vosk(audio)
+        elif backend == 'sphinx':
+            return self.recognizer.recognize_sphinx(audio, language=self.language)
+        else:
+            raise ValueError(f'unknown asr backend {backend}')
+
+    def recognize(self, audio: sr.AudioData):
+        """
+        recognize recorded audio (falls back to the fallback backend on errors)
+
+        :return: the recognized text or None if nothing was recognized
+        """
+        self.last_error = None
+        backends = [self.backend] + ([self.fallback_backend] if self.fallback_backend else [])
+
+        for backend in backends:
+            self.calls[backend] += 1
+            try:
+                return self._recognize_with(backend, audio)
+            except sr.UnknownValueError:
+                # speech was not understood, no other backend will do better on it
+                self.last_error = f'{backend}: speech not understood'
+                return None
+            except (sr.RequestError, SetupError, OSError, ValueError) as e:
+                # (e.g. no network, a backend that is not installed or an answer that can not be read)
+                self.errors[backend] += 1
+                count('asr_error')
+                self.last_error = f'{backend}: {e}'
+                print(f'__asr error ({self.last_error})')
+
+        return None
+
+    def listen_and_recognize(self, on_speech_start=None, start_threshold_factor=None, timeout=None,
+                             endpointing='default'):
+        """
+        record one phrase and recognize it
+
+        :param on_speech_start: see listen
+        :param start_threshold_factor: see listen
+        :param timeout: see listen
+        :param endpointing: see listen (e.g. 'answer' if a single word is expected)
+        :return: the recognized text or None (also if the user did not speak within timeout)
+        """
+        self.open()
+        self.timed_out = False
+
+        start = perf_counter()
+        try:
+            audio = listen(self.recognizer, self._source, on_speech_start, start_threshold_factor, timeout,
+                           endpointing, self.vad)
+        except sr.WaitTimeoutError:
+            self.timed_out = True
+            self.last_error = None
+            self.last_timing = {'listen': perf_counter() - start, 'recognize': 0.0, 'audio': 0.0}
+            return None
+        listened = perf_counter()
+        text = self.recognize(audio)
+        recognized = perf_counter()
+
+        self.last_timing = {'listen': listened - start, 'recognize': recognized - listened,
+                            'audio': len(audio.frame_data) / (audio.sample_rate * audio.sample_width)}
+        observe('asr_listen', self.last_timing['listen'])
+        observe('asr_recognize', self.last_timing['recognize'])
+        if text is None:
+            count('asr_no_result')
+        return text
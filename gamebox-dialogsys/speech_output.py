@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+
+"""
+speech output (TTS) for the dialog manager
+
+espeak is only started to synthesize text that is not cached yet, the audio is kept in
+an LRU cache keyed by (text, voice, rate) and played through one long-lived aplay process.
+the text is passed to espeak on stdin and never through a shell.
+"""
+
+import queue
+import struct
+import subprocess
+import threading
+from collections import OrderedDict
+from time import perf_counter
+
+from metrics import count, observe, span
+
+
+class Audio:
+    """synthesized audio: raw signed 16 bit little endian pcm"""
+
+    def __init__(self, pcm: bytes, sample_rate: int, channels=1):
+        self.pcm = pcm
+        self.sample_rate = sample_rate
+        self.channels = channels
+
+    @property
+    def bytes_per_second(self) -> int:
+        return self.sample_rate * self.channels * 2
+
+    @property
+    def duration(self) -> float:
+        return len(self.pcm) / self.bytes_per_second
+
+
+def parse_wav(data: bytes) -> Audio:
+    """
+    get the pcm data out of a wav file as written by espeak --stdout
+
+    (the wave module can not be used, espeak does not fill in the sizes when writing to a pipe)
+
+    :param data: the wav file content
+    :return: the audio
+    """
+    if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        raise ValueError('not a wav file')
+
+    sample_rate, channels = 22050, 1
+    pos = 12
+    while pos + 8 <= len(data):
+        chunk_id = data[pos:pos + 4]
+        chunk_size = struct.unpack('<I', data[pos + 4:pos + 8])[0]
+        if chunk_id == b'fmt ':
+            channels, sample_rate = struct.unpack('<HI', data[pos + 10:pos + 16])
+        elif chunk_id == b'data':
+            # the size may be bogus, so just take everything after the header
+            return Audio(data[pos + 8:], sample_rate, channels)
+        pos += 8 + chunk_size
+
+    raise ValueError('wav file has no data chunk')
+
+
+class EspeakSynthesizer:
+    """synthesizes text to audio with espeak"""
+
+    def __init__(self, executable='espeak'):
+        self.executable = executable
+
+    def synthesize(self, text: str, voice='en', rate=150) -> Audio:
+        # text goes through stdin, so no quoting is needed and text can not be mistaken for an option
+        result = subprocess.run([self.executable, '-v', voice, '-s', str(rate), '--stdout', '--stdin'],
+                                input=text.encode('utf-8'), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                check=True)
+        return parse_wav(result.stdout)
+
+
+class AudioPlayer:
+    """plays raw pcm through one aplay process that is kept open between utterances"""
+
+    # amount of audio written at once
+    chunk_seconds = 0.1
+
+    def __init__(self, executable='aplay'):
+        self.executable = executable
+        self._process = None
+        self._format = None
+
+    def _get_process(self, audio: Audio):
+        audio_format = (audio.sample_rate, audio.channels)
+        # (re)start aplay if it is not running or the format changed
+        if self._process is None or self._process.poll() is not None or self._format != audio_format:
+            self.close()
+            self._process = subprocess.Popen([self.executable, '-q', '-t', 'raw', '-f', 'S16_LE',
+                                              '-r', str(audio.sample_rate), '-c', str(audio.channels), '-'],
+                                             stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                             stderr=subprocess.DEVNULL)
+            self._format = audio_format
+        return self._process
+
+    def play(self, audio: Audio, cancel_event=None) -> bool:
+        """
+        play the audio and block until it has been played
+
+        :param cancel_event: if given and set while playing, playback stops as soon as possible
+        :return: True if the audio was played completely, False if it was cancelled
+        """
+        if not audio.pcm:
+            return True
+
+        cancel_event = cancel_event if cancel_event is not None else threading.Event()
+        process = self._get_process(audio)
+        start = perf_counter()
+        chunk_size = int(audio.bytes_per_second * self.chunk_seconds) & ~1
+
+        for pos in range(0, len(audio.pcm), chunk_size):
+            if cancel_event.is_set():
+                self.stop()
+                return False
+            process.stdin.write(audio.pcm[pos:pos + chunk_size])
+            process.stdin.flush()
+
+        # aplay buffers a little, so wait until the audio should have been played
+        if cancel_event.wait(max(0.0, start + audio.duration - perf_counter())):
+            self.stop()
+            return False
+
+        return True
+
+    def stop(self):
+        """stop playing immediately (drops the audio aplay has buffered)"""
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+            self._process = None
+
+    def close(self):
+        if self._process is not None:
+            try:
+                self._process.stdin.close()
+            except OSError:
+                pass
+            self._process.wait()
+            self._process = None
+
+
+class TTSEngine:
+    """
+    long-lived text to speech engine with an LRU cache of synthesized audio
+
+    repeated prompts (greetings, praise lines, rule texts) are played without any synthesis cost
+    """
+
+    def __init__(self, synthesizer=None, player=None, cache_size=256):
+        self.synthesizer = synthesizer if synthesizer is not None else EspeakSynthesizer()
+        self.player = player if player is not None else AudioPlayer()
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        # cache statistics
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, text: str, voice='en', rate=150) -> Audio:
+        """
+        get the audio for the text, from the cache if possible
+
+        :return: the synthesized audio
+        """
+        key = (text, voice, rate)
+        with self._lock:
+            audio = self._cache.get(key)
+            if audio is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                count('tts_cache_hit')
+                return audio
+            self.misses += 1
+        count('tts_cache_miss')
+
+        # synthesize outside the lock, so prerendering does not block speaking
+        with span('tts_synthesize'):
+            audio = self.synthesizer.synthesize(text, voice, rate)
+
+        with self._lock:
+            self._cache[key] = audio
+            self._cache.move_to_end(key)
+            # evict the least recently used audio
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return audio
+
+    def say(self, text: str, voice='en', rate=150, cancel_event=None) -> bool:
+        """
+        speak the text (blocks until it has been spoken)
+
+        :param cancel_event: if given and set while speaking, speaking stops
+        :return: True if the text was spoken completely
+        """
+        return self.player.play(self.render(text, voice, rate), cancel_event)
+
+    def prerender(self, phrases, voice='en', rate=150):
+        """synthesize the phrases into the cache"""
+        for phrase in phrases:
+            try:
+                self.render(phrase, voice, rate)
+            except (OSError, subprocess.CalledProcessError, ValueError) as e:
+                print(f'__could not prerender "{phrase}": {e}')
+
+    def prerender_async(self, phrases, voice='en', rate=150) -> threading.Thread:
+        """synthesize the phrases into the cache on a background thread"""
+        thread = threading.Thread(target=self.prerender, args=(list(phrases), voice, rate),
+                                  name='tts-prerender', daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'cached': len(self._cache)}
+
+    def close(self):
+        self.player.close()
+
+
+class SpeechQueue:
+    """
+    speaks texts in the background, one after another
+
+    putting a text returns immediately, so the dialog can already listen while the bot is speaking.
+    cancel() drops everything that has not been spoken yet (barge-in).
+    """
+
+    def __init__(self, engine: TTSEngine):
+        self.engine = engine
+        self._queue = queue.Queue()
+        # every queued text gets the cancel event current at the time it was queued,
+        # cancelling sets the event and replaces it, so texts queued afterwards are not affected
+        self._cancel_event = threading.Event()
+        # set while nothing is queued or being spoken
+        self._idle = threading.Event()
+        self._idle.set()
+        self._pending = 0
+        self._lock = threading.Lock()
+
+        self._thread = threading.Thread(target=self._run, name='speech-queue', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            text, voice, rate, cancel_event, queued_at = self._queue.get()
+            try:
+                # skip texts that were cancelled before they were spoken
+                if not cancel_event.is_set():
+                    # time the text waited behind the texts before it
+                    observe('tts_queue_wait', perf_counter() - queued_at)
+                    with span('tts_say'):
+                        self.engine.say(text, voice, rate, cancel_event)
+                else:
+                    count('tts_cancelled')
+            except (OSError, subprocess.CalledProcessError, ValueError) as e:
+                count('tts_error')
+                print(f'__tts error: {e}')
+            finally:
+                with self._lock:
+                    self._pending -= 1
+                    if self._pending == 0:
+                        self._idle.set()
+
+    def put(self, text: str, voice='en', rate=150):
+        """queue the text to be spoken and return immediately"""
+        with self._lock:
+            self._pending += 1
+            self._idle.clear()
+            self._queue.put((text, voice, rate, self._cancel_event, perf_counter()))
+
+    def is_speaking(self) -> bool:
+        """True while something is queued or being spoken"""
+        return not self._idle.is_set()
+
+    def cancel(self):
+        """stop speaking and drop everything queued (e.g. because the user started to talk)"""
+        with self._lock:
+            self._cancel_event.set()
+            self._cancel_event = threading.Event()
+
+    def wait(self, timeout=None) -> bool:
+        """
+        wait until everything queued has been spoken
+
+        :return: True if the queue is idle
+        """
+        return self._idle.wait(timeout)
+
+
+# the engine and queue shared by the whole process (created on first use)
+_engine = None
+_speech_queue = None
+
+
+def get_engine() -> TTSEngine:
+    global _engine
+    if _engine is None:
+        _engine = TTSEngine()
+    return _engine
+
+
+def get_speech_queue() -> SpeechQueue:
+    global _speech_queue
+    if _speech_queue is None:
+        _speech_queue = SpeechQueue(get_engine())
+    return _speech_queue
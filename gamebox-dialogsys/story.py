@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+"""
+incremental story generation for the word sequence game
+
+instead of re-encoding and re-running the whole story each turn, the token ids and
+the model's past_key_values are kept between turns and only new tokens are fed
+"""
+
+from time import monotonic
+
+import torch
+
+
+# punctuation after which a phrase can be spoken
+phrase_end_chars = '.,!?;:'
+
+
+# GPT-2 can not attend to more than 1024 tokens
+gpt2_max_context = 1024
+
+
+def cache_layers(past):
+    """
+    get the (key, value) tensors of each layer of a kv cache
+
+    (the cache is a tuple in older transformers versions and a Cache object in newer ones)
+    """
+    if past is None:
+        return []
+    if isinstance(past, (tuple, list)):
+        return [(layer[0], layer[1]) for layer in past]
+    if hasattr(past, 'layers'):
+        return [(layer.keys, layer.values) for layer in past.layers]
+    return list(zip(past.key_cache, past.value_cache))
+
+
+def make_cache(layers):
+    """build a kv cache the model accepts from (key, value) tensors of each layer"""
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return tuple(layers)
+
+    cache = DynamicCache()
+    for layer_idx, (keys, values) in enumerate(layers):
+        cache.update(keys, values, layer_idx)
+    return cache
+
+
+class StoryGenerator:
+    """
+    keeps the token buffer and kv cache of one story
+
+    the context window is bounded: when a turn would exceed max_context tokens,
+    only the last keep_tokens tokens are kept and the cache is rebuilt once from them
+    """
+
+    def __init__(self, tokenizer, model, max_context=gpt2_max_context, keep_tokens=None):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.max_context = max_context
+        # by default keep half of the window, so sliding only happens every few turns
+        self.keep_tokens = keep_tokens if keep_tokens is not None else max_context // 2
+
+        # token ids the kv cache (past) already covers
+        self.token_ids = []
+        # token ids that are part of the story, but have not been fed to the model yet
+        self.pending_ids = []
+        # the model's kv cache for self.token_ids
+        self.past = None
+
+    def __len__(self):
+        """number of tokens currently in the context window"""
+        return len(self.token_ids) + len(self.pending_ids)
+
+    def add_text(self, text: str):
+        """
+        add text (e.g. the user's input) to the story, it is fed lazily on the next generation
+
+        :param text: the text to add
+        """
+        if text:
+            self.pending_ids.extend(self.tokenizer.encode(text))
+
+    def _slide_window(self, n_new: int):
+        """drop the oldest tokens if the next generation would not fit into the context"""
+        if len(self) + n_new <= self.max_context:
+            return
+
+        # keep the newest tokens, but leave room for the generation
+        keep = max(1, min(self.keep_tokens, self.max_context - n_new))
+        all_ids = self.token_ids + self.pending_ids
+        # the cache can not be cut (positions would be off), so it is rebuilt from the kept tokens
+        self.token_ids = []
+        self.pending_ids = all_ids[-keep:]
+        self.past = None
+
+    def _step(self, input_ids):
+        """feed tokens to the model, update the cache and return the logits of the last position"""
+        outputs = self.model(input_ids=torch.tensor([input_ids]), past_key_values=self.past, use_cache=True)
+        self.past = outputs.past_key_values
+        self.token_ids.extend(input_ids)
+        return outputs.logits[0, -1]
+
+    def prepare(self, n_limit: int) -> int:
+        """
+        make room for the next generation and make sure there are tokens to feed
+
+        :param n_limit: maximum number of new tokens
+        :return: the number of tokens that can be generated (0 if there is nothing to continue from)
+        """
+        if n_limit <= 0:
+            return 0
+
+        # make sure prompt and new tokens fit into the window
+        n_limit = min(n_limit, self.max_context - 1)
+        self._slide_window(n_limit)
+
+        # nothing to continue from
+        if not self.pending_ids:
+            if not self.token_ids:
+                return 0
+            # rebuild the cache to get fresh logits (rare, e.g. after an end of text token)
+            self.pending_ids = self.token_ids
+            self.token_ids = []
+            self.past = None
+
+        return n_limit
+
+    def generate_ids(self, n_limit: int, deadline=None):
+        """
+        generate up to n_limit new tokens (greedy decoding), yielding each token id as soon as it is chosen
+
+        :param n_limit: maximum number of new tokens
+        :param deadline: time.monotonic() after which no more tokens are generated (like reaching n_limit)
+        """
+        n_limit = self.prepare(n_limit)
+        if n_limit <= 0:
+            return
+
+        for _ in range(n_limit):
+            # inference mode only around the step, not while the caller has the token
+            # (it would stay on in the caller's code until the generator is closed)
+            with torch.inference_mode():
+                logits = self._step(self.pending_ids)
+                next_id = int(torch.argmax(logits))
+            # the generated token becomes part of the story, it is fed with the next step/turn
+            self.pending_ids = [next_id]
+
+            if next_id == self.tokenizer.eos_token_id:
+                # do not keep the end of text token in the story
+                self.pending_ids = []
+                return
+
+            yield next_id
+
+            if deadline is not None and monotonic() >= deadline:
+                return
+
+    def generate(self, n_limit: int) -> str:
+        """
+        generate the continuation of the story
+
+        :param n_limit: maximum number of new tokens
+        :return: the generated text (only the new part)
+        """
+        return self.tokenizer.decode(list(self.generate_ids(n_limit)), skip_special_tokens=True)
+
+    def stream_words(self, n_limit: int, deadline=None):
+        """
+        generate the continuation of the story, yielding it word by word while decoding
+
+        :param n_limit: maximum number of new tokens
+        :param deadline: time.monotonic() after which no more tokens are generated
+        :return: generator of text pieces (each a complete word with its leading whitespace)
+        """
+        ids = []
+        text = ''
+        emitted = 0
+
+        for next_id in self.generate_ids(n_limit, deadline):
+            ids.append(next_id)
+            text = self.tokenizer.decode(ids, skip_special_tokens=True)
+
+            # a word is complete once the next one has started,
+            # so everything before the last whitespace can be emitted
+            boundary = max(text.rfind(' '), text.rfind('\n'))
+            if boundary > emitted:
+                yield text[emitted:boundary]
+                emitted = boundary
+
+        # the last word is complete when generation stops
+        if len(text) > emitted:
+            yield text[emitted:]
+
+
+def stream_phrases(words, max_words=6, first_max_words=3):
+    """
+    group a stream of words into phrases that can be spoken one after another
+
+    a phrase ends at punctuation or after max_words words, the first phrase is
+    kept shorter, so the first audio does not have to wait for many tokens
+
+    :param words: iterable of words (e.g. from StoryGenerator.stream_words)
+    :param max_words: maximum number of words per phrase
+    :param first_max_words: maximum number of words of the first phrase
+    :return: generator of phrases
+    """
+    phrase = ''
+    n_words = 0
+    limit = first_max_words
+
+    for word in words:
+        phrase += word
+        n_words += 1
+
+        if phrase.rstrip().endswith(tuple(phrase_end_chars)) or n_words >= limit:
+            yield phrase
+            phrase = ''
+            n_words = 0
+            limit = max_words
+
+    if phrase.strip():
+        yield phrase
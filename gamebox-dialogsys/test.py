@@ -1,14 +1,16 @@
 #!/usr/bin/env python3
 
 import torch
-from transformers import GPT2Tokenizer, GPT2LMHeadModel
 import random
 
-# Load pre-trained model tokenizer (vocabulary)
-tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
+from models import get_gpt2, set_inference_profile
 
-# Load pre-trained model (weights)
-model = GPT2LMHeadModel.from_pretrained('gpt2')
+# choose how the model runs on the cpu ('default', 'int8', 'distil' or 'distil-int8', see models.py)
+set_inference_profile('default')
+
+# Load pre-trained model tokenizer (vocabulary) and model (weights)
+# from the process wide registry
+tokenizer, model = get_gpt2()
 
 def predict(text: str, n_limit=50):
     """
@@ -30,14 +32,16 @@ def predict(text: str, n_limit=50):
 
     # Generate text
     attention_mask = torch.ones(input_ids.shape, device=input_ids.device) # Ensure attention is only on the input sequence
-    output_sequences = model.generate(
-        input_ids=input_ids,
-        attention_mask=attention_mask,
-        max_length=input_tokens_count + n_limit,  # Adjust max_length for the desired number of additional tokens
-        temperature=1.0,
-        num_return_sequences=1,
-        pad_token_id=tokenizer.eos_token_id
-    )
+    # no autograd bookkeeping, we only do inference
+    with torch.inference_mode():
+        output_sequences = model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            max_length=input_tokens_count + n_limit,  # Adjust max_length for the desired number of additional tokens
+            temperature=1.0,
+            num_return_sequences=1,
+            pad_token_id=tokenizer.eos_token_id
+        )
 
     # Decode the output
     return tokenizer.decode(output_sequences[0], skip_special_tokens=True)
@@ -4,15 +4,34 @@
 utils needed by the dialog manager
 """
 
-import os
-import subprocess
-import speech_recognition as sr
-import requests
-import json
+import select
+import sys
+
+from speech_output import get_engine, get_speech_queue
+import threading
+
+from metrics import span
+
+# speech_input (speech_recognition) and the nlu modules (requests, the local classifier) are
+# imported on first use or by warm_up(), so the bot can greet without waiting for them
 
 # in print mode stdin/stdout is used instead of asr/tts
 print_mode = False
 
+# while the bot is speaking, the user has to be this much louder than the energy threshold
+# to interrupt it (so the bot's own voice from the speakers does not count as the user talking)
+barge_in_threshold_factor = 2.0
+
+# settings of the asr session and the session itself (opened on first use)
+asr_options = {'backend': 'google'}
+asr_session = None
+
+# the rasa server and the parser (created on first use): a local classifier trained from data/nlu.yml
+# answers confident utterances, the others go to the pooled rasa client with a cache of the results
+rasa_url = 'http://localhost:5005'
+nlu_client = None
+_nlu_client_lock = threading.Lock()
+
 def set_print_mode(mode: bool):
     global print_mode
     print_mode = mode
@@ -20,8 +39,40 @@ def set_print_mode(mode: bool):
 def get_print_mode() -> bool:
     return print_mode
 
+def set_asr_backend(backend: str, **options):
+    """
+    choose the asr backend ('google' needs network access, 'vosk' and 'sphinx' work offline)
+
+    :param options: further options of ASRSession (e.g. fallback_backend, vosk_model_path, vad)
+    """
+    global asr_options, asr_session
+    asr_options = dict(options, backend=backend)
+    # the next asr call opens a new session with these settings
+    if asr_session is not None:
+        asr_session.close()
+        asr_session = None
+
+def set_rasa_url(url: str):
+    """use another rasa server (e.g. a stand-in for benchmarks)"""
+    global rasa_url, nlu_client
+    rasa_url = url
+    # the next parse creates a new client for this server
+    nlu_client = None
+
+def get_asr_session():
+    """the asr session (an ASRSession of speech_input.py)"""
+    global asr_session
+    if asr_session is None:
+        from speech_input import ASRSession
+        asr_session = ASRSession(**asr_options)
+    return asr_session
+
 def tts(text, language='en'):
-    """Text to speech function using espeak"""
+    """
+    Text to speech function using espeak (through the cached tts engine)
+
+    the text is queued and spoken in the background, so this returns immediately
+    """
 
     if not text:
         return
@@ -35,71 +86,137 @@ def tts(text, language='en'):
     if print_mode:
         return
 
-    # use espeak to convert text to speech
-    command = f'espeak -v {language} -s 150 "{text}"'
-    
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    process.wait()
+    # use espeak to convert text to speech (cached audio is played without running espeak)
+    get_speech_queue().put(text, voice=language, rate=150)
 
 
-def asr() -> str:
-    """perform automatic speech recognition using google speech recognition"""
+def tts_prepare(text, language='en'):
+    """
+    synthesize a text that will probably be said soon in the background,
+    so saying it later only plays the cached audio
+    """
+    if not text or print_mode:
+        return
+
+    get_engine().prerender_async([text], voice=language, rate=150)
+
+
+def wait_for_speech():
+    """block until everything queued with tts has been spoken"""
+    if not print_mode:
+        get_speech_queue().wait()
+
+
+def _barge_in_factor() -> float:
+    return barge_in_threshold_factor if get_speech_queue().is_speaking() else 1.0
+
+
+def _read_line(timeout=None):
+    """read a line from stdin, None if nothing was typed within timeout seconds"""
+    print('>> ', end='', flush=True)
+    if timeout is not None:
+        readable, _, _ = select.select([sys.stdin], [], [], timeout)
+        if not readable:
+            print()
+            return None
+
+    line = sys.stdin.readline()
+    if not line:
+        raise EOFError
+    return line.rstrip('\n')
+
+
+def asr(timeout=None, expected_input='default') -> str:
+    """
+    perform automatic speech recognition (google speech recognition or an offline backend)
+
+    :param timeout: seconds to wait for the user to start speaking (None: wait forever)
+    :param expected_input: what the user is expected to say, chooses how long a pause ends the input
+        ('answer', 'confirmation', 'story' or 'default', see speech_input.endpointing_presets)
+    :return: the recognized text ('' if nothing was recognized), None if the user did not speak in time
+    """
 
     global print_mode
 
     if print_mode:
-        return input('>> ')
-
-    # speech recognition using google speech recognition
-    # could also easily use bing, sphinx, etc. using this lib
-    recognizer = sr.Recognizer()
-    with sr.Microphone() as source:
-        audio = recognizer.listen(source)
-    try:
-        rec = recognizer.recognize_google(audio)
-        # print what has been recognized
-        print('>> ' + rec)
-        return rec
-    except Exception as e:
+        return _read_line(timeout)
+
+    # the session keeps the microphone open and calibrated between the turns
+    session = get_asr_session()
+    # start listening right away, even if the bot is still speaking,
+    # and stop the bot's speech as soon as the user starts to talk (barge-in)
+    speech_queue = get_speech_queue()
+    with span('asr'):
+        rec = session.listen_and_recognize(on_speech_start=speech_queue.cancel,
+                                           start_threshold_factor=_barge_in_factor, timeout=timeout,
+                                           endpointing=expected_input)
+    if session.timed_out:
         return None
 
+    timing = session.last_timing
+    if rec:
+        # print what has been recognized
+        print(f'>> {rec}')
+    print(f'__asr listen {timing["listen"]:.2f}s ({expected_input}), recognize {timing["recognize"]:.2f}s'
+          + (f' ({session.last_error})' if session.last_error else ''))
+    return rec or ''
 
-def rasa_parse(text):
+
+def get_nlu_client():
+    """the nlu parser (a HybridParser of fast_nlu.py)"""
+    global nlu_client
+    # (it might be created by warm_up() and the dialog at the same time)
+    with _nlu_client_lock:
+        if nlu_client is None:
+            from nlu import RasaClient, CachingParser
+            from fast_nlu import LocalIntentClassifier, HybridParser
+            nlu_client = HybridParser(LocalIntentClassifier.load_or_train(), CachingParser(RasaClient(rasa_url)))
+    return nlu_client
+
+
+def warm_up() -> threading.Thread:
+    """
+    create the nlu client and import the asr on a background (daemon) thread,
+    e.g. while the greeting is spoken
+
+    :return: the thread doing the warm-up
+    """
+    def run():
+        get_nlu_client()
+        if not print_mode:
+            import speech_input  # noqa: F401 (only imported to have it loaded)
+
+    thread = threading.Thread(target=run, name='warm-up', daemon=True)
+    thread.start()
+    return thread
+
+def nlu_parse(text):
     """
     input text into the rasa NLU model
-    
+
     :param text: input text
-    :return: most probable intent, entity (is type None if there is none)
+    :return: the full result (intent ranking with confidences and all entities), None if text is empty
     """
 
     # if the text is empty, return None
     if not text:
-        return None, None
-
-    url = 'http://localhost:5005/model/parse'
-    data = {'text': text}
-
-    # Set the headers for the request
-    headers = {'Content-Type': 'application/json'}
-
-    # Make the POST request
-    response = requests.post(url, data=json.dumps(data), headers=headers)
+        return None
 
-    # Check the response
-    if response.status_code == 200:
-        # Parse the JSON response
-        parsed_data = response.json()
+    # if the server can not be reached (and the local classifier is not sure), the result has the nlu_fallback intent
+    with span('nlu'):
+        return get_nlu_client().parse(text)
 
-        # get the most probable intent from data
-        intent = parsed_data['intent']['name']
-        entity = None
 
-        # and the entity if there is one 
-        if len(parsed_data['entities']) > 0:
-            entity = parsed_data['entities'][0]['value']
+def rasa_parse(text):
+    """
+    input text into the rasa NLU model
+    
+    :param text: input text
+    :return: most probable intent, entity (is type None if there is none)
+    """
 
-        return intent, entity 
-    else:
-        # If the response code is not 200, print an error message
-        tts('Rasa NLU server error')
+    result = nlu_parse(text)
+    if result is None:
         return None, None
+
+    return result.intent, result.entity
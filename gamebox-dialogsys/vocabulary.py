@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+"""
+vocabularies of the category games (e.g. animals, foods)
+
+each category is loaded only once per process, its entries are normalized and indexed
+by their initial letter. large vocabularies can be compiled into a binary file that is
+memory-mapped, so only the letters that are actually played are read.
+"""
+
+import json
+import mmap
+import os
+import struct
+import threading
+import unicodedata
+
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+game_data_dir = os.path.join(base_dir, 'game_data')
+
+# header of the compiled vocabulary: magic, number of letters
+compiled_magic = b'GBV1'
+header_format = '<4sI'
+# per letter: code point of the letter, offset and length of its words, number of words
+letter_format = '<IQQI'
+
+
+def normalize_entry(entry: str) -> str:
+    """normalize a vocabulary entry (unicode form, case and whitespace)"""
+    return ' '.join(unicodedata.normalize('NFC', entry).lower().split())
+
+
+def initial_letter(entry: str):
+    """upper case initial letter of a (normalized) entry, None if it does not start with a letter"""
+    if not entry or not entry[0].isalpha():
+        return None
+    # letters with accents are indexed by their base letter
+    return unicodedata.normalize('NFD', entry[0])[0].upper()
+
+
+class Vocabulary:
+    """normalized entries of a category, indexed by initial letter"""
+
+    def __init__(self, category: str, by_letter: dict):
+        """
+        :param category: name of the category (e.g. 'animals')
+        :param by_letter: upper case letter -> list of normalized entries
+        """
+        self.category = category
+        self._by_letter = by_letter
+
+    @classmethod
+    def from_entries(cls, category: str, entries):
+        """normalize and index the entries (duplicates are dropped, order is kept)"""
+        by_letter = {}
+        seen = set()
+        for entry in entries:
+            entry = normalize_entry(entry)
+            letter = initial_letter(entry)
+            if not entry or letter is None or entry in seen:
+                continue
+            seen.add(entry)
+            by_letter.setdefault(letter, []).append(entry)
+        return cls(category, by_letter)
+
+    @classmethod
+    def from_json(cls, category: str, path: str):
+        """load a game_data json file (letter -> list of entries)"""
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return cls.from_entries(category, (entry for entries in data.values() for entry in entries))
+
+    def words(self, letter: str):
+        """
+        get the entries starting with the letter
+
+        :return: list of normalized entries (empty if there are none), do not modify it
+        """
+        return self._by_letter.get(letter.upper(), [])
+
+    def count(self, letter: str) -> int:
+        """number of entries starting with the letter"""
+        return len(self.words(letter))
+
+    def letters(self):
+        """letters that have at least one entry"""
+        return sorted(letter for letter in self._letters() if self.count(letter))
+
+    def _letters(self):
+        return self._by_letter.keys()
+
+    def __contains__(self, entry) -> bool:
+        entry = normalize_entry(entry)
+        letter = initial_letter(entry)
+        return letter is not None and entry in self.words(letter)
+
+    def __len__(self):
+        return sum(self.count(letter) for letter in self._letters())
+
+    def compile(self, path: str):
+        """write the vocabulary as a binary file that can be memory-mapped (see MappedVocabulary)"""
+        letters = sorted(self._letters())
+        blobs = ['\n'.join(self.words(letter)).encode('utf-8') for letter in letters]
+
+        offset = struct.calcsize(header_format) + len(letters) * struct.calcsize(letter_format)
+        table = []
+        for letter, blob in zip(letters, blobs):
+            table.append(struct.pack(letter_format, ord(letter), offset, len(blob), len(self.words(letter))))
+            offset += len(blob)
+
+        with open(path, 'wb') as f:
+            f.write(struct.pack(header_format, compiled_magic, len(letters)))
+            f.write(b''.join(table))
+            f.write(b''.join(blobs))
+
+
+class MappedVocabulary(Vocabulary):
+    """
+    vocabulary read from a compiled, memory-mapped file
+
+    the words of a letter are only decoded when that letter is used for the first time
+    """
+
+    def __init__(self, category: str, path: str):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, n_letters = struct.unpack_from(header_format, self._map, 0)
+        if magic != compiled_magic:
+            raise ValueError(f'{path} is not a compiled vocabulary')
+
+        # letter -> (offset, length, number of words)
+        self._table = {}
+        position = struct.calcsize(header_format)
+        for _ in range(n_letters):
+            code_point, offset, length, n_words = struct.unpack_from(letter_format, self._map, position)
+            self._table[chr(code_point)] = (offset, length, n_words)
+            position += struct.calcsize(letter_format)
+
+        super().__init__(category, {})
+
+    def words(self, letter: str):
+        letter = letter.upper()
+        if letter not in self._by_letter:
+            if letter not in self._table:
+                return []
+            offset, length, _ = self._table[letter]
+            blob = self._map[offset:offset + length].decode('utf-8')
+            self._by_letter[letter] = blob.split('\n') if blob else []
+        return self._by_letter[letter]
+
+    def count(self, letter: str) -> int:
+        # from the table, without decoding the words
+        entry = self._table.get(letter.upper())
+        return entry[2] if entry is not None else 0
+
+    def _letters(self):
+        return self._table.keys()
+
+
+class VocabularyStore:
+    """loads every category once per process"""
+
+    def __init__(self, data_dir=game_data_dir):
+        self.data_dir = data_dir
+        self._vocabularies = {}
+        self._lock = threading.Lock()
+
+    def categories(self):
+        """names of the categories there is game data for"""
+        return sorted({os.path.splitext(name)[0] for name in os.listdir(self.data_dir)
+                       if name.endswith(('.json', '.vocab'))})
+
+    def _load(self, category: str) -> Vocabulary:
+        json_path = os.path.join(self.data_dir, f'{category}.json')
+        compiled_path = os.path.join(self.data_dir, f'{category}.vocab')
+
+        # prefer the compiled file if it is up to date
+        if os.path.exists(compiled_path) and (not os.path.exists(json_path)
+                                              or os.path.getmtime(compiled_path) >= os.path.getmtime(json_path)):
+            return MappedVocabulary(category, compiled_path)
+
+        return Vocabulary.from_json(category, json_path)
+
+    def get(self, category: str) -> Vocabulary:
+        vocabulary = self._vocabularies.get(category)
+        if vocabulary is None:
+            with self._lock:
+                vocabulary = self._vocabularies.get(category)
+                if vocabulary is None:
+                    vocabulary = self._load(category)
+                    self._vocabularies[category] = vocabulary
+        return vocabulary
+
+    def preload(self):
+        """load all categories (e.g. at startup, so starting a game costs no i/o)"""
+        for category in self.categories():
+            self.get(category)
+
+
+# the store shared by the whole process
+store = VocabularyStore()
+
+
+def get_vocabulary(category: str) -> Vocabulary:
+    return store.get(category)
+
+
+if __name__ == '__main__':
+    # compile all categories, e.g. for vocabularies too large to parse at every start
+    for category in store.categories():
+        vocabulary = Vocabulary.from_json(category, os.path.join(game_data_dir, f'{category}.json'))
+        vocabulary.compile(os.path.join(game_data_dir, f'{category}.vocab'))
+        print(f'compiled {category}: {len(vocabulary)} entries')